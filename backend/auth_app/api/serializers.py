@@ -2,6 +2,8 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 
+from content_app.authentication import add_user_claims
+
 User = get_user_model()
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -69,6 +71,13 @@ class LoginSerializer(TokenObtainPairSerializer):
     email = serializers.EmailField()
     password = serializers.CharField(write_only=True)
 
+    @classmethod
+    def get_token(cls, user):
+        """
+            Add the claims of the lightweight user, refreshed access tokens inherit them
+        """
+        return add_user_claims(super().get_token(user), user)
+
     def __init__(self, *args, **kwargs):
         """
             Remove username field from TokenObtainPairSerializer.
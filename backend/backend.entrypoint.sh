@@ -38,6 +38,21 @@ else:
     print(f"Superuser '{username}' already exists.")
 EOF
 
-python manage.py rqworker default &
+python manage.py collect_rendition_garbage --schedule
+python manage.py rqworker default transcode_high transcode --with-scheduler &
+
+# Additional workers which only encode renditions, more hosts can join the transcode queues the same way.
+# Queues are worked in order, so the lowest rendition of a new upload never waits behind a full ladder
+for i in $(seq 2 "${TRANSCODE_WORKERS:-1}"); do
+  python manage.py rqworker transcode_high transcode &
+done
+
+# HLS_SEGMENT_CACHE_BUDGET=<bytes> keeps hot segments in memory, every one of the 3 workers below holds
+# its own budget unless HLS_SEGMENT_CACHE_DIR=/dev/shm/segments lets them share one
+# ASGI=True serves playlists and segments from async views on uvicorn, a slow viewer then holds no thread
+if [ "${ASGI:-False}" = "True" ]; then
+  export HLS_ASYNC_VIEWS=True
+  exec uvicorn core.asgi:application --host 0.0.0.0 --port 8000 --workers 3
+fi
 
 exec gunicorn core.wsgi:application --bind 0.0.0.0:8000 --workers 3 --timeout 60 --reload
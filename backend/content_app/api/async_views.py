@@ -0,0 +1,89 @@
+import os
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.http import require_safe
+from rest_framework.exceptions import AuthenticationFailed
+
+from content_app.authentication import CookieJWTAuthentication
+from content_app.locations import aget_video_location, ahas_rendition
+from content_app.playlists import sign_media_playlist
+from content_app.rendition_storage import get_rendition_storage
+from content_app.segment_tokens import check_segment_token, sign_segment_token
+from .responses import arendered_response, asegment_response
+from .views import SEGMENT_CONTENT_TYPES, SEGMENT_NAME_RE, get_rendition_file_name, segment_cache_key
+
+
+def error_response(detail, status, headers=None):
+    """
+        Error body in the format of the DRF views
+    """
+    return JsonResponse(detail if isinstance(detail, dict) else {'detail': detail}, status=status, headers=headers)
+
+
+async def authenticate(request):
+    """
+        Error response unless the access token cookie belongs to an active user
+    """
+    try:
+        result = await CookieJWTAuthentication().aauthenticate(request)
+    except AuthenticationFailed as error:
+        return error_response(error.detail, 401, {'WWW-Authenticate': 'Bearer realm="api"'})
+    if result is None:
+        return error_response('Authentication credentials were not provided.', 401, {'WWW-Authenticate': 'Bearer realm="api"'})
+    request.user = result[0]
+    return None
+
+
+@require_safe
+async def hls_playlist(request, pk, resolution):
+    """
+        HLSPlayListView for ASGI deployments, auth, cache lookups and file reads don't block the event loop
+    """
+    if error := await authenticate(request):
+        return error
+
+    location = await aget_video_location(pk)
+    if location is None:
+        return error_response('Video not found.', 404)
+    if not await ahas_rendition(pk, location, resolution):
+        return error_response('Resolution not found.', 404)
+
+    name = get_rendition_file_name(location, resolution, 'index.m3u8')
+    token = sign_segment_token(pk, resolution)
+    expires = token.partition('.')[0]
+
+    try:
+        return await arendered_response(
+            request, get_rendition_storage(), name, 'application/vnd.apple.mpegurl',
+            settings.HLS_PLAYLIST_CACHE_CONTROL, lambda text: sign_media_playlist(text, token), version=f'-{int(expires):x}'
+        )
+    except FileNotFoundError:
+        return error_response('HSL Playlist not found.', 404)
+
+
+@require_safe
+async def hls_segment(request, pk, resolution, segment):
+    """
+        HSLSegmentView for ASGI deployments, cached segments are served without a thread, others are
+        streamed in bounded chunks read in worker threads. A slow viewer holds no thread while the event loop waits for it
+    """
+    if not check_segment_token(request.GET.get('token'), pk, resolution):
+        return error_response('You do not have permission to perform this action.', 403)
+    if not SEGMENT_NAME_RE.fullmatch(segment):
+        return error_response('Segment not found.', 404)
+
+    location = await aget_video_location(pk)
+    if location is None:
+        return error_response('Video not found.', 404)
+
+    name = get_rendition_file_name(location, resolution, segment)
+    content_type = SEGMENT_CONTENT_TYPES.get(os.path.splitext(segment)[1], 'application/octet-stream')
+
+    try:
+        return await asegment_response(
+            request, get_rendition_storage(), name, content_type, settings.HLS_SEGMENT_CACHE_CONTROL,
+            segment_cache_key(location, resolution, segment)
+        )
+    except FileNotFoundError:
+        return error_response('Segment not found.', 404)
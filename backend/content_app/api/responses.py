@@ -0,0 +1,279 @@
+import asyncio
+import re
+from functools import partial
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from content_app.segment_cache import CachedSegment, get_segment_cache
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header, size):
+    """
+        Return (start, end) of a single byte range header, end inclusive.
+        None if the header is missing or not a single range, False if it can't be satisfied
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def file_etag(stat, version=''):
+    """
+        Strong ETag from modification time and size in the format nginx uses for static files,
+        so the validators stay the same when the proxy serves the file. The content is never read.
+        A version tells apart responses rendered differently from the same file
+    """
+    return f'"{int(stat.mtime):x}-{stat.size:x}{version}"'
+
+
+def range_applies(request, etag, stat):
+    """
+        A Range header is honoured unless the If-Range validator no longer matches the file
+    """
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(stat.mtime)
+
+
+def storage_file_response(storage, name, content_type, size):
+    """
+        Serve a whole file of the rendition storage. Local files go through FileResponse so the
+        server can use sendfile, remote files are streamed
+    """
+    path = storage.local_path(name)
+    if path is not None:
+        return FileResponse(open(path, 'rb'), content_type=content_type)
+
+    response = StreamingHttpResponse(storage.iter_range(name), content_type=content_type)
+    response['Content-Length'] = str(size)
+    return response
+
+
+def offload_response(storage, name, content_type):
+    """
+        Empty response which hands the file to the reverse proxy with X-Accel-Redirect or X-Sendfile,
+        the proxy answers range requests itself. None when offloading is off or the file is not local
+    """
+    path = storage.local_path(name)
+    if not settings.HLS_OFFLOAD or path is None:
+        return None
+
+    response = HttpResponse(content_type=content_type)
+    if settings.HLS_OFFLOAD == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = quote(f"{settings.HLS_OFFLOAD_PREFIX.rstrip('/')}/{name}")
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+def ranged_file_response(request, storage, name, content_type, stat, etag, iter_range=None):
+    """
+        Serve a file of the rendition storage, or the part of it asked for by a Range header with 206.
+        With iter_range the file is streamed from it, e.g. from async reads
+    """
+    byte_range = parse_range(request.headers.get('Range'), stat.size)
+    if byte_range and not range_applies(request, etag, stat):
+        byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.size}'
+        return response
+
+    if byte_range is None and iter_range is None:
+        response = storage_file_response(storage, name, content_type, stat.size)
+    elif byte_range is None:
+        response = StreamingHttpResponse(iter_range(name), content_type=content_type)
+        response['Content-Length'] = str(stat.size)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            (iter_range or storage.iter_range)(name, start, end - start + 1),
+            status=206,
+            content_type=content_type
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.size}'
+        response['Content-Length'] = str(end - start + 1)
+
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def storage_response(request, storage, name, content_type, cache_control, offload=False, stat=None, iter_range=None):
+    """
+        Serve a file of the rendition storage with validators from its metadata. If-None-Match and
+        If-Modified-Since are answered with 304 before the file is opened, a single byte range with 206.
+        With offload the reverse proxy sends the file. A missing file raises FileNotFoundError
+    """
+    stat = stat or storage.stat(name)
+    etag = file_etag(stat)
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.mtime))
+    if response is None and offload:
+        response = offload_response(storage, name, content_type)
+    if response is None:
+        response = ranged_file_response(request, storage, name, content_type, stat, etag, iter_range)
+
+    return set_validators(response, etag, cache_control, stat.mtime)
+
+
+def rendered_response(request, storage, name, content_type, cache_control, render, version=''):
+    """
+        Serve a small text file of the rendition storage rewritten by render, e.g. a playlist.
+        The ETag comes from the file metadata and the version of the rendering, there is no
+        Last-Modified since the rendering changes while the file does not
+    """
+    stat = storage.stat(name)
+    etag = file_etag(stat, version)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = HttpResponse(render(storage.read_text(name)), content_type=content_type)
+    return set_validators(response, etag, cache_control)
+
+
+async def aiter_range(storage, name, start=0, length=None):
+    """
+        Async iterator over a part of a file, every bounded chunk is read in a worker thread
+        so a slow client holds no thread while it waits for the next one
+    """
+    chunks = storage.iter_range(name, start, length)
+    try:
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            yield chunk
+    finally:
+        await asyncio.to_thread(chunks.close)
+
+
+async def astorage_response(request, storage, name, content_type, cache_control, offload=False):
+    """
+        storage_response for async views, the stat and the reads of the file don't block the event loop
+    """
+    stat = await asyncio.to_thread(storage.stat, name)
+    return storage_response(
+        request, storage, name, content_type, cache_control, offload, stat=stat, iter_range=partial(aiter_range, storage)
+    )
+
+
+async def arendered_response(request, storage, name, content_type, cache_control, render, version=''):
+    """
+        rendered_response for async views
+    """
+    stat = await asyncio.to_thread(storage.stat, name)
+    etag = file_etag(stat, version)
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        text = await asyncio.to_thread(storage.read_text, name)
+        response = HttpResponse(render(text), content_type=content_type)
+    return set_validators(response, etag, cache_control)
+
+
+def iter_memory(data, name, start=0, length=None):
+    """
+        iter_range over a cached file
+    """
+    yield bytes(data[start:len(data) if length is None else start + length])
+
+
+async def aiter_memory(data, name, start=0, length=None):
+    yield bytes(data[start:len(data) if length is None else start + length])
+
+
+def caches_segment(segment_cache, storage, name):
+    """
+        Files the reverse proxy sends with offloading are left to it
+    """
+    return segment_cache is not None and not (settings.HLS_OFFLOAD and storage.local_path(name) is not None)
+
+
+def read_segment(storage, name, stat):
+    """
+        Whole file small enough for the segment cache, None otherwise
+    """
+    if stat.size > settings.HLS_SEGMENT_CACHE_MAX_SIZE:
+        return None
+    return b''.join(storage.iter_range(name))
+
+
+def segment_response(request, storage, name, content_type, cache_control, key):
+    """
+        storage_response for segments with the hot segment cache in front of the storage, a hit
+        is served from memory without opening the file. X-Cache tells hits from misses
+    """
+    segment_cache = get_segment_cache()
+    if not caches_segment(segment_cache, storage, name):
+        return storage_response(request, storage, name, content_type, cache_control, offload=True)
+
+    entry = segment_cache.get(key)
+    hit = entry is not None
+    if not hit:
+        stat = storage.stat(name)
+        data = read_segment(storage, name, stat)
+        if data is None:
+            return storage_response(request, storage, name, content_type, cache_control, stat=stat)
+        segment_cache.put(key, data, stat)
+        entry = CachedSegment(data, stat)
+
+    response = storage_response(
+        request, storage, name, content_type, cache_control, stat=entry.stat, iter_range=partial(iter_memory, entry.data)
+    )
+    response['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+
+async def asegment_response(request, storage, name, content_type, cache_control, key):
+    """
+        segment_response for async views, only misses read in worker threads
+    """
+    segment_cache = get_segment_cache()
+    if not caches_segment(segment_cache, storage, name):
+        return await astorage_response(request, storage, name, content_type, cache_control, offload=True)
+
+    entry = segment_cache.get(key)
+    hit = entry is not None
+    if not hit:
+        stat = await asyncio.to_thread(storage.stat, name)
+        data = await asyncio.to_thread(read_segment, storage, name, stat)
+        if data is None:
+            return storage_response(
+                request, storage, name, content_type, cache_control, stat=stat, iter_range=partial(aiter_range, storage)
+            )
+        segment_cache.put(key, data, stat)
+        entry = CachedSegment(data, stat)
+
+    response = storage_response(
+        request, storage, name, content_type, cache_control, stat=entry.stat, iter_range=partial(aiter_memory, entry.data)
+    )
+    response['X-Cache'] = 'HIT' if hit else 'MISS'
+    return response
+
+
+def set_validators(response, etag, cache_control, mtime=None):
+    if response.status_code in (200, 206, 304):
+        response['ETag'] = etag
+        response['Cache-Control'] = cache_control
+        if mtime is not None:
+            response['Last-Modified'] = http_date(mtime)
+    return response
@@ -8,7 +8,7 @@ class VideoSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = Video 
-        exclude = ['video_file']
+        exclude = ['video_file', 'content_hash', 'cpu_seconds', 'manifest']
 
     
 
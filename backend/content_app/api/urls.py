@@ -1,11 +1,27 @@
+from django.conf import settings
 from django.urls import path
-from .views import VideoListView, HLSPlayListView, HSLSegmentView
 
+from . import async_views
+from .views import (
+    VideoListView, HLSMasterPlayListView, HLSPlayListView, HSLSegmentView, SegmentCacheStatsView, TrickplayView,
+    VideoUploadCreateView, VideoUploadView
+)
+
+# ASGI deployments serve playlists and segments from async views
+if settings.HLS_ASYNC_VIEWS:
+    playlist_view, segment_view = async_views.hls_playlist, async_views.hls_segment
+else:
+    playlist_view, segment_view = HLSPlayListView.as_view(), HSLSegmentView.as_view()
 
 urlpatterns = [
     path('video/', VideoListView.as_view(), name='video-list'),
-    path('video/<int:pk>/<str:resolution>/index.m3u8', HLSPlayListView.as_view(), name='HSL-playlist'),
-    path('video/<int:pk>/<str:resolution>/<str:segment>/', HSLSegmentView.as_view(), name='HSL-segment')
+    path('video/uploads/', VideoUploadCreateView.as_view(), name='video-upload-create'),
+    path('video/uploads/<uuid:pk>/', VideoUploadView.as_view(), name='video-upload'),
+    path('video/segment-cache/', SegmentCacheStatsView.as_view(), name='segment-cache-stats'),
+    path('video/<int:pk>/master.m3u8', HLSMasterPlayListView.as_view(), name='HSL-master-playlist'),
+    path('video/<int:pk>/trickplay/<str:filename>', TrickplayView.as_view(), name='trickplay'),
+    path('video/<int:pk>/<str:resolution>/index.m3u8', playlist_view, name='HSL-playlist'),
+    path('video/<int:pk>/<str:resolution>/<str:segment>/', segment_view, name='HSL-segment')
 ]
 
 
@@ -1,16 +1,66 @@
 import os
+import re
 
 from rest_framework.generics import ListAPIView
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.views import APIView
-from rest_framework.exceptions import NotFound
-from django.http import FileResponse
+from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework import status
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.urls import reverse
 
-from content_app.models import Video
+from content_app.models import Video, VideoUpload, upload_video_path, validate_video_file_extension
+from content_app.uploads import (
+    TUS_VERSION, ChecksumMismatch, UploadLocked, parse_metadata, parse_checksum, open_upload_file, write_chunk,
+    create_video_from_upload
+)
+from content_app.tasks import FMP4_FILENAME, get_rendition_dir, get_master_playlist_path, get_trickplay_dir
+from content_app.rendition_storage import get_rendition_storage
+from content_app.locations import get_video_location, has_rendition
+from content_app.playlists import sign_media_playlist
+from content_app.segment_tokens import HasSegmentToken, sign_segment_token
+from content_app.segment_cache import get_segment_cache
 from .serializers import VideoSerializer
+from .responses import rendered_response, segment_response, storage_response
 
-def get_video_base_path(video):
-    return os.path.splitext(video.video_file.path)[0]
+SEGMENT_CONTENT_TYPES = {
+    '.ts': 'video/MP2T',
+    '.mp4': 'video/mp4',
+}
+
+# Names the muxer gives segments, numbered mpegts segments of new and legacy videos or the one fmp4 file.
+# Anything else, like '..' or a playlist, is not looked up in the storage
+SEGMENT_NAME_RE = re.compile(rf'segment_\d{{3,}}\.ts|{re.escape(FMP4_FILENAME)}')
+
+TRICKPLAY_CONTENT_TYPES = {
+    '.vtt': 'text/vtt',
+    '.jpg': 'image/jpeg',
+}
+
+def get_location(pk):
+    """
+        Cached rendition location of a video, the HLS views don't query the database once it is cached
+    """
+    location = get_video_location(pk)
+    if location is None:
+        raise NotFound("Video not found.")
+    return location
+
+def get_rendition_file_name(location, resolution, filename):
+    """
+        Name of a file of a rendition in the rendition storage
+    """
+    return os.path.join(get_rendition_dir(location['base'], resolution), filename)
+
+def segment_cache_key(location, resolution, segment):
+    """
+        Segment cache key, locations cached before generations existed start at 0
+    """
+    return (location['base'], location.get('generation', 0), resolution, segment)
 
 # Create your views here.
 class VideoListView(ListAPIView):
@@ -21,43 +71,222 @@ class VideoListView(ListAPIView):
     serializer_class = VideoSerializer
     permission_classes = [IsAuthenticated]
 
+    def get_queryset(self):
+        """
+            ?playable=true only lists videos which finished transcoding
+        """
+        queryset = super().get_queryset()
+        if self.request.query_params.get('playable') in ('1', 'true', 'True'):
+            queryset = queryset.playable()
+        return queryset
+
+class HLSMasterPlayListView(APIView):
+    """
+        To get adaptive bitrate playlist over all resolutions, revalidated until the whole ladder is transcoded
+    """
+    permission_classes = [IsAuthenticated]
+    def get(self, request, pk):
+        location = get_location(pk)
+        name = get_master_playlist_path(location['base'])
+        cache_control = settings.HLS_PLAYLIST_CACHE_CONTROL if location['complete'] else settings.HLS_INCOMPLETE_CACHE_CONTROL
+
+        try:
+            return storage_response(request, get_rendition_storage(), name, 'application/vnd.apple.mpegurl', cache_control)
+        except FileNotFoundError:
+            raise NotFound("HSL Playlist not found.")
+
+
 class HLSPlayListView(APIView):
     """
-        To get HSL playlist
+        To get HSL playlist, its segment URIs carry a short-lived token for this rendition
     """
     permission_classes = [IsAuthenticated]
     def get(self, request, pk, resolution):
-        try:
-            video = Video.objects.get(id=pk)
-        except Video.DoesNotExist:
-            raise NotFound("Video not found.")
-        
-        base_path = get_video_base_path(video)
-        file_path = f'{base_path}_{resolution}/index.m3u8'
+        location = get_location(pk)
+        if not has_rendition(pk, location, resolution):
+            raise NotFound("Resolution not found.")
 
-        if not os.path.exists(file_path):
-            raise NotFound("HSL Playlist not found.")
+        name = get_rendition_file_name(location, resolution, 'index.m3u8')
+        token = sign_segment_token(pk, resolution)
+        expires = token.partition('.')[0]
 
-        return FileResponse(open(file_path, 'rb'), content_type='application/vnd.apple.mpegurl')
+        try:
+            return rendered_response(
+                request, get_rendition_storage(), name, 'application/vnd.apple.mpegurl',
+                settings.HLS_PLAYLIST_CACHE_CONTROL, lambda text: sign_media_playlist(text, token), version=f'-{int(expires):x}'
+            )
+        except FileNotFoundError:
+            raise NotFound("HSL Playlist not found.")
         
 
 
 class HSLSegmentView(APIView):
     """
-        To get single segment
+        To get single segment, byte ranges of fmp4 renditions are served from the rendition file.
+        Segments never change and are cached as immutable. With HLS_OFFLOAD the reverse proxy sends the file,
+        otherwise hot segments come from the segment cache.
+        Access is checked by the token of the playlist alone, there is no session or user lookup
     """
-    permission_classes = [IsAuthenticated]
+    authentication_classes = []
+    permission_classes = [HasSegmentToken]
     def get(self, request, pk, resolution, segment):
-        try:
-            video = Video.objects.get(id=pk)
-        except Video.DoesNotExist:
-            raise NotFound("Video not found.")
-        
-        base_path = get_video_base_path(video)
-        file_path = f'{base_path}_{resolution}/{segment}'
+        if not SEGMENT_NAME_RE.fullmatch(segment):
+            raise NotFound("Segment not found.")
+        location = get_location(pk)
+        name = get_rendition_file_name(location, resolution, segment)
+        content_type = SEGMENT_CONTENT_TYPES.get(os.path.splitext(segment)[1], 'application/octet-stream')
 
-        if not os.path.exists(file_path):
+        try:
+            return segment_response(
+                request, get_rendition_storage(), name, content_type, settings.HLS_SEGMENT_CACHE_CONTROL,
+                segment_cache_key(location, resolution, segment)
+            )
+        except FileNotFoundError:
             raise NotFound("Segment not found.")
 
-        return FileResponse(open(file_path, 'rb'), content_type='video/MP2T')
-        
\ No newline at end of file
+
+class SegmentCacheStatsView(APIView):
+    """
+        Hit ratio and usage of the segment cache of the process which answers
+    """
+    permission_classes = [IsAdminUser]
+    def get(self, request):
+        segment_cache = get_segment_cache()
+        if segment_cache is None:
+            return Response({'enabled': False})
+        return Response({'enabled': True, **segment_cache.stats()})
+
+
+class TrickplayView(APIView):
+    """
+        To get the WebVTT thumbnail track or one of its sprite sheets
+    """
+    permission_classes = [IsAuthenticated]
+    def get(self, request, pk, filename):
+        location = get_location(pk)
+        content_type = TRICKPLAY_CONTENT_TYPES.get(os.path.splitext(filename)[1])
+        if content_type is None:
+            raise NotFound("Trickplay file not found.")
+
+        name = os.path.join(get_trickplay_dir(location['base']), filename)
+        try:
+            return storage_response(request, get_rendition_storage(), name, content_type, settings.HLS_PLAYLIST_CACHE_CONTROL)
+        except FileNotFoundError:
+            raise NotFound("Trickplay file not found.")
+
+
+class VideoUploadCreateView(APIView):
+    """
+        To start a resumable upload (tus creation), the upload is resumed on the returned location
+    """
+    permission_classes = [IsAdminUser]
+    # The upload is owned by request.user, which has to be a model instance
+    full_user = True
+    def post(self, request):
+        try:
+            length = int(request.headers['Upload-Length'])
+            metadata = parse_metadata(request.headers.get('Upload-Metadata'))
+        except (KeyError, ValueError):
+            raise ValidationError("Valid Upload-Length and Upload-Metadata headers are required.")
+
+        if not metadata.get('filename') or length <= 0:
+            raise ValidationError("A filename and a positive Upload-Length are required.")
+        if length > settings.VIDEO_UPLOAD_MAX_SIZE:
+            return Response(status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, headers={'Tus-Max-Size': str(settings.VIDEO_UPLOAD_MAX_SIZE)})
+        try:
+            validate_video_file_extension(ContentFile(b'', name=metadata['filename']))
+        except DjangoValidationError as e:
+            raise ValidationError(e.messages)
+
+        upload = VideoUpload.objects.create(
+            user=request.user,
+            file_name=upload_video_path(None, metadata['filename']),
+            length=length,
+            metadata=metadata
+        )
+        os.makedirs(os.path.dirname(upload.get_path()), exist_ok=True)
+        open(upload.get_path(), 'wb').close()
+
+        location = request.build_absolute_uri(reverse('video-upload', kwargs={'pk': upload.pk}))
+        return Response(status=status.HTTP_201_CREATED, headers={'Location': location, 'Tus-Resumable': TUS_VERSION})
+
+
+class VideoUploadView(APIView):
+    """
+        To resume an upload, HEAD returns the offset and PATCH appends the next chunk at it.
+        The body is streamed to the file and never parsed, the video is created once all bytes arrived
+    """
+    permission_classes = [IsAdminUser]
+    full_user = True
+
+    def get_upload(self, request, pk, lock=False):
+        queryset = VideoUpload.objects.select_for_update() if lock else VideoUpload.objects
+        try:
+            return queryset.get(pk=pk, user=request.user)
+        except VideoUpload.DoesNotExist:
+            raise NotFound("Upload not found.")
+
+    def upload_headers(self, upload):
+        return {
+            'Upload-Offset': str(upload.offset),
+            'Upload-Length': str(upload.length),
+            'Cache-Control': 'no-store',
+            'Tus-Resumable': TUS_VERSION,
+        }
+
+    def head(self, request, pk):
+        upload = self.get_upload(request, pk)
+        return Response(headers=self.upload_headers(upload))
+
+    def patch(self, request, pk):
+        if request.content_type != 'application/offset+octet-stream':
+            return Response(status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+        except (KeyError, ValueError):
+            raise ValidationError("Valid Upload-Offset and Upload-Checksum headers are required.")
+
+        if 'CONTENT_LENGTH' not in request.META:
+            return Response(status=status.HTTP_411_LENGTH_REQUIRED, headers={'Tus-Resumable': TUS_VERSION})
+        try:
+            content_length = int(request.META['CONTENT_LENGTH'] or 0)
+        except ValueError:
+            raise ValidationError("A valid Content-Length header is required.")
+
+        # No transaction is held while the body arrives, the file lock keeps other requests for the
+        # upload out and the offset only moves if it is still the one the chunk was written at
+        upload = self.get_upload(request, pk)
+        try:
+            with open_upload_file(upload.get_path()) as f:
+                upload.refresh_from_db(fields=['offset'])
+                if offset != upload.offset:
+                    return Response(status=status.HTTP_409_CONFLICT, headers=self.upload_headers(upload))
+
+                length = min(content_length, upload.length - offset)
+                written = write_chunk(f, offset, request.stream, length, checksum) if length else 0
+                if not VideoUpload.objects.filter(pk=upload.pk, offset=offset).update(offset=offset + written):
+                    upload.refresh_from_db(fields=['offset'])
+                    return Response(status=status.HTTP_409_CONFLICT, headers=self.upload_headers(upload))
+        except UploadLocked:
+            return Response(status=status.HTTP_423_LOCKED, headers=self.upload_headers(upload))
+        except ChecksumMismatch:
+            response = Response(status=460, headers=self.upload_headers(upload))
+            response.reason_phrase = 'Checksum Mismatch'
+            return response
+
+        upload.offset = offset + written
+        if upload.is_complete:
+            with transaction.atomic():
+                upload = self.get_upload(request, pk, lock=True)
+                if upload.video is None:
+                    create_video_from_upload(upload)
+
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=self.upload_headers(upload))
+
+    def delete(self, request, pk):
+        upload = self.get_upload(request, pk)
+        if upload.video is None and os.path.exists(upload.get_path()):
+            os.remove(upload.get_path())
+        upload.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT, headers={'Tus-Resumable': TUS_VERSION})
@@ -1,13 +1,127 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils.functional import cached_property
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from content_app.models import TokenVersion
+
+# Claim with the token version of the user when the token was issued
+TOKEN_VERSION_CLAIM = 'ver'
+# Seconds a token version stays in the cache, the database row is the source of truth
+TOKEN_VERSION_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def token_version_key(user_id):
+    return f'token-version:{user_id}'
+
+
+def load_token_version(user_id):
+    version = TokenVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first() or 0
+    cache.set(token_version_key(user_id), version, TOKEN_VERSION_CACHE_TIMEOUT)
+    return version
+
+
+def get_token_version(user_id):
+    """
+        Current token version of a user, tokens issued with a lower one are revoked.
+        Read through the cache from the database
+    """
+    version = cache.get(token_version_key(user_id))
+    return load_token_version(user_id) if version is None else version
+
+
+async def aget_token_version(user_id):
+    """
+        get_token_version for async views
+    """
+    version = await cache.aget(token_version_key(user_id))
+    return await sync_to_async(load_token_version)(user_id) if version is None else version
+
+
+def forget_token_version(user_id):
+    cache.delete(token_version_key(user_id))
+
+
+def revoke_user_tokens(user_id):
+    """
+        Revoke every token issued to a user so far. The cached version is dropped now and again
+        once the transaction commits, a read in between would cache the old version
+    """
+    TokenVersion.objects.get_or_create(user_id=user_id)
+    TokenVersion.objects.filter(user_id=user_id).update(version=F('version') + 1)
+    forget_token_version(user_id)
+    transaction.on_commit(lambda: forget_token_version(user_id))
+
+
+def add_user_claims(token, user):
+    """
+        Claims a ClaimsUser is built from
+    """
+    token['email'] = user.email
+    token['is_staff'] = user.is_staff
+    token[TOKEN_VERSION_CLAIM] = get_token_version(user.pk)
+    return token
+
+
+def check_token_version(validated_token, version):
+    """
+        Reject a token issued before the current token version of its user
+    """
+    if validated_token.get(TOKEN_VERSION_CLAIM, 0) < version:
+        raise AuthenticationFailed('Token has been revoked.', code='token_revoked')
+
+
+class ClaimsUser(TokenUser):
+    """
+        User built from the claims of the access token without a database query
+    """
+    @cached_property
+    def id(self):
+        return int(self.token[api_settings.USER_ID_CLAIM])
+
+    @property
+    def email(self):
+        return self.token.get('email', '')
+
 
 class CookieJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
         """
-            Cusom authentication if access_token is valid
+            Cusom authentication if access_token is valid.
+            With JWT_CLAIMS_USER the user is built from the token claims and revoked tokens are
+            rejected by their version, views with full_user = True still get the user from the database
         """
         access_token = request.COOKIES.get('access_token')
 
         if access_token is None:
-            return None 
+            return None
         validated_token = self.get_validated_token(access_token)
-        return self.get_user(validated_token), validated_token
\ No newline at end of file
+
+        view = (getattr(request, 'parser_context', None) or {}).get('view')
+        # Tokens issued before the claims were added are resolved from the database
+        if settings.JWT_CLAIMS_USER and TOKEN_VERSION_CLAIM in validated_token and not getattr(view, 'full_user', False):
+            check_token_version(validated_token, get_token_version(validated_token[api_settings.USER_ID_CLAIM]))
+            return ClaimsUser(validated_token), validated_token
+        return self.get_user(validated_token), validated_token
+
+    async def aauthenticate(self, request):
+        """
+            authenticate for async views, the token version comes from the cache without blocking
+            and only tokens without claims or an uncached version need the database
+        """
+        access_token = request.COOKIES.get('access_token')
+
+        if access_token is None:
+            return None
+        validated_token = self.get_validated_token(access_token)
+
+        if settings.JWT_CLAIMS_USER and TOKEN_VERSION_CLAIM in validated_token:
+            check_token_version(validated_token, await aget_token_version(validated_token[api_settings.USER_ID_CLAIM]))
+            return ClaimsUser(validated_token), validated_token
+        return await sync_to_async(self.get_user)(validated_token), validated_token
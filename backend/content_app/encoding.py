@@ -0,0 +1,160 @@
+import json
+import subprocess
+
+from django.conf import settings
+
+from content_app.governor import ffmpeg_slot
+
+# RFC 6381 profile and constraint bytes of the h264 profiles ffprobe reports
+AVC_PROFILES = {
+    'Constrained Baseline': '42e0',
+    'Baseline': '4200',
+    'Main': '4d40',
+    'High': '6400',
+}
+
+# Label of the audio rendition shared by all video renditions
+AUDIO_LABEL = 'audio'
+
+
+def probe_video(source):
+    """
+        Read resolution, frame rate, duration and bitrate of the source with ffprobe
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        source
+    ]
+    data = json.loads(subprocess.run(cmd, check=True, capture_output=True, text=True).stdout)
+
+    streams = data.get('streams', [])
+    video = next((stream for stream in streams if stream['codec_type'] == 'video'), None)
+    if video is None:
+        raise ValueError(f'{source} has no video stream')
+    num, den = video.get('avg_frame_rate', '0/1').split('/')
+    fmt = data.get('format', {})
+
+    return {
+        'width': int(video['width']),
+        'height': int(video['height']),
+        'fps': int(num) / int(den) if int(den) else 0,
+        'duration': float(fmt.get('duration') or video.get('duration') or 0),
+        'bitrate': int(fmt.get('bit_rate') or 0) // 1000,
+        'has_audio': any(stream['codec_type'] == 'audio' for stream in streams),
+    }
+
+
+def probe_codecs(segment):
+    """
+        CODECS attribute of an encoded segment, e.g. avc1.64001f,mp4a.40.2
+    """
+    cmd = [
+        'ffprobe',
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_streams',
+        segment
+    ]
+    streams = json.loads(subprocess.run(cmd, check=True, capture_output=True, text=True).stdout).get('streams', [])
+
+    codecs = []
+    for stream in streams:
+        if stream.get('codec_name') == 'h264':
+            profile = AVC_PROFILES.get(stream.get('profile'), AVC_PROFILES['High'])
+            codecs.append(f"avc1.{profile}{int(stream.get('level', 31)):02x}")
+        elif stream.get('codec_name') == 'aac':
+            codecs.append('mp4a.40.5' if stream.get('profile') == 'HE-AAC' else 'mp4a.40.2')
+    return ','.join(codecs)
+
+
+def build_ladder(probe, ladder=None):
+    """
+        Rungs of the configured ladder which fit the source, never upscales and never
+        caps the bitrate above the source bitrate. Sources with sound get one audio rung
+        after the video rungs, the video rungs are encoded without audio.
+        A configured startup rung joins the ladder when it is below all of its rungs
+    """
+    ladder = sorted(ladder or settings.HLS_LADDER, key=lambda rung: rung['height'])
+    startup = settings.HLS_STARTUP_RUNG
+    if startup and startup['height'] < ladder[0]['height']:
+        ladder = [startup, *ladder]
+    rungs = [dict(rung) for rung in ladder if rung['height'] <= probe['height']]
+
+    if not rungs:
+        # Source is smaller than the lowest rung, encode it once at its own height
+        rungs = [dict(ladder[0], height=probe['height'] - probe['height'] % 2)]
+
+    for rung in rungs:
+        rung['label'] = f"{rung['height']}p"
+        rung['width'] = round(rung['height'] * probe['width'] / probe['height'] / 2) * 2
+        if probe['bitrate']:
+            rung['video_bitrate'] = min(rung['video_bitrate'], probe['bitrate'])
+        max_fps = rung.pop('max_fps', None)
+        rung['fps'] = max_fps if max_fps and probe['fps'] > max_fps else None
+
+    if probe.get('has_audio'):
+        rungs.append({'label': AUDIO_LABEL, 'type': 'audio', 'audio_bitrate': settings.HLS_AUDIO_BITRATE})
+    return rungs
+
+
+def is_audio_rung(rung):
+    """
+        The rung is the shared audio rendition
+    """
+    return rung.get('type') == 'audio'
+
+
+def video_rungs(ladder):
+    """
+        Video rungs of a ladder, lowest first
+    """
+    return [rung for rung in ladder if not is_audio_rung(rung)]
+
+
+def encode_args(rung, threads=0):
+    """
+        Video codec options of one rung, crf encoding with the rung bitrate as cap.
+        The preset is chosen per video, 0 threads leaves the thread count to x264
+    """
+    args = [
+        '-c:v', 'libx264',
+        '-crf', '23',
+        '-preset', rung.get('preset', 'medium'),
+        '-maxrate', f"{rung['video_bitrate']}k",
+        '-bufsize', f"{rung['video_bitrate'] * 2}k",
+    ]
+    if threads:
+        args += ['-threads', str(threads)]
+    if rung.get('fps'):
+        args += ['-r', str(rung['fps'])]
+    return args
+
+
+def audio_encode_args(rung):
+    """
+        Codec options of the audio rung
+    """
+    return ['-c:a', 'aac', '-b:a', f"{rung['audio_bitrate']}k", '-ac', '2']
+
+
+def run_ffmpeg(cmd, reporter=None):
+    """
+        Run an ffmpeg command once a host wide ffmpeg slot is free,
+        with a reporter its -progress output is fed line by line
+    """
+    with ffmpeg_slot():
+        if reporter is None:
+            subprocess.run(cmd, check=True)
+            return
+
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as process:
+            for line in process.stdout:
+                reporter.feed(line)
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
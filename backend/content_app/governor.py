@@ -0,0 +1,86 @@
+import fcntl
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+import django_rq
+from django.conf import settings
+
+# Seconds between two attempts to get an ffmpeg slot
+SLOT_POLL_INTERVAL = 2
+# Cores per ffmpeg process when the slot count is derived from the host
+CORES_PER_SLOT = 4
+
+
+def host_cpu_count():
+    """
+        Cores this process may run on, respects cpu affinity and container cpusets
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def slot_count():
+    """
+        How many ffmpeg processes may run on this host at once
+    """
+    return settings.TRANSCODE_FFMPEG_SLOTS or max(1, host_cpu_count() // CORES_PER_SLOT)
+
+
+def threads_per_process():
+    """
+        Equal share of the cores for every ffmpeg slot, so running slots never oversubscribe the host
+    """
+    return max(1, host_cpu_count() // slot_count())
+
+
+@contextmanager
+def ffmpeg_slot():
+    """
+        Hold one of the host wide ffmpeg slots while the block runs. Slots are flock'ed files,
+        so workers of every process on the host share them and a crashed worker frees its slot
+    """
+    os.makedirs(settings.TRANSCODE_LOCK_DIR, exist_ok=True)
+    while True:
+        for slot in range(slot_count()):
+            lock_file = open(os.path.join(settings.TRANSCODE_LOCK_DIR, f'slot_{slot}.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+
+            try:
+                yield slot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def transcode_backlog():
+    """
+        Jobs waiting on the transcode queues
+    """
+    return sum(django_rq.get_queue(name).count for name in ('transcode_high', 'transcode'))
+
+
+def choose_preset():
+    """
+        x264 preset for a new video, faster presets while the transcode queues are backed up
+    """
+    backlog = transcode_backlog()
+    return next(preset for threshold, preset in reversed(settings.HLS_BACKLOG_PRESETS) if backlog >= threshold)
+
+
+def job_cpu_seconds():
+    """
+        User and system cpu time of the current rq work horse and the ffmpeg processes it waited for.
+        The work horse is forked per job, so this is the cpu time of the job
+    """
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
@@ -0,0 +1,163 @@
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from content_app.models import Video
+from content_app.rendition_storage import storage_name
+from content_app.segment_cache import get_segment_generation
+
+
+class LocalLRU:
+    """
+        Small in-process LRU whose entries expire after a ttl, in front of the shared cache.
+        Other processes can't invalidate it, the ttl bounds how long they keep a stale entry
+    """
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + settings.VIDEO_LOCATION_LOCAL_TTL)
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.VIDEO_LOCATION_LOCAL_SIZE:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+local_locations = LocalLRU()
+
+
+def location_key(video_id):
+    return f'video-location:{video_id}'
+
+
+def load_video_location(video_id):
+    """
+        Storage name of the rendition base path, the labels of the published and of the planned renditions,
+        whether the whole ladder is transcoded and the generation of its cached segments. None if the video does not exist
+    """
+    video = Video.objects.only('video_file', 'content_hash', 'renditions', 'progress').filter(pk=video_id).first()
+    if video is None:
+        return None
+    base = storage_name(video.get_base_path())
+    return {
+        'base': base,
+        'renditions': [rendition['label'] for rendition in video.renditions],
+        'planned': list(video.progress),
+        'complete': video.is_complete,
+        'generation': get_segment_generation(base),
+    }
+
+
+def get_video_location(video_id, refresh=False):
+    """
+        Location of the renditions of a video from the in-process LRU, then from the shared cache,
+        then from the database. Missing videos are not cached
+    """
+    key = location_key(video_id)
+    location = None if refresh else local_locations.get(key)
+    if location is not None:
+        return location
+
+    location = None if refresh else cache.get(key)
+    if location is None:
+        location = load_video_location(video_id)
+        if location is None:
+            return None
+        cache.set(key, location, settings.VIDEO_LOCATION_CACHE_TIMEOUT)
+    local_locations.set(key, location)
+    return location
+
+
+def may_be_published(location, label):
+    """
+        Whether a rendition missing from a cached location could have been published since, only labels
+        of the planned ladder can. Locations cached before the ladder was part of them may have any label
+    """
+    return label in location.get('planned', [label])
+
+
+def has_rendition(video_id, location, label):
+    """
+        Whether a rendition is published. A planned label the cached location doesn't know is looked up
+        once more in the database, another process may have published it since
+    """
+    if label in location['renditions']:
+        return True
+    if not may_be_published(location, label):
+        return False
+    location = get_video_location(video_id, refresh=True)
+    return location is not None and label in location['renditions']
+
+
+async def aget_video_location(video_id, refresh=False):
+    """
+        get_video_location for async views
+    """
+    key = location_key(video_id)
+    location = None if refresh else local_locations.get(key)
+    if location is not None:
+        return location
+
+    location = None if refresh else await cache.aget(key)
+    if location is None:
+        location = await sync_to_async(load_video_location)(video_id)
+        if location is None:
+            return None
+        await cache.aset(key, location, settings.VIDEO_LOCATION_CACHE_TIMEOUT)
+    local_locations.set(key, location)
+    return location
+
+
+async def ahas_rendition(video_id, location, label):
+    """
+        has_rendition for async views
+    """
+    if label in location['renditions']:
+        return True
+    if not may_be_published(location, label):
+        return False
+    location = await aget_video_location(video_id, refresh=True)
+    return location is not None and label in location['renditions']
+
+
+def forget_video_locations(video_ids):
+    keys = [location_key(video_id) for video_id in video_ids]
+    for key in keys:
+        local_locations.delete(key)
+    cache.delete_many(keys)
+
+
+def invalidate_video_locations(video_ids):
+    """
+        Drop cached locations now and again once the transaction which changes the videos commits,
+        a read in between would cache the old row again
+    """
+    video_ids = list(video_ids)
+    forget_video_locations(video_ids)
+    transaction.on_commit(lambda: forget_video_locations(video_ids))
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from content_app.management.commands.benchmark_transcode import git_commit
+from content_app.models import Video
+from content_app.segment_tokens import sign_segment_token
+from content_app.tasks import get_rendition_dir
+
+# Content hash of the benchmark video, its segment is written below MEDIA_ROOT and removed afterwards
+BENCHMARK_HASH = 'benchmark-concurrency'
+# Small client receive buffer so a slow viewer pushes back on the server instead of on the kernel
+CLIENT_RCVBUF = 64 * 1024
+READ_SIZE = 16 * 1024
+
+
+def server_command(deployment, port, workers, threads):
+    """
+        The WSGI deployment of the entrypoint with gthread workers, or the ASGI one on uvicorn
+    """
+    if deployment == 'wsgi':
+        return [
+            sys.executable, '-m', 'gunicorn', 'core.wsgi:application', '--bind', f'127.0.0.1:{port}',
+            '--workers', str(workers), '--worker-class', 'gthread', '--threads', str(threads), '--timeout', '120'
+        ]
+    return [
+        sys.executable, '-m', 'uvicorn', 'core.asgi:application', '--host', '127.0.0.1', '--port', str(port),
+        '--workers', str(workers), '--log-level', 'warning'
+    ]
+
+
+def process_tree(pid):
+    """
+        Pid of a process and of all its descendants, read from /proc
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        pending += children.get(current, [])
+    return pids
+
+
+def tree_usage(pid):
+    """
+        Resident memory in bytes and threads of a process tree
+    """
+    rss = threads = 0
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+        except OSError:
+            continue
+    return rss, threads
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f'Server exited with {process.returncode}')
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise CommandError('Server did not start')
+
+
+async def slow_viewer(port, path, read_rate):
+    """
+        Fetch a segment and read it at read_rate bytes per second like a viewer on a slow link.
+        Returns the seconds to the first byte and to the last one, None on errors
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CLIENT_RCVBUF)
+    sock.setblocking(False)
+    start = time.monotonic()
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, ('127.0.0.1', port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n'.encode())
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        first_byte = time.monotonic() - start
+        if not head.startswith(b'HTTP/1.1 200'):
+            writer.close()
+            return None
+        received = 0
+        while data := await reader.read(READ_SIZE):
+            received += len(data)
+            await asyncio.sleep(len(data) / read_rate)
+        writer.close()
+        return first_byte, time.monotonic() - start, received
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        sock.close()
+        return None
+
+
+async def sample_usage(pid, peak, stop):
+    while not stop.is_set():
+        rss, threads = await asyncio.to_thread(tree_usage, pid)
+        peak['rss'], peak['threads'] = max(peak['rss'], rss), max(peak['threads'], threads)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_level(port, pid, path, clients, read_rate, size):
+    """
+        All viewers of one concurrency level at once, with the peak memory and threads of the server
+    """
+    peak, stop = {'rss': 0, 'threads': 0}, asyncio.Event()
+    sampler = asyncio.create_task(sample_usage(pid, peak, stop))
+    wall_start = time.perf_counter()
+    results = await asyncio.gather(*(slow_viewer(port, path, read_rate) for _ in range(clients)))
+    wall = time.perf_counter() - wall_start
+    stop.set()
+    await sampler
+
+    done = [result for result in results if result and result[2] == size]
+    first_bytes = sorted(result[0] for result in done)
+    return {
+        'clients': clients,
+        'completed': len(done),
+        'errors': clients - len(done),
+        'wall_seconds': round(wall, 3),
+        'first_byte_p50': round(statistics.median(first_bytes), 3) if first_bytes else None,
+        'first_byte_max': round(first_bytes[-1], 3) if first_bytes else None,
+        'peak_rss_mb': round(peak['rss'] / 1024 / 1024, 1),
+        'peak_threads': peak['threads'],
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark concurrent slow viewers against the WSGI deployment (gunicorn gthread, sync views) '
+        'and the ASGI deployment (uvicorn, async views). Every viewer fetches one segment at a limited '
+        'read rate. Reports completed requests, time to first byte and the peak memory and threads of the '
+        'server as JSON. The servers use the configured database, the benchmark video is removed afterwards'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--deployments', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+        parser.add_argument('--clients', nargs='+', type=int, default=[50, 200, 1000], help='Concurrent viewers per level')
+        parser.add_argument('--segment-size', type=int, default=2048, help='KiB of the served segment')
+        parser.add_argument('--read-rate', type=int, default=512, help='KiB per second every viewer reads')
+        parser.add_argument('--workers', type=int, default=2, help='Server processes of both deployments')
+        parser.add_argument('--threads', type=int, default=8, help='Threads per gunicorn worker of the WSGI deployment')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        size = options['segment_size'] * 1024
+        video, segment_path = self.setup_video(size)
+        try:
+            url = reverse('HSL-segment', kwargs={'pk': video.pk, 'resolution': '720p', 'segment': 'segment_000.ts'})
+            path = f'{url}?token={sign_segment_token(video.pk, "720p")}'
+            results = [
+                dict(self.run_deployment(deployment, path, size, options), deployment=deployment)
+                for deployment in options['deployments']
+            ]
+        finally:
+            video.delete()
+            os.remove(segment_path)
+            os.rmdir(os.path.dirname(segment_path))
+
+        report = json.dumps({
+            'commit': git_commit(),
+            'cpu_count': os.cpu_count(),
+            'segment_bytes': size,
+            'read_rate_bytes': options['read_rate'] * 1024,
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def setup_video(self, size):
+        """
+            Committed video with one segment, the servers run in other processes
+        """
+        rendition_dir = get_rendition_dir(os.path.join(settings.MEDIA_ROOT, 'videos', BENCHMARK_HASH), '720p')
+        os.makedirs(rendition_dir, exist_ok=True)
+        segment_path = os.path.join(rendition_dir, 'segment_000.ts')
+        with open(segment_path, 'wb') as f:
+            f.write(os.urandom(size))
+
+        # bulk_create sends no post_save, so no transcode is enqueued for it
+        video, = Video.objects.bulk_create([Video(
+            title='Concurrency benchmark', content_hash=BENCHMARK_HASH,
+            renditions=[{'label': '720p'}], status=Video.Status.READY
+        )])
+        return video, segment_path
+
+    def run_deployment(self, deployment, path, size, options):
+        port = free_port()
+        env = dict(
+            os.environ, HLS_ASYNC_VIEWS=str(deployment == 'asgi'), HLS_OFFLOAD='',
+            ALLOWED_HOSTS='127.0.0.1', PYTHONPATH=os.pathsep.join(sys.path)
+        )
+        process = subprocess.Popen(
+            server_command(deployment, port, options['workers'], options['threads']),
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            return {'levels': asyncio.run(self.run_levels(port, process, path, size, options))}
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=30)
+
+    async def run_levels(self, port, process, path, size, options):
+        await wait_for_port(port, process)
+        # Untimed request so every worker has imported the views
+        await asyncio.gather(*(slow_viewer(port, path, 1024 * 1024 * 1024) for _ in range(options['workers'] * 2)))
+        return [
+            await run_level(port, process.pid, path, clients, options['read_rate'] * 1024, size)
+            for clients in options['clients']
+        ]
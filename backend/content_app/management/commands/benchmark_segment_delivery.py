@@ -0,0 +1,105 @@
+import json
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from content_app.management.commands.benchmark_transcode import git_commit
+from content_app.models import Video
+from content_app.segment_tokens import sign_segment_token
+
+GB = 1024 ** 3
+# Content hash of the benchmark video, its renditions live in a temp MEDIA_ROOT
+BENCHMARK_HASH = 'benchmark'
+# Mode which streams through the worker with the segment cache, every other mode runs without it
+SEGMENT_CACHE_MODE = 'segment-cache'
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the cpu time a worker spends per GB of segments served, streamed through the worker '
+        'from the file or from the segment cache, and offloaded to the reverse proxy. '
+        'Requests run through the whole django stack in this process, '
+        'the test client reads file responses in python like a worker without wsgi.file_wrapper. '
+        'Reports JSON, the database changes are rolled back'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--modes', nargs='+', default=['', SEGMENT_CACHE_MODE, 'x-accel-redirect', 'x-sendfile'],
+            help=f"HLS_OFFLOAD values, '' streams the file through the worker and {SEGMENT_CACHE_MODE} from the segment cache"
+        )
+        parser.add_argument('--segment-size', type=int, default=4, help='MiB of the served segment')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--range', type=int, help='Request byte ranges of this many KiB instead of the whole segment')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        # The test client sends its requests to the host testserver
+        allowed_hosts = [*settings.ALLOWED_HOSTS, 'testserver']
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media, ALLOWED_HOSTS=allowed_hosts), transaction.atomic():
+            client, url, size = self.setup_video(media, options['segment_size'] * 1024 * 1024)
+            length = min(options['range'] * 1024, size) if options['range'] else size
+            headers = {'HTTP_RANGE': f'bytes=0-{length - 1}'} if options['range'] else {}
+            results = [self.run_mode(client, url, length, mode, options['requests'], headers) for mode in options['modes']]
+            transaction.set_rollback(True)
+
+        report = json.dumps({'commit': git_commit(), 'cpu_count': os.cpu_count(), 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def setup_video(self, media, size):
+        """
+            Video with one rendition of one segment and the signed url of the segment
+        """
+        rendition_dir = os.path.join(media, 'videos', f'{BENCHMARK_HASH}_720p')
+        os.makedirs(rendition_dir)
+        with open(os.path.join(rendition_dir, 'segment_000.ts'), 'wb') as f:
+            f.write(os.urandom(size))
+
+        video = Video.objects.create(
+            title='Segment delivery benchmark', video_file='videos/benchmark.mp4', content_hash=BENCHMARK_HASH,
+            renditions=[{'label': '720p'}], status=Video.Status.READY
+        )
+        url = reverse('HSL-segment', kwargs={'pk': video.pk, 'resolution': '720p', 'segment': 'segment_000.ts'})
+        return APIClient(), f'{url}?token={sign_segment_token(video.pk, "720p")}', size
+
+    def run_mode(self, client, url, length, mode, requests, headers):
+        """
+            Cpu and wall time of all requests in one offload mode, bytes served counts what the
+            worker or, when offloaded, the proxy sends to the clients
+        """
+        served = 0
+        cache_budget = max(settings.HLS_SEGMENT_CACHE_BUDGET, settings.HLS_SEGMENT_CACHE_MAX_SIZE) if mode == SEGMENT_CACHE_MODE else 0
+        offload = '' if mode == SEGMENT_CACHE_MODE else mode
+        with override_settings(HLS_OFFLOAD=offload, HLS_SEGMENT_CACHE_BUDGET=cache_budget, HLS_SEGMENT_CACHE_DIR=''):
+            # Untimed request so imports and connection setup don't count for the first mode
+            b''.join(client.get(url, **headers))
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            for _ in range(requests):
+                response = client.get(url, **headers)
+                if response.status_code >= 300:
+                    raise CommandError(f'Segment request failed with {response.status_code}')
+                if offload:
+                    served += length
+                else:
+                    served += sum(len(chunk) for chunk in response.streaming_content)
+            cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+
+        return {
+            'mode': mode or 'worker',
+            'requests': requests,
+            'bytes_served': served,
+            'cpu_seconds': round(cpu, 3),
+            'wall_seconds': round(wall, 3),
+            'cpu_seconds_per_gb': round(cpu / (served / GB), 3) if served else None,
+        }
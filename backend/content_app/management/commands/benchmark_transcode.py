@@ -0,0 +1,171 @@
+import json
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from content_app.encoding import build_ladder, probe_video
+from content_app.playlists import parse_media_playlist
+from content_app.tasks import convert_resolutions_to_hls, get_rendition_dir, get_trickplay_dir
+
+# Frame rate of the synthetic clips
+CLIP_FPS = 25
+
+
+def children_cpu_seconds():
+    """
+        User and system cpu time of all finished child processes
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def git_commit():
+    """
+        Commit of the checked out code so reports can be compared from commit to commit
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def generate_clip(output_dir, duration, height):
+    """
+        Deterministic 16:9 test clip, moving test pattern and a sine tone, returns its name, path and probe
+    """
+    width = round(height * 16 / 9 / 2) * 2
+    name = f'testsrc_{height}p_{duration}s'
+    path = os.path.join(output_dir, f'{name}.mp4')
+    subprocess.run([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=duration={duration}:size={width}x{height}:rate={CLIP_FPS}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '18', '-g', str(CLIP_FPS * 2),
+        '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+    probe = {
+        'width': width,
+        'height': height,
+        'fps': CLIP_FPS,
+        'duration': duration,
+        'bitrate': os.path.getsize(path) * 8 // duration // 1000,
+        'has_audio': True,
+    }
+    return {'name': name, 'path': path, 'probe': probe}
+
+
+def output_stats(output_dir):
+    """
+        Bytes of all files of an output dir and the segment count if it holds a playlist
+    """
+    stats = {'bytes': sum(entry.stat().st_size for entry in os.scandir(output_dir))}
+    playlist_path = os.path.join(output_dir, 'index.m3u8')
+    if os.path.exists(playlist_path):
+        with open(playlist_path) as f:
+            stats['segments'] = len(parse_media_playlist(f.read()))
+    return stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the hls transcode pipeline on a source file or on synthetic clips, '
+        'reports wall and cpu time, realtime factor and the outputs per rendition as JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', nargs='?', help='Video file used as transcode source, synthetic clips are generated without one')
+        parser.add_argument('--modes', nargs='+', default=['serial', 'single_pass'])
+        parser.add_argument('--runs', type=int, default=1)
+        parser.add_argument('--durations', type=int, nargs='+', default=[10, 60], help='Seconds of the synthetic clips')
+        parser.add_argument('--heights', type=int, nargs='+', default=[720, 1080], help='Heights of the synthetic clips')
+        parser.add_argument('--presets', nargs='+', default=['medium'])
+        parser.add_argument('--segment-durations', type=int, nargs='+', default=[settings.HLS_SEGMENT_DURATION])
+        parser.add_argument('--ladder', type=int, nargs='+', help='Heights of the HLS_LADDER rungs to encode, all by default')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        source = options['source']
+        if source and not os.path.isfile(source):
+            raise CommandError(f'Source {source} does not exist.')
+
+        ladder = settings.HLS_LADDER
+        if options['ladder']:
+            ladder = [rung for rung in ladder if rung['height'] in options['ladder']]
+
+        with tempfile.TemporaryDirectory() as clips_dir:
+            if source:
+                sources = [{'name': os.path.basename(source), 'path': source, 'probe': probe_video(source)}]
+            else:
+                sources = [
+                    generate_clip(clips_dir, duration, height)
+                    for duration in options['durations'] for height in options['heights']
+                ]
+
+            results = []
+            for clip in sources:
+                for mode in options['modes']:
+                    for preset in options['presets']:
+                        for segment_duration in options['segment_durations']:
+                            runs = [
+                                self.run_once(clip, mode, preset, segment_duration, ladder)
+                                for _ in range(options['runs'])
+                            ]
+                            results.append(self.summarize(clip, mode, preset, segment_duration, runs))
+
+        report = json.dumps({'commit': git_commit(), 'cpu_count': os.cpu_count(), 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
+
+    def run_once(self, clip, mode, preset, segment_duration, ladder):
+        """
+            Transcode a copy of the source in a temp dir so the outputs never touch media
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            copy = os.path.join(tmp, os.path.basename(clip['path']))
+            shutil.copy(clip['path'], copy)
+            rungs = [dict(rung, preset=preset) for rung in build_ladder(clip['probe'], ladder=ladder)]
+
+            # Segment duration is read from settings deep in the pipeline
+            with override_settings(HLS_SEGMENT_DURATION=segment_duration):
+                cpu_start = children_cpu_seconds()
+                wall_start = time.perf_counter()
+                convert_resolutions_to_hls(copy, mode=mode, ladder=rungs, duration=clip['probe']['duration'])
+                wall, cpu = time.perf_counter() - wall_start, children_cpu_seconds() - cpu_start
+
+            base, _ = os.path.splitext(copy)
+            outputs = {rung['label']: output_stats(get_rendition_dir(base, rung['label'])) for rung in rungs}
+            if os.path.isdir(get_trickplay_dir(base)):
+                outputs['trickplay'] = output_stats(get_trickplay_dir(base))
+            return {'wall_seconds': wall, 'cpu_seconds': cpu, 'outputs': outputs}
+
+    def summarize(self, clip, mode, preset, segment_duration, runs):
+        """
+            Best of all runs, outputs are the same for every run
+        """
+        best = min(runs, key=lambda run: run['wall_seconds'])
+        duration = clip['probe']['duration']
+        return {
+            'source': clip['name'],
+            'source_duration': duration,
+            'source_resolution': f"{clip['probe']['width']}x{clip['probe']['height']}",
+            'mode': mode,
+            'preset': preset,
+            'segment_duration': segment_duration,
+            'runs': len(runs),
+            'wall_seconds': round(best['wall_seconds'], 3),
+            'cpu_seconds': round(min(run['cpu_seconds'] for run in runs), 3),
+            'realtime_factor': round(duration / best['wall_seconds'], 3) if best['wall_seconds'] else None,
+            'renditions': best['outputs'],
+        }
@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from content_app.storage import collect_garbage_batch, schedule_rendition_gc, storage_report
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete rendition files in MEDIA_ROOT/videos and the rendition storage which no video owns anymore '
+        'and print the storage used per video as JSON, or start the periodic garbage collection job with --schedule'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--schedule', action='store_true', help='Enqueue the periodic rq job instead of collecting now')
+
+    def handle(self, *args, **options):
+        if options['schedule']:
+            job = schedule_rendition_gc()
+            self.stdout.write(f'Scheduled {job.id}' if job else 'Storage garbage collection is already scheduled')
+            return
+
+        cursor, reclaimed = '', 0
+        while True:
+            names, batch_reclaimed = collect_garbage_batch(cursor)
+            reclaimed += batch_reclaimed
+            if not names:
+                break
+            cursor = names[-1]
+        self.stdout.write(json.dumps(dict(storage_report(), reclaimed_bytes=reclaimed), indent=2))
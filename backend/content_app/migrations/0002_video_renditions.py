@@ -0,0 +1,44 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:05
+
+import os
+
+from django.db import migrations, models
+
+
+LEGACY_LADDER = [
+    {'height': 480, 'video_bitrate': 1400, 'audio_bitrate': 128},
+    {'height': 720, 'video_bitrate': 2800, 'audio_bitrate': 128},
+    {'height': 1080, 'video_bitrate': 5000, 'audio_bitrate': 128},
+]
+
+
+def fill_renditions_from_disk(apps, schema_editor):
+    """
+        Videos transcoded with the fixed 480/720/1080 list get the renditions found on disk
+    """
+    Video = apps.get_model('content_app', 'Video')
+    for video in Video.objects.all():
+        if not video.video_file:
+            continue
+        base, _ = os.path.splitext(video.video_file.path)
+        video.renditions = [
+            dict(rung, label=f"{rung['height']}p", fps=None) for rung in LEGACY_LADDER
+            if os.path.exists(f"{base}_{rung['height']}p/index.m3u8")
+        ]
+        video.save(update_fields=['renditions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='renditions',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.RunPython(fill_renditions_from_disk, migrations.RunPython.noop),
+    ]
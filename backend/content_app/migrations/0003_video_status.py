@@ -0,0 +1,36 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:08
+
+from django.db import migrations, models
+
+
+def mark_transcoded_videos_ready(apps, schema_editor):
+    """
+        Videos which already have renditions were transcoded before status existed,
+        every rendition they have is complete
+    """
+    Video = apps.get_model('content_app', 'Video')
+    for video in Video.objects.exclude(renditions=[]):
+        video.status = 'READY'
+        video.progress = {rendition['label']: 100 for rendition in video.renditions}
+        video.save(update_fields=['status', 'progress'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0002_video_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='progress',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+        migrations.AddField(
+            model_name='video',
+            name='status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('TRANSCODING', 'Transcoding'), ('READY', 'Ready'), ('FAILED', 'Failed')], default='QUEUED', editable=False, max_length=20),
+        ),
+        migrations.RunPython(mark_transcoded_videos_ready, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0005_video_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='cpu_seconds',
+            field=models.FloatField(default=0, editable=False),
+        ),
+    ]
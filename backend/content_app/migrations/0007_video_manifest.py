@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 18:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0006_video_cpu_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='video',
+            name='manifest',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,98 @@
+import math
+import os
+
+from django.db import migrations
+
+
+
+# Frozen copies of the playlist helpers as they were when this migration was written,
+# so later changes to content_app.playlists cannot change what it writes
+
+
+def parse_media_playlist(text):
+    """
+        Return (duration, uri) of every segment in a media playlist
+    """
+    segments = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#'):
+            segments.append((duration, line))
+            duration = None
+    return segments
+
+
+def render_master_playlist(renditions):
+    """
+        Build the master playlist over the renditions, lowest bandwidth first.
+        Legacy renditions carry their own audio, there is no audio group
+    """
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    for rendition in sorted(renditions, key=lambda rendition: rendition['bandwidth']):
+        attributes = [
+            f"BANDWIDTH={rendition['bandwidth']}",
+            f"AVERAGE-BANDWIDTH={rendition['average_bandwidth']}",
+        ]
+        if rendition.get('width'):
+            attributes.append(f"RESOLUTION={rendition['width']}x{rendition['height']}")
+        if rendition.get('codecs'):
+            attributes.append(f'CODECS="{rendition["codecs"]}"')
+        lines += [f"#EXT-X-STREAM-INF:{','.join(attributes)}", f"{rendition['label']}/index.m3u8"]
+    return '\n'.join(lines) + '\n'
+
+
+def measure_legacy_rendition(output_dir, rendition):
+    """
+        Peak and average bandwidth of a rendition from its segment sizes
+    """
+    with open(os.path.join(output_dir, 'index.m3u8')) as f:
+        segments = parse_media_playlist(f.read())
+    sizes = [os.path.getsize(os.path.join(output_dir, uri)) for _, uri in segments]
+    total_duration = sum(duration for duration, _ in segments)
+    peak = max((size * 8 / duration for (duration, _), size in zip(segments, sizes) if duration), default=0)
+    return dict(
+        rendition,
+        bandwidth=math.ceil(peak),
+        average_bandwidth=math.ceil(sum(sizes) * 8 / total_duration) if total_duration else 0,
+    )
+
+
+def write_legacy_master_playlists(apps, schema_editor):
+    """
+        Videos transcoded before master playlists existed get one over their renditions.
+        Their renditions carry the audio themselves, so the master has no audio group
+    """
+    Video = apps.get_model('content_app', 'Video')
+    for video in Video.objects.exclude(renditions=[]).filter(content_hash=''):
+        if not video.video_file or any(rendition.get('type') == 'audio' for rendition in video.renditions):
+            continue
+        base, _ = os.path.splitext(video.video_file.path)
+        master_path = f'{base}_master.m3u8'
+        if os.path.exists(master_path):
+            continue
+        try:
+            renditions = [
+                measure_legacy_rendition(f"{base}_{rendition['label']}", rendition) for rendition in video.renditions
+            ]
+        except FileNotFoundError:
+            continue
+
+        with open(f'{master_path}.partial', 'w') as f:
+            f.write(render_master_playlist(renditions))
+        os.replace(f'{master_path}.partial', master_path)
+        video.renditions = renditions
+        video.save(update_fields=['renditions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0007_video_manifest'),
+    ]
+
+    operations = [
+        migrations.RunPython(write_legacy_master_playlists, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-18 19:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_app', '0009_token_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContentClaim',
+            fields=[
+                ('content_hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('video', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='content_claims', to='content_app.video')),
+            ],
+        ),
+    ]
@@ -1,6 +1,8 @@
 
 import os
+import hashlib
 
+from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
 from django.utils.text import slugify
@@ -15,6 +17,22 @@ def upload_video_path(instance, filename):
     name = slugify(name) 
     return f"videos/{uuid4().hex}_{name}{ext}"
 
+def hash_video_file(field_file):
+    """
+        sha256 of an uploaded file, read chunk by chunk so memory stays flat
+    """
+    sha256 = hashlib.sha256()
+    with field_file.open('rb') as f:
+        for chunk in f.chunks():
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def rendition_base_path(content_hash):
+    """
+        Renditions are stored under the hash of their source so identical uploads share them
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'videos', content_hash)
+
 def validate_video_file_extension(value):
     """
         Vlidate video extension
@@ -25,6 +43,21 @@ def validate_video_file_extension(value):
         raise ValidationError('Unsupported file extension. Allowed: ' + ', '.join(valid_extensions))
 
 
+class VideoQuerySet(models.QuerySet):
+    def playable(self):
+        """
+            Videos whose renditions are transcoded and can be streamed
+        """
+        return self.filter(status=Video.Status.READY)
+
+    def sharing_content(self, video_id):
+        """
+            The video and every video deduplicated onto the same source
+        """
+        content_hash = self.filter(pk=video_id).exclude(content_hash='').values('content_hash')
+        return self.filter(models.Q(pk=video_id) | models.Q(content_hash__in=content_hash))
+
+
 class Video(models.Model):
     """
         Video Model
@@ -38,12 +71,103 @@ class Video(models.Model):
         GAMING = 'GAMING', 'Gaming'
         DOCUMENTARY = 'DOCUMENTARY', 'Documentary'
 
+    # READY as soon as the first rendition is playable, progress tells when the whole ladder is done
+    class Status(models.TextChoices):
+        QUEUED = 'QUEUED', 'Queued'
+        TRANSCODING = 'TRANSCODING', 'Transcoding'
+        READY = 'READY', 'Ready'
+        FAILED = 'FAILED', 'Failed'
+
     title = models.CharField(max_length=255)
     description = models.TextField(blank=True)
     thumbnail_url = models.ImageField(upload_to='thumbnails/', null=True, blank=True)
     category = models.CharField(max_length=100, null=True, blank=True, choices=Category, default=Category.MOVIE)
     created_at = models.DateTimeField(auto_now_add=True)
     video_file = models.FileField(upload_to=upload_video_path, null=True, blank=True, validators=[validate_video_file_extension])
+    renditions = models.JSONField(default=list, blank=True, editable=False)
+    status = models.CharField(max_length=20, choices=Status, default=Status.QUEUED, editable=False)
+    progress = models.JSONField(default=dict, blank=True, editable=False)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    cpu_seconds = models.FloatField(default=0, editable=False)
+    # Every file the transcode produced, path relative to MEDIA_ROOT mapped to its size in bytes
+    manifest = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = VideoQuerySet.as_manager()
+
+    def __str__(self):
+        return self.title
+
+    def get_base_path(self):
+        """
+            Path prefix of the rendition dirs, videos uploaded before deduplication keep theirs next to the source
+        """
+        if self.content_hash:
+            return rendition_base_path(self.content_hash)
+        return os.path.splitext(self.video_file.path)[0]
+
+    def get_rendition(self, label):
+        """
+            Rung of the produced ladder with this label, e.g. 720p
+        """
+        return next((rung for rung in self.renditions if rung['label'] == label), None)
+
+    @property
+    def is_complete(self):
+        """
+            Every rung of the ladder is transcoded, the master playlist won't change anymore
+        """
+        return bool(self.progress) and all(value == 100 for value in self.progress.values())
+
+
+class VideoUpload(models.Model):
+    """
+        Resumable upload of a video file, chunks are appended to the file until offset reaches length
+    """
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='video_uploads')
+    file_name = models.CharField(max_length=255)
+    length = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    metadata = models.JSONField(default=dict, blank=True)
+    video = models.OneToOneField(Video, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.file_name
+
+    def get_path(self):
+        """
+            Final location of the uploaded file, chunks are written there directly
+        """
+        return os.path.join(settings.MEDIA_ROOT, self.file_name)
+
+    @property
+    def is_complete(self):
+        """
+            All bytes announced on creation arrived
+        """
+        return self.offset >= self.length
+
+
+class ContentClaim(models.Model):
+    """
+        Upload which encodes the renditions of a content hash. The row is unique per hash so concurrent
+        uploads of the same content agree on one of them, the others reuse its renditions
+    """
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    video = models.ForeignKey(Video, on_delete=models.SET_NULL, null=True, blank=True, related_name='content_claims')
+
+    def __str__(self):
+        return self.content_hash
+
+
+class TokenVersion(models.Model):
+    """
+        Token version of a user, tokens issued with a lower one are revoked. Kept in the database
+        so revocations survive cache evictions, the cache only serves reads
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True, related_name='token_version')
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return self.title
\ No newline at end of file
+        return f'{self.user_id}: {self.version}'
@@ -0,0 +1,108 @@
+import math
+import re
+
+from content_app.encoding import is_audio_rung, video_rungs
+
+# GROUP-ID of the shared audio rendition in the master playlist
+AUDIO_GROUP = 'audio'
+
+
+def parse_media_playlist(text):
+    """
+        Return (duration, uri) of every segment in a media playlist
+    """
+    segments = []
+    duration = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#'):
+            segments.append((duration, line))
+            duration = None
+    return segments
+
+
+def parse_byte_ranges(text):
+    """
+        Return (length, offset) of every segment in a byte range playlist,
+        None for segments which are a whole file
+    """
+    ranges = []
+    byte_range = None
+    next_offset = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-BYTERANGE:'):
+            length, _, offset = line[len('#EXT-X-BYTERANGE:'):].partition('@')
+            offset = int(offset) if offset else next_offset
+            byte_range = (int(length), offset)
+            next_offset = offset + int(length)
+        elif line and not line.startswith('#'):
+            ranges.append(byte_range)
+            byte_range = None
+    return ranges
+
+
+def render_media_playlist(segments):
+    """
+        Build a vod media playlist from (duration, uri) pairs
+    """
+    target_duration = max((math.ceil(duration) for duration, _ in segments), default=0)
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{target_duration}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    for duration, uri in segments:
+        lines += [f'#EXTINF:{duration:.6f},', uri]
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def render_master_playlist(renditions):
+    """
+        Build the master playlist over all renditions, lowest bandwidth first.
+        Video renditions without sound reference the audio rendition as their audio group,
+        its bandwidth and codecs are added to each of them
+    """
+    audio = next((rendition for rendition in renditions if is_audio_rung(rendition)), None)
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+    if audio:
+        lines.append(
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="{AUDIO_GROUP}",NAME="default",'
+            f'DEFAULT=YES,AUTOSELECT=YES,URI="{audio["label"]}/index.m3u8"'
+        )
+
+    for rendition in sorted(video_rungs(renditions), key=lambda rendition: rendition['bandwidth']):
+        attributes = [
+            f"BANDWIDTH={rendition['bandwidth'] + (audio['bandwidth'] if audio else 0)}",
+            f"AVERAGE-BANDWIDTH={rendition['average_bandwidth'] + (audio['average_bandwidth'] if audio else 0)}",
+        ]
+        if rendition.get('width'):
+            attributes.append(f"RESOLUTION={rendition['width']}x{rendition['height']}")
+        codecs = ','.join(filter(None, [rendition.get('codecs'), audio and audio.get('codecs')]))
+        if codecs:
+            attributes.append(f'CODECS="{codecs}"')
+        if audio:
+            attributes.append(f'AUDIO="{AUDIO_GROUP}"')
+        lines += [f"#EXT-X-STREAM-INF:{','.join(attributes)}", f"{rendition['label']}/index.m3u8"]
+    return '\n'.join(lines) + '\n'
+
+
+def sign_media_playlist(text, token):
+    """
+        Point the segment URIs and the init section of a media playlist at the segment route
+        with a token, the trailing slash of the route saves a redirect per segment
+    """
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#EXT-X-MAP:'):
+            line = re.sub(r'URI="([^"]+)"', lambda match: f'URI="{match.group(1)}/?token={token}"', line)
+        elif stripped and not stripped.startswith('#'):
+            line = f'{stripped}/?token={token}'
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from content_app.models import Video
+
+
+def save_progress(video_id, progress):
+    """
+        Merge percentages per rendition into the progress of the video and its duplicates,
+        the row is locked so parallel rendition jobs don't overwrite each other
+    """
+    with transaction.atomic():
+        video = Video.objects.select_for_update().filter(pk=video_id).first()
+        if video is None:
+            return
+        Video.objects.sharing_content(video_id).update(progress={**video.progress, **progress})
+
+
+class ProgressReporter:
+    """
+        Turns ffmpeg -progress output into a percentage of some renditions,
+        writes to the database at most every HLS_PROGRESS_INTERVAL seconds
+    """
+    def __init__(self, video_id, labels, duration):
+        self.video_id = video_id
+        self.labels = labels
+        self.duration = duration
+        self.percent = 0
+        self.last_write = 0
+
+    def feed(self, line):
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and value.isdigit() and self.duration:
+            self.update(min(99, int(int(value) / 1_000_000 / self.duration * 100)))
+        elif key == 'progress' and value == 'end':
+            self.update(100, force=True)
+
+    def update(self, percent, force=False):
+        if percent == self.percent and not force:
+            return
+        self.percent = percent
+
+        now = time.monotonic()
+        if force or now - self.last_write >= settings.HLS_PROGRESS_INTERVAL:
+            self.last_write = now
+            save_progress(self.video_id, {label: percent for label in self.labels})
@@ -0,0 +1,265 @@
+import os
+import shutil
+from collections import namedtuple
+from functools import cache
+from stat import S_ISREG
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# Bytes read per chunk when a file of the storage is streamed
+CHUNK_SIZE = 64 * 1024
+# Most keys S3 deletes with one request
+S3_DELETE_BATCH_SIZE = 1000
+
+# Size in bytes and modification time as unix timestamp of a stored file
+FileStat = namedtuple('FileStat', ['size', 'mtime'])
+
+
+def storage_name(path):
+    """
+        Name of a local rendition file in the storage, its path relative to MEDIA_ROOT
+    """
+    return os.path.relpath(path, settings.MEDIA_ROOT)
+
+
+class LocalRenditionStorage:
+    """
+        Renditions stay where the transcode wrote them below MEDIA_ROOT
+    """
+    is_local = True
+
+    def local_path(self, name):
+        """
+            Path of the file on this host
+        """
+        return os.path.join(settings.MEDIA_ROOT, name)
+
+    def save_dir(self, path):
+        """
+            Files are already in place
+        """
+
+    def save_file(self, path):
+        """
+            Files are already in place
+        """
+
+    def stat(self, name):
+        """
+            Size and modification time of a file, raises FileNotFoundError if it does not exist or is a directory
+        """
+        stat = os.stat(self.local_path(name))
+        if not S_ISREG(stat.st_mode):
+            raise FileNotFoundError(name)
+        return FileStat(stat.st_size, stat.st_mtime)
+
+    def size(self, name):
+        """
+            Bytes of a file, raises FileNotFoundError if it does not exist
+        """
+        return self.stat(name).size
+
+    def read_text(self, name):
+        """
+            Content of a small text file, e.g. a playlist
+        """
+        with open(self.local_path(name)) as f:
+            return f.read()
+
+    def iter_range(self, name, start=0, length=None):
+        """
+            Read a part of a file in bounded chunks, to its end without a length
+        """
+        with open(self.local_path(name), 'rb') as f:
+            f.seek(start)
+            while length is None or length > 0:
+                data = f.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+                if not data:
+                    break
+                if length is not None:
+                    length -= len(data)
+                yield data
+
+    def list(self, prefix):
+        """
+            Names of all files below a directory
+        """
+        root = self.local_path(prefix)
+        return [
+            storage_name(os.path.join(directory, name))
+            for directory, _, names in os.walk(root) for name in sorted(names)
+        ]
+
+    def delete(self, names):
+        """
+            Unlink files and the directories they leave empty
+        """
+        for name in names:
+            try:
+                os.remove(self.local_path(name))
+            except FileNotFoundError:
+                pass
+
+        dirs = {os.path.dirname(self.local_path(name)) for name in names}
+        for directory in sorted(dirs, key=len, reverse=True):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass
+
+
+class S3RenditionStorage:
+    """
+        Renditions in an S3 compatible bucket, e.g. AWS S3 or MinIO. Published renditions are uploaded
+        while the rest of the ladder is still encoding, large files in multipart uploads.
+        Reads are streamed from the object body chunk by chunk. boto3 is only imported when this backend is used
+    """
+    is_local = False
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region_name=None,
+                 access_key_id=None, secret_access_key=None, multipart_threshold=8 * 1024 * 1024,
+                 multipart_chunksize=8 * 1024 * 1024):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            region_name=region_name or None,
+            aws_access_key_id=access_key_id or None,
+            aws_secret_access_key=secret_access_key or None,
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+        )
+
+    def key(self, name):
+        """
+            Object key of a name
+        """
+        return f'{self.prefix}{name}'
+
+    def request(self, method, name, **kwargs):
+        """
+            Call a client method on the object of a name, a missing object raises FileNotFoundError
+        """
+        from botocore.exceptions import ClientError
+
+        try:
+            return getattr(self.client, method)(Bucket=self.bucket, Key=self.key(name), **kwargs)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(name)
+            raise
+
+    def local_path(self, name):
+        """
+            Objects have no path on this host
+        """
+        return None
+
+    def save_file(self, path):
+        """
+            Upload a local file, files above the multipart threshold are uploaded in parts
+        """
+        self.client.upload_file(path, self.bucket, self.key(storage_name(path)), Config=self.transfer_config)
+
+    def save_dir(self, path):
+        """
+            Upload every file of a published local directory
+        """
+        for directory, _, names in os.walk(path):
+            for name in sorted(names):
+                self.save_file(os.path.join(directory, name))
+
+    def stat(self, name):
+        """
+            Size and modification time of an object, raises FileNotFoundError if it does not exist
+        """
+        head = self.request('head_object', name)
+        return FileStat(head['ContentLength'], head['LastModified'].timestamp())
+
+    def size(self, name):
+        """
+            Bytes of an object, raises FileNotFoundError if it does not exist
+        """
+        return self.stat(name).size
+
+    def read_text(self, name):
+        """
+            Content of a small text object, e.g. a playlist
+        """
+        body = self.request('get_object', name)['Body']
+        with body:
+            return body.read().decode()
+
+    def iter_range(self, name, start=0, length=None):
+        """
+            Stream a part of an object, only the requested bytes are fetched
+        """
+        if length == 0:
+            return
+        end = '' if length is None else start + length - 1
+        body = self.request('get_object', name, Range=f'bytes={start}-{end}')['Body']
+        with body:
+            yield from body.iter_chunks(CHUNK_SIZE)
+
+    def list(self, prefix):
+        """
+            Names of all objects below a directory
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        prefix = self.key(prefix.rstrip('/') + '/')
+        return [
+            item['Key'][len(self.prefix):]
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+            for item in page.get('Contents', [])
+        ]
+
+    def delete(self, names):
+        """
+            Delete objects, S3 takes up to 1000 keys per request
+        """
+        for start in range(0, len(names), S3_DELETE_BATCH_SIZE):
+            batch = names[start:start + S3_DELETE_BATCH_SIZE]
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': self.key(name)} for name in batch], 'Quiet': True}
+            )
+
+
+@cache
+def get_rendition_storage():
+    """
+        Backend configured by RENDITION_STORAGE, created once per process
+    """
+    config = settings.RENDITION_STORAGE
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+@receiver(setting_changed)
+def reset_rendition_storage(setting, **kwargs):
+    """
+        Tests which override the setting get a fresh backend
+    """
+    if setting == 'RENDITION_STORAGE':
+        get_rendition_storage.cache_clear()
+
+
+def release_local_copies(paths):
+    """
+        Remove local working copies once a remote storage holds them
+    """
+    if get_rendition_storage().is_local:
+        return
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,349 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager, nullcontext
+from functools import cache
+
+from django.conf import settings
+from django.core.cache import cache as shared_cache
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from content_app.rendition_storage import FileStat
+
+# Data of a cached segment and the stat of its file, validators stay those of the file
+CachedSegment = namedtuple('CachedSegment', ['data', 'stat'])
+
+# Budget bytes per counter of the frequency sketch, about one counter per small segment
+SKETCH_BYTES_PER_COUNTER = 64 * 1024
+# Halves every counter of the sketch
+HALVE = bytes(value >> 1 for value in range(256))
+
+
+class FrequencySketch:
+    """
+        Count-min sketch of how often keys were requested with counters up to 15 (TinyLFU).
+        Every counter is halved after ten increments per counter so past popularity fades
+    """
+    DEPTH = 4
+
+    def __init__(self, width):
+        self.width = 1 << max(6, min(20, (width - 1).bit_length()))
+        self.rows = [bytearray(self.width) for _ in range(self.DEPTH)]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def indexes(self, key):
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=4 * self.DEPTH).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'little') & (self.width - 1) for i in range(self.DEPTH)]
+
+    def increment(self, key):
+        for row, index in zip(self.rows, self.indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                row[:] = row.translate(HALVE)
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+
+class SegmentCache:
+    """
+        Segments of the most watched renditions in process memory within a byte budget, keyed on
+        (base, generation, rendition, segment). 'lru' evicts the least recently used segments,
+        'tinylfu' also only admits a segment requested more often than the ones it would evict,
+        so a burst of one-off requests doesn't flush the hot set
+    """
+    def __init__(self, budget, policy='lru'):
+        self.budget = budget
+        self.sketch = FrequencySketch(budget // SKETCH_BYTES_PER_COUNTER) if policy == 'tinylfu' else None
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.rejections = 0
+
+    def ident(self, key):
+        """
+            Name of an entry in the store
+        """
+        return key
+
+    def get(self, key):
+        """
+            Cached segment or None, every call counts as a request of the key
+        """
+        with self.lock:
+            ident = self.ident(key)
+            if self.sketch:
+                self.sketch.increment(ident)
+            entry = self.lookup(ident)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, data, stat):
+        """
+            Cache a segment unless it exceeds the budget or the policy doesn't admit it
+        """
+        if len(data) > self.budget:
+            return False
+        with self.lock, self.exclusive():
+            ident = self.ident(key)
+            victims = self.victims(len(data))
+            if self.sketch and victims and self.sketch.frequency(ident) <= max(map(self.sketch.frequency, victims)):
+                self.rejections += 1
+                return False
+            for victim in victims:
+                self.discard(victim)
+            self.evictions += len(victims)
+            self.store(ident, data, stat)
+            return True
+
+    def exclusive(self):
+        """
+            Held while entries are evicted and stored, the lock of the instance is enough in one process
+        """
+        return nullcontext()
+
+    def lookup(self, ident):
+        entry = self.entries.get(ident)
+        if entry is not None:
+            self.entries.move_to_end(ident)
+        return entry
+
+    def victims(self, size):
+        """
+            Least recently used entries which have to go so size more bytes fit the budget
+        """
+        victims, free = [], self.budget - self.size
+        for ident, entry in self.entries.items():
+            if free >= size:
+                break
+            victims.append(ident)
+            free += len(entry.data)
+        return victims
+
+    def discard(self, ident):
+        entry = self.entries.pop(ident, None)
+        if entry is not None:
+            self.size -= len(entry.data)
+
+    def store(self, ident, data, stat):
+        self.discard(ident)
+        self.entries[ident] = CachedSegment(bytes(data), stat)
+        self.size += len(data)
+
+    def invalidate(self, base):
+        """
+            Drop every segment of a rendition base path
+        """
+        with self.lock:
+            for ident in [ident for ident in self.entries if ident[0] == base]:
+                self.discard(ident)
+
+    def usage(self):
+        return len(self.entries), self.size
+
+    def stats(self):
+        """
+            Hit ratio and usage of this process
+        """
+        with self.lock:
+            entries, size = self.usage()
+            requests = self.hits + self.misses
+            return {
+                'pid': os.getpid(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / requests, 4) if requests else None,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'entries': entries,
+                'bytes': size,
+                'budget': self.budget,
+            }
+
+
+class SharedSegmentCache(SegmentCache):
+    """
+        Segments in files of a directory on a tmpfs like /dev/shm which every worker of a host maps into
+        memory, so the workers share one copy within the budget. Files start with the size and mtime of
+        their source, hits refresh the file mtime and the least recently used files are evicted first
+    """
+    HEADER = struct.Struct('<qd')
+    # Seconds between two refreshes of the mtime of a file by one worker
+    TOUCH_INTERVAL = 10
+    # Mappings a worker keeps open
+    MAX_MAPS = 1024
+    # Lock file in the directory, not an entry
+    LOCK_NAME = '.lock'
+
+    def __init__(self, budget, policy='lru', directory=None):
+        super().__init__(budget, policy)
+        self.directory = directory
+        self.maps = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def base_prefix(self, base):
+        return hashlib.blake2b(base.encode(), digest_size=8).hexdigest()
+
+    def ident(self, key):
+        return f'{self.base_prefix(key[0])}-{hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()}'
+
+    def lookup(self, ident):
+        path = os.path.join(self.directory, ident)
+        mapped = self.maps.get(ident)
+        if mapped is not None:
+            entry, touched = mapped
+            if time.monotonic() - touched < self.TOUCH_INTERVAL:
+                self.maps.move_to_end(ident)
+                return entry
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another worker, the mapping is dropped so the memory is freed
+                del self.maps[ident]
+                return None
+            self.maps[ident] = (entry, time.monotonic())
+            self.maps.move_to_end(ident)
+            return entry
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        entry = CachedSegment(memoryview(data)[self.HEADER.size:], FileStat(*self.HEADER.unpack_from(data)))
+        self.maps[ident] = (entry, time.monotonic())
+        # Mappings are closed once no response uses them anymore
+        while len(self.maps) > self.MAX_MAPS:
+            self.maps.popitem(last=False)
+        return entry
+
+    @contextmanager
+    def exclusive(self):
+        """
+            flock of the directory's lock file, so workers on the host evict and store one at a time
+            and together stay within the budget
+        """
+        with open(os.path.join(self.directory, self.LOCK_NAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def files(self):
+        """
+            (mtime, size, name) of every cached file
+        """
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp') or entry.name == self.LOCK_NAME:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.name))
+        return files
+
+    def victims(self, size):
+        files = sorted(self.files())
+        victims, free = [], self.budget - sum(file_size for _, file_size, _ in files)
+        for _, file_size, name in files:
+            if free >= size + self.HEADER.size:
+                break
+            victims.append(name)
+            free += file_size
+        return victims
+
+    def discard(self, ident):
+        self.maps.pop(ident, None)
+        try:
+            os.remove(os.path.join(self.directory, ident))
+        except FileNotFoundError:
+            pass
+
+    def store(self, ident, data, stat):
+        path = os.path.join(self.directory, ident)
+        partial = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(partial, 'wb') as f:
+            f.write(self.HEADER.pack(stat.size, stat.mtime))
+            f.write(data)
+        os.replace(partial, path)
+        self.maps.pop(ident, None)
+
+    def invalidate(self, base):
+        prefix = f'{self.base_prefix(base)}-'
+        with self.lock:
+            for _, _, name in self.files():
+                if name.startswith(prefix):
+                    self.discard(name)
+
+    def usage(self):
+        files = self.files()
+        return len(files), sum(file_size for _, file_size, _ in files)
+
+
+@cache
+def get_segment_cache():
+    """
+        Segment cache configured by the HLS_SEGMENT_CACHE settings, None when the budget is 0
+    """
+    if not settings.HLS_SEGMENT_CACHE_BUDGET:
+        return None
+    if settings.HLS_SEGMENT_CACHE_DIR:
+        return SharedSegmentCache(
+            settings.HLS_SEGMENT_CACHE_BUDGET, settings.HLS_SEGMENT_CACHE_POLICY, settings.HLS_SEGMENT_CACHE_DIR
+        )
+    return SegmentCache(settings.HLS_SEGMENT_CACHE_BUDGET, settings.HLS_SEGMENT_CACHE_POLICY)
+
+
+@receiver(setting_changed)
+def reset_segment_cache(setting, **kwargs):
+    """
+        A new configuration or other media files start with an empty cache
+    """
+    if setting.startswith('HLS_SEGMENT_CACHE') or setting in ('MEDIA_ROOT', 'RENDITION_STORAGE'):
+        get_segment_cache.cache_clear()
+
+
+def generation_key(base):
+    return f'segment-generation:{base}'
+
+
+def get_segment_generation(base):
+    """
+        Part of the cache keys of the segments of a base, a new generation leaves the cached ones behind
+    """
+    return shared_cache.get(generation_key(base), 0)
+
+
+def invalidate_segments(base):
+    """
+        Drop the cached segments of a rendition base path when its files are replaced or deleted.
+        Other processes move to the new generation once their cached location of the video expires
+    """
+    key = generation_key(base)
+    shared_cache.add(key, 0, timeout=None)
+    shared_cache.incr(key)
+
+    segment_cache = get_segment_cache()
+    if segment_cache is not None:
+        segment_cache.invalidate(base)
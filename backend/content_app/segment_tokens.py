@@ -0,0 +1,44 @@
+import math
+import time
+
+from django.conf import settings
+from django.utils.crypto import constant_time_compare, salted_hmac
+from rest_framework.permissions import BasePermission
+
+SEGMENT_TOKEN_SALT = 'content_app.segment_tokens'
+# Expiry is rounded up to this many seconds, the segment URLs of playlists served within
+# the same window are identical and stay cacheable
+SEGMENT_TOKEN_GRANULARITY = 60 * 60
+
+
+def token_signature(video_id, resolution, expires):
+    return salted_hmac(SEGMENT_TOKEN_SALT, f'{video_id}/{resolution}/{expires}', algorithm='sha256').hexdigest()
+
+
+def sign_segment_token(video_id, resolution, now=None):
+    """
+        Token which grants access to the segments of one rendition of a video until it expires
+    """
+    now = time.time() if now is None else now
+    expires = math.ceil((now + settings.HLS_SEGMENT_TOKEN_TTL) / SEGMENT_TOKEN_GRANULARITY) * SEGMENT_TOKEN_GRANULARITY
+    return f'{expires}.{token_signature(video_id, resolution, expires)}'
+
+
+def check_segment_token(token, video_id, resolution, now=None):
+    """
+        Whether a token was signed for this rendition and has not expired, only cpu work
+    """
+    expires, _, signature = (token or '').partition('.')
+    if not expires.isdigit() or int(expires) < (time.time() if now is None else now):
+        return False
+    return constant_time_compare(signature, token_signature(video_id, resolution, int(expires)))
+
+
+class HasSegmentToken(BasePermission):
+    """
+        Segment requests carry the token of their playlist instead of the session cookie
+    """
+    def has_permission(self, request, view):
+        return check_segment_token(
+            request.query_params.get('token'), view.kwargs['pk'], view.kwargs['resolution']
+        )
@@ -1,10 +1,20 @@
 from .models import Video
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
-from content_app.tasks import convert_resolutions_to_hls, delete_hls_files
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, pre_save
+from rq import Callback
+from content_app.tasks import transcode_video, delete_hls_files, mark_transcode_failed, record_transcode_cpu
+from content_app.storage import delete_manifest_files
+from content_app.locations import invalidate_video_locations
+from content_app.segment_cache import invalidate_segments
+from content_app.rendition_storage import storage_name
+from content_app.authentication import revoke_user_tokens
 from core.utils.tasks import enqueue_after_commit
 import os
 
+# A change of one of these user fields revokes the tokens issued to the user
+TOKEN_REVOKING_FIELDS = ('is_active', 'is_staff', 'password')
+
 def save_remove(path):
     """
         Capture File not found error so it will not throw error 
@@ -20,20 +30,37 @@ def save_remove(path):
 @receiver(post_save, sender=Video)
 def video_post_save(sender, instance, created, **kwargs):
     """
-        Convert video in diffrent resolutions
+        Convert video in diffrent resolutions, the cached location of a changed video is dropped
     """
+    invalidate_video_locations([instance.pk])
     if created:
-        enqueue_after_commit(convert_resolutions_to_hls, instance.video_file.path)
+        enqueue_after_commit(
+            transcode_video, instance.pk, queue='transcode_high',
+            on_success=Callback(record_transcode_cpu), on_failure=Callback(mark_transcode_failed)
+        )
 
 
 @receiver(post_delete, sender=Video)
 def video_post_delete(sender, instance, **kwargs):
     """
-        Delete files from Media if video object is delete
+        Delete files from Media if video object is delete,
+        source and renditions shared with other videos are kept until the last one is deleted.
+        Renditions are deleted by their manifest, files a failed delete leaves behind are
+        reclaimed by the storage garbage collection. Cached segments of deleted renditions are dropped
     """
-    if instance.video_file and os.path.isfile(instance.video_file.path):
+    source_shared = Video.objects.filter(video_file=instance.video_file.name).exists()
+    renditions_shared = bool(instance.content_hash) and Video.objects.filter(content_hash=instance.content_hash).exists()
+
+    if instance.video_file and not source_shared and os.path.isfile(instance.video_file.path):
         enqueue_after_commit(save_remove, instance.video_file.path)
-        enqueue_after_commit(delete_hls_files, instance.video_file.path)
+    if (instance.content_hash or instance.video_file) and not renditions_shared:
+        invalidate_segments(storage_name(instance.get_base_path()))
+    invalidate_video_locations([instance.pk])
+
+    if instance.manifest and not renditions_shared:
+        enqueue_after_commit(delete_manifest_files, sorted(instance.manifest))
+    elif instance.video_file and not renditions_shared:
+        enqueue_after_commit(delete_hls_files, instance.get_base_path(), [rung['label'] for rung in instance.renditions])
 
     if instance.thumbnail_url and os.path.isfile(instance.thumbnail_url.path):
         enqueue_after_commit(save_remove, instance.thumbnail_url.path)
@@ -42,3 +69,14 @@ def video_post_delete(sender, instance, **kwargs):
             
 
 
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def user_pre_save(sender, instance, update_fields=None, **kwargs):
+    """
+        Revoke the tokens of a user who is deactivated, loses or gains staff status or gets a new password,
+        their claims no longer hold
+    """
+    if instance.pk is None or (update_fields is not None and not set(update_fields) & set(TOKEN_REVOKING_FIELDS)):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values(*TOKEN_REVOKING_FIELDS).first()
+    if previous and any(previous[field] != getattr(instance, field) for field in TOKEN_REVOKING_FIELDS):
+        revoke_user_tokens(instance.pk)
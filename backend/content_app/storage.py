@@ -0,0 +1,195 @@
+import os
+import shutil
+import time
+from collections import defaultdict
+from datetime import timedelta
+from uuid import uuid4
+
+import django_rq
+from django.conf import settings
+
+from core.utils.tasks import DEFAULT_RETRY, enqueue
+from content_app.models import Video, VideoUpload
+from content_app.rendition_storage import get_rendition_storage
+
+# Job ids of the periodic garbage collection start with this, so only one chain runs at a time
+GC_JOB_PREFIX = 'storage-gc-'
+
+
+def get_videos_dir():
+    """
+        Directory which holds the sources and the renditions of all videos
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'videos')
+
+
+def delete_manifest_files(paths):
+    """
+        Delete the files of a manifest from the rendition storage, paths relative to MEDIA_ROOT. One job
+        deletes a batch of STORAGE_DELETE_BATCH_SIZE files and enqueues the rest, so a retry never starts over
+    """
+    batch, rest = paths[:settings.STORAGE_DELETE_BATCH_SIZE], paths[settings.STORAGE_DELETE_BATCH_SIZE:]
+    get_rendition_storage().delete(batch)
+
+    if rest:
+        enqueue(delete_manifest_files, rest)
+    return len(batch)
+
+
+def entry_size(path):
+    """
+        Bytes of a file or of all files below a directory
+    """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path) for name in names
+    )
+
+
+def owned_prefixes():
+    """
+        Sources and the name prefixes of renditions which still belong to a video or an upload.
+        Renditions are prefixed by the content hash, those of videos transcoded before
+        deduplication by the name of their source
+    """
+    sources = set(Video.objects.exclude(video_file='').values_list('video_file', flat=True))
+    sources |= set(VideoUpload.objects.values_list('file_name', flat=True))
+    hashes = set(Video.objects.exclude(content_hash='').values_list('content_hash', flat=True))
+    return sources, hashes | {os.path.splitext(os.path.basename(source))[0] for source in sources}
+
+
+def is_orphan(name, sources, prefixes):
+    """
+        Entry of the videos dir which no video or upload owns, renditions, master playlists,
+        staging dirs and chunk dirs are all named <prefix>_<label>
+    """
+    if os.path.join('videos', name) in sources:
+        return False
+    return name.rsplit('_', 1)[0] not in prefixes
+
+
+def stored_entries(storage):
+    """
+        Files of a remote rendition storage below videos by the entry of the videos dir they belong to,
+        none for the local backend whose files are the videos dir itself
+    """
+    entries = defaultdict(list)
+    if not storage.is_local:
+        for name in storage.list('videos'):
+            entries[name.split('/')[1]].append(name)
+    return entries
+
+
+def delete_local_entry(path, min_mtime):
+    """
+        Delete an entry of the local videos dir unless it changed after min_mtime, returns the bytes reclaimed
+    """
+    if os.path.getmtime(path) > min_mtime:
+        return 0
+    size = entry_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+    return size
+
+
+def delete_stored_entry(storage, names, min_mtime):
+    """
+        Delete the files of an entry from the rendition storage unless one of them changed after min_mtime
+        or disappeared meanwhile, returns the bytes reclaimed
+    """
+    try:
+        stats = [storage.stat(name) for name in names]
+    except FileNotFoundError:
+        return 0
+    if max(stat.mtime for stat in stats) > min_mtime:
+        return 0
+    storage.delete(names)
+    return sum(stat.size for stat in stats)
+
+
+def collect_garbage_batch(cursor=''):
+    """
+        Look at the next batch of entries of the videos dir after the cursor in name order
+        and delete the orphaned ones which are old enough. With a remote rendition storage its files
+        below videos are entries as well, listed through the storage. Returns the names looked at
+        and the bytes reclaimed
+    """
+    videos_dir = get_videos_dir()
+    storage = get_rendition_storage()
+    stored = stored_entries(storage)
+    local = set(os.listdir(videos_dir)) if os.path.isdir(videos_dir) else set()
+    names = sorted(name for name in local | set(stored) if name > cursor)[:settings.STORAGE_GC_BATCH_SIZE]
+
+    sources, prefixes = owned_prefixes()
+    min_mtime = time.time() - settings.STORAGE_GC_MIN_AGE
+    reclaimed = 0
+    for name in names:
+        if not is_orphan(name, sources, prefixes):
+            continue
+        if name in local:
+            reclaimed += delete_local_entry(os.path.join(videos_dir, name), min_mtime)
+        if name in stored:
+            reclaimed += delete_stored_entry(storage, stored[name], min_mtime)
+    return names, reclaimed
+
+
+def collect_rendition_garbage(cursor='', reclaimed=0):
+    """
+        Periodic rq job, one step of a garbage collection pass over the videos dir and the rendition storage.
+        A step enqueues the next one right away until the pass reached the end of the dir,
+        then the next pass is scheduled after STORAGE_GC_INTERVAL. The last step returns
+        the storage report, rq keeps it as the job result
+    """
+    names, batch_reclaimed = collect_garbage_batch(cursor)
+    reclaimed += batch_reclaimed
+    if len(names) == settings.STORAGE_GC_BATCH_SIZE:
+        enqueue(collect_rendition_garbage, names[-1], reclaimed, job_id=f'{GC_JOB_PREFIX}{uuid4().hex}')
+        return {'cursor': names[-1], 'reclaimed_bytes': reclaimed}
+
+    django_rq.get_queue('default').enqueue_in(
+        timedelta(seconds=settings.STORAGE_GC_INTERVAL), collect_rendition_garbage,
+        job_id=f'{GC_JOB_PREFIX}{uuid4().hex}', retry=DEFAULT_RETRY
+    )
+    return dict(storage_report(), reclaimed_bytes=reclaimed)
+
+
+def schedule_rendition_gc():
+    """
+        Start the periodic garbage collection unless a step of it is already queued, scheduled or running.
+        Needs a worker of the default queue started with --with-scheduler
+    """
+    queue = django_rq.get_queue('default')
+    job_ids = [
+        *queue.get_job_ids(),
+        *queue.scheduled_job_registry.get_job_ids(),
+        *queue.started_job_registry.get_job_ids(),
+    ]
+    if any(job_id.startswith(GC_JOB_PREFIX) for job_id in job_ids):
+        return None
+    return enqueue(collect_rendition_garbage, job_id=f'{GC_JOB_PREFIX}{uuid4().hex}')
+
+
+def storage_report():
+    """
+        Bytes of the source and of the renditions per video from the manifests, files shared
+        by deduplicated videos are counted once in the total
+    """
+    videos = []
+    sizes = {}
+    for video in Video.objects.only('id', 'title', 'video_file', 'manifest').order_by('pk'):
+        source_bytes = 0
+        if video.video_file and os.path.isfile(video.video_file.path):
+            source_bytes = os.path.getsize(video.video_file.path)
+            sizes[video.video_file.name] = source_bytes
+        sizes.update(video.manifest)
+        videos.append({
+            'id': video.id,
+            'title': video.title,
+            'source_bytes': source_bytes,
+            'rendition_bytes': sum(video.manifest.values()),
+        })
+    return {'videos': videos, 'total_bytes': sum(sizes.values())}
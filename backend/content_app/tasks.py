@@ -1,60 +1,711 @@
 import subprocess
 import os
 import glob
+import math
+import shutil
 
-resolutions = [480, 720, 1080]
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from rq import Callback
 
-def convert_resolutions_to_hls(source):
+from core.utils.tasks import enqueue
+from content_app.models import ContentClaim, Video, hash_video_file, rendition_base_path
+from content_app.encoding import (
+    probe_video, probe_codecs, build_ladder, encode_args, audio_encode_args, is_audio_rung, video_rungs, run_ffmpeg
+)
+from content_app.playlists import parse_media_playlist, parse_byte_ranges, render_media_playlist, render_master_playlist
+from content_app.progress import ProgressReporter, save_progress
+from content_app.locations import invalidate_video_locations
+from content_app.segment_cache import invalidate_segments
+from content_app.rendition_storage import get_rendition_storage, release_local_copies, storage_name
+from content_app.governor import choose_preset, job_cpu_seconds, threads_per_process
+from content_app.trickplay import (
+    TRICKPLAY_VTT, build_sprite_command, build_trickplay_command, render_trickplay_vtt,
+    trickplay_filter, trickplay_output_args
+)
+
+# Added to every chunk's timestamps so the encoder delay never yields a negative dts,
+# otherwise the muxer shifts only the first chunk and the stitched rendition jumps.
+# Renditions encoded whole in chunked mode get the same lead so they stay in sync with the stitched ones
+CHUNK_TS_LEAD = 1.0
+
+# Single file of a rendition in fmp4 mode, holds the init section and all fragments
+FMP4_FILENAME = 'rendition.mp4'
+
+# Largest keyframe interval of the encoder in frames, far above a segment so only forced keyframes start segments
+MAX_GOP_FRAMES = 100000
+
+
+def get_rendition_dir(base, label):
+    """
+        Directory which holds the playlist and segments of one rendition
+    """
+    return f'{base}_{label}'
+
+
+def get_staging_dir(base, label):
+    """
+        Directory a rendition is encoded into, it is renamed to the rendition dir once complete
+    """
+    return f'{base}_{label}.partial'
+
+
+def get_trickplay_dir(base):
+    """
+        Directory which holds the sprite sheets and the WebVTT thumbnail track of a video
+    """
+    return get_rendition_dir(base, 'trickplay')
+
+
+def get_master_playlist_path(base):
+    """
+        Adaptive bitrate playlist over all renditions of a video
+    """
+    return f'{base}_master.m3u8'
+
+
+def get_chunks_dir(base):
+    """
+        Working directory of the chunked encoding mode
+    """
+    return f'{base}_chunks'
+
+
+def has_startup_segments():
+    """
+        Whether video renditions start with short segments
+    """
+    return settings.HLS_STARTUP_SEGMENTS > 0 and 0 < settings.HLS_STARTUP_SEGMENT_DURATION < settings.HLS_SEGMENT_DURATION
+
+
+def startup_span():
+    """
+        Seconds of the startup segments, the grid of regular segments starts there
+    """
+    return settings.HLS_STARTUP_SEGMENTS * settings.HLS_STARTUP_SEGMENT_DURATION if has_startup_segments() else 0
+
+
+def keyframe_args(start=0):
+    """
+        Encoder options which put keyframes exactly at the segment boundaries and nowhere else,
+        first at the startup segment length and then at the segment length. The hls muxer cuts at
+        every keyframe once the startup segment length passed, so no other keyframes may appear.
+        A chunk beginning start seconds into the source gets its keyframes on the grid of the
+        whole source, the chunk's first frame is the first boundary
+    """
+    duration = settings.HLS_SEGMENT_DURATION
+    grid_start = startup_span()
+    if start == 0 and has_startup_segments():
+        count, startup_duration = settings.HLS_STARTUP_SEGMENTS, settings.HLS_STARTUP_SEGMENT_DURATION
+        boundaries = (
+            f'if(lt(n_forced,{count}),gte(t,n_forced*{startup_duration}),'
+            f'gte(t,{grid_start}+(n_forced-{count})*{duration}))'
+        )
+    elif start == 0:
+        boundaries = f'gte(t,n_forced*{duration})'
+    else:
+        first = grid_start + max(0, math.floor(round((start - grid_start) / duration, 6))) * duration
+        boundaries = f'gte(t+{start:g},{first:g}+n_forced*{duration})'
+    return ['-force_key_frames', f'expr:{boundaries}', '-sc_threshold', '0', '-g', str(MAX_GOP_FRAMES)]
+
+
+def hls_output_args(output_dir, prefix='', segment_format=None, startup=False):
+    """
+        ffmpeg muxer options for one hls rendition, fmp4 renditions are one file with byte range segments.
+        With startup the muxer cuts at the startup segment length, keyframe_args decide where
+    """
+    startup = startup and has_startup_segments()
+    segment_duration = settings.HLS_STARTUP_SEGMENT_DURATION if startup else settings.HLS_SEGMENT_DURATION
+    if (segment_format or settings.HLS_SEGMENT_FORMAT) == 'fmp4':
+        segment_args = [
+            '-hls_segment_type', 'fmp4',
+            '-hls_flags', 'single_file',
+            '-hls_segment_filename', os.path.join(output_dir, f'{prefix}{FMP4_FILENAME}'),
+        ]
+    else:
+        segment_args = ['-hls_segment_filename', os.path.join(output_dir, f'{prefix}segment_%03d.ts')]
+
+    return [
+        '-f', 'hls',
+        '-hls_time', str(segment_duration),
+        '-hls_playlist_type', 'vod',
+        *segment_args,
+        os.path.join(output_dir, f'{prefix}index.m3u8')
+    ]
+
+
+def build_rendition_command(source, base, rung, threads=0, ts_offset=0):
+    """
+        ffmpeg command for a single rendition, video renditions are encoded without audio.
+        ts_offset shifts the timestamps of the rendition by seconds
+    """
+    if is_audio_rung(rung):
+        stream_args = ['-map', '0:a:0', *audio_encode_args(rung)]
+    else:
+        stream_args = ['-map', '0:v:0', '-vf', f"scale=-2:{rung['height']}", *encode_args(rung, threads), *keyframe_args()]
+
+    return [
+        'ffmpeg',
+        '-i', source,
+        *stream_args,
+        *(['-output_ts_offset', f'{ts_offset:.6f}'] if ts_offset else []),
+        *hls_output_args(get_staging_dir(base, rung['label']), startup=not is_audio_rung(rung))
+    ]
+
+
+def build_serial_commands(source, base, ladder, threads=0):
+    """
+        One ffmpeg command per rendition, the source is decoded for every command
+    """
+    return [build_rendition_command(source, base, rung, threads) for rung in ladder]
+
+
+def build_single_pass_command(source, base, ladder, trickplay=False, threads=0):
+    """
+        One ffmpeg command for all renditions, the decoded frames are split and scaled per video rendition
+        and the audio is encoded once into its own rendition.
+        The trickplay thumbnails are optionally taken from the same decoded frames.
+        The threads of the process are shared among the encoders of all video renditions
+    """
+    videos = video_rungs(ladder)
+    encoder_threads = max(1, threads // len(videos)) if threads and videos else 0
+    labels = [rung['label'] for rung in videos] + (['trickplay'] if trickplay else [])
+    splits = ''.join(f'[s{label}]' for label in labels)
+    scales = ''.join(f";[s{rung['label']}]scale=-2:{rung['height']}[v{rung['label']}]" for rung in videos)
+    filter_graph = f'[0:v]split={len(labels)}{splits}{scales}'
+    if trickplay:
+        filter_graph += f';[strickplay]{trickplay_filter(ladder)}[vtrickplay]'
+
+    cmd = ['ffmpeg', '-i', source, '-filter_complex', filter_graph]
+    for rung in ladder:
+        if is_audio_rung(rung):
+            stream_args = ['-map', '0:a:0', *audio_encode_args(rung)]
+        else:
+            stream_args = ['-map', f"[v{rung['label']}]", *encode_args(rung, encoder_threads), *keyframe_args()]
+        cmd += [*stream_args, *hls_output_args(get_staging_dir(base, rung['label']), startup=not is_audio_rung(rung))]
+    if trickplay:
+        cmd += ['-map', '[vtrickplay]', *trickplay_output_args(get_staging_dir(base, 'trickplay'))]
+    return cmd
+
+
+def convert_resolutions_to_hls(source, mode=None, ladder=None, video_id=None, duration=0, base=None):
+    """
+        Convert videos into hls files, progress is reported when a video id is given.
+        Renditions are written next to the source unless a base path is given.
+        Renditions completed by an earlier attempt are skipped, a failing ffmpeg raises
+    """
+    base = base or os.path.splitext(source)[0]
+    mode = mode or settings.HLS_TRANSCODE_MODE
+    if ladder is None:
+        probe = probe_video(source)
+        ladder = build_ladder(probe)
+        duration = duration or probe['duration']
+
+    pending = pending_renditions(base, ladder)
+    if video_id and len(pending) < len(ladder):
+        save_progress(video_id, {rung['label']: 100 for rung in ladder if rung not in pending})
+    trickplay = trickplay_pending(base, duration)
+
+    labels = [rung['label'] for rung in pending]
+    threads = threads_per_process()
+    if mode == 'single_pass' and video_rungs(pending):
+        commands = [(build_single_pass_command(source, base, pending, trickplay, threads), labels)]
+    else:
+        commands = list(zip(build_serial_commands(source, base, pending, threads), [[label] for label in labels]))
+        if trickplay:
+            commands.append((build_trickplay_command(source, get_staging_dir(base, 'trickplay'), ladder), []))
+
+    for label in labels + (['trickplay'] if trickplay else []):
+        prepare_staging_dir(base, label)
+
+    for cmd, cmd_labels in commands:
+        reporter = ProgressReporter(video_id, cmd_labels, duration) if video_id and cmd_labels else None
+        run_ffmpeg(cmd, reporter)
+        for label in cmd_labels:
+            publish_rendition(base, label)
+        if video_id and cmd_labels:
+            publish_playable(video_id, base, ladder)
+
+    if trickplay:
+        publish_trickplay(base, ladder, duration)
+    return ladder
+
+
+def is_rendition_complete(output_dir):
+    """
+        A rendition is complete once its playlist is ended and every segment of it exists,
+        files of byte range segments have to reach the end of the last range
+    """
+    playlist_path = os.path.join(output_dir, 'index.m3u8')
+    if not os.path.isfile(playlist_path):
+        return False
+
+    with open(playlist_path) as f:
+        playlist = f.read()
+    if '#EXT-X-ENDLIST' not in playlist:
+        return False
+
+    segments = parse_media_playlist(playlist)
+    for (_, uri), byte_range in zip(segments, parse_byte_ranges(playlist)):
+        path = os.path.join(output_dir, uri)
+        if not os.path.isfile(path) or os.path.getsize(path) < (sum(byte_range) if byte_range else 1):
+            return False
+    return bool(segments)
+
+
+def pending_renditions(base, ladder):
+    """
+        Rungs of the ladder which are not yet published
+    """
+    return [rung for rung in ladder if not is_rendition_complete(get_rendition_dir(base, rung['label']))]
+
+
+def prepare_staging_dir(base, label):
+    """
+        Empty staging dir for a new encoding attempt, leftovers of a crashed attempt are dropped
+    """
+    staging_dir = get_staging_dir(base, label)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+
+def publish_rendition(base, label):
+    """
+        Verify the staged rendition, rename it into place and hand it to the rendition storage,
+        the views never see a partly written rendition. Segments cached from a rendition it replaces
+        are dropped, a first publish leaves the cached segments of the other renditions alone
+    """
+    staging_dir = get_staging_dir(base, label)
+    if not is_rendition_complete(staging_dir):
+        raise RuntimeError(f'Rendition {label} of {base} is incomplete')
+
+    output_dir = get_rendition_dir(base, label)
+    storage = get_rendition_storage()
+    try:
+        storage.stat(storage_name(os.path.join(output_dir, 'index.m3u8')))
+        replaces = True
+    except FileNotFoundError:
+        replaces = False
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(staging_dir, output_dir)
+    storage.save_dir(output_dir)
+    if replaces:
+        invalidate_segments(storage_name(base))
+
+
+def enqueue_transcode(task, *args, queue='transcode', **kwargs):
+    """
+        Put a job of the transcode pipeline on a transcode queue, the video is marked
+        as failed once the job ran out of retries. First argument of every job is the video id
+    """
+    return enqueue(
+        task, *args, queue=queue,
+        on_success=Callback(record_transcode_cpu), on_failure=Callback(mark_transcode_failed),
+        **kwargs
+    )
+
+
+def record_transcode_cpu(job, connection, result=None, *args, **kwargs):
+    """
+        rq callback, stores the cpu seconds of the attempt on the job and adds them to the video
     """
-        Convert videos into hls files
+    cpu_seconds = job_cpu_seconds()
+    job.meta['cpu_seconds'] = job.meta.get('cpu_seconds', 0) + cpu_seconds
+    job.save_meta()
+    Video.objects.filter(pk=job.args[0]).update(cpu_seconds=F('cpu_seconds') + cpu_seconds)
+
+
+def mark_transcode_failed(job, connection, type, value, traceback):
+    """
+        rq failure callback, runs on every failed attempt.
+        Videos which already play their published renditions stay ready
+    """
+    record_transcode_cpu(job, connection)
+    if not job.retries_left:
+        Video.objects.sharing_content(job.args[0]).filter(renditions=[]).update(status=Video.Status.FAILED)
+
+
+def transcode_video(video_id):
+    """
+        Entry job of the transcode pipeline, runs on the transcode_high queue. Hashes the source,
+        a source which is already known reuses the existing renditions. Otherwise the lowest rendition
+        and the audio are encoded right away so the video becomes playable, the rest of the ladder follows on the transcode queue
+    """
+    video = Video.objects.get(pk=video_id)
+    content_hash = hash_video_file(video.video_file)
+    original = claim_content(video, content_hash)
+    if original.pk != video.pk:
+        reuse_renditions(video, original)
+        return
+
+    source = video.video_file.path
+    base = rendition_base_path(content_hash)
+    probe = probe_video(source)
+    preset = choose_preset()
+    ladder = [dict(rung, preset=preset) for rung in build_ladder(probe)]
+
+    # Uploads of the same content which claimed it meanwhile follow this transcode
+    videos = Video.objects.sharing_content(video_id)
+    videos.update(status=Video.Status.TRANSCODING, progress={rung['label']: 0 for rung in ladder})
+    invalidate_video_locations(list(videos.values_list('pk', flat=True)))
+
+    duration = probe['duration']
+    for rung in [ladder[0], *filter(is_audio_rung, ladder)]:
+        convert_rendition_to_hls(video_id, source, base, rung, duration, ladder)
+
+    if settings.HLS_TRANSCODE_MODE == 'fanout':
+        fan_out_renditions(video_id, source, base, ladder, duration)
+    elif settings.HLS_TRANSCODE_MODE == 'chunked':
+        fan_out_chunks(video_id, source, base, ladder, duration)
+    else:
+        enqueue_transcode(encode_ladder, video_id, source, base, ladder, duration)
+
+
+def encode_ladder(video_id, source, base, ladder, duration):
+    """
+        Encode the renditions which are not yet published in the configured mode and finalize
+    """
+    convert_resolutions_to_hls(source, ladder=ladder, video_id=video_id, duration=duration, base=base)
+    finalize_transcode(video_id, base, ladder)
+
+
+def claim_content(video, content_hash):
+    """
+        Video which encodes the content, the earliest upload of it which didn't fail. The claim row
+        of the hash is locked while it is decided and the hash of the video is written in the same
+        transaction, so of concurrent uploads of the same content only one encodes it
+    """
+    with transaction.atomic():
+        claim, _ = ContentClaim.objects.select_for_update().get_or_create(content_hash=content_hash)
+        original = Video.objects.filter(pk=claim.video_id).exclude(status=Video.Status.FAILED).first()
+        if original is None:
+            # Uploads deduplicated before claims existed hold the content without one
+            original = (
+                Video.objects.filter(content_hash=content_hash)
+                .exclude(pk=video.pk)
+                .exclude(status=Video.Status.FAILED)
+                .first()
+            ) or video
+            claim.video = original
+            claim.save(update_fields=['video'])
+        Video.objects.filter(pk=video.pk).update(content_hash=content_hash)
+    return original
+
+
+def reuse_renditions(video, original):
+    """
+        Point the video at the source and renditions of an earlier upload with the same content
+        and drop its own copy of the file. A transcode still running for the other upload
+        updates this video too once it finishes
     """
-    base, _ = os.path.splitext(source)
+    duplicate_path = video.video_file.path
+    with transaction.atomic():
+        # Locked so a publish of the other upload can't land between the read and the copy
+        original = Video.objects.select_for_update().get(pk=original.pk)
+        Video.objects.filter(pk=video.pk).update(
+            content_hash=original.content_hash,
+            video_file=original.video_file.name,
+            renditions=original.renditions,
+            manifest=original.manifest,
+            status=original.status,
+            progress=original.progress
+        )
+    invalidate_video_locations([video.pk])
+    if duplicate_path != original.video_file.path and os.path.exists(duplicate_path):
+        os.remove(duplicate_path)
+
+
+def fan_out_renditions(video_id, source, base, ladder, duration):
+    """
+        Enqueue every rendition which is not yet published and the trickplay sprite sheets
+        as their own jobs on the transcode queue, the finalizer only runs once all of them succeeded
+    """
+    jobs = [
+        enqueue_transcode(convert_rendition_to_hls, video_id, source, base, rung, duration, ladder)
+        for rung in pending_renditions(base, ladder)
+    ]
+    jobs.append(enqueue_transcode(generate_trickplay, video_id, source, base, ladder, duration))
+    return enqueue_transcode(finalize_transcode, video_id, base, ladder, depends_on=jobs)
+
+
+def convert_rendition_to_hls(video_id, source, base, rung, duration, ladder):
+    """
+        Convert video into hls files of one rendition of the ladder and make it playable,
+        skipped if a previous attempt already published it. In chunked mode the rendition
+        starts CHUNK_TS_LEAD later like the stitched ones
+    """
+    if not pending_renditions(base, [rung]):
+        return
+
+    ts_offset = CHUNK_TS_LEAD if settings.HLS_TRANSCODE_MODE == 'chunked' else 0
+    prepare_staging_dir(base, rung['label'])
+    run_ffmpeg(
+        build_rendition_command(source, base, rung, threads_per_process(), ts_offset),
+        ProgressReporter(video_id, [rung['label']], duration)
+    )
+    publish_rendition(base, rung['label'])
+    publish_playable(video_id, base, ladder)
+
+
+def trickplay_pending(base, duration):
+    """
+        Trickplay thumbnails are wanted and not yet published
+    """
+    return bool(settings.TRICKPLAY_INTERVAL and duration) and not os.path.exists(
+        os.path.join(get_trickplay_dir(base), TRICKPLAY_VTT)
+    )
+
+
+def generate_trickplay(video_id, source, base, ladder, duration):
+    """
+        Take the trickplay thumbnails on their own, skipped if a previous attempt already published them
+    """
+    if not trickplay_pending(base, duration):
+        return
+
+    prepare_staging_dir(base, 'trickplay')
+    run_ffmpeg(build_trickplay_command(source, get_staging_dir(base, 'trickplay'), ladder))
+    publish_trickplay(base, ladder, duration)
+
+
+def publish_trickplay(base, ladder, duration):
+    """
+        Pack the staged thumbnails into sprite sheets, write the WebVTT track over them
+        and rename the sheets into place
+    """
+    staging_dir = get_staging_dir(base, 'trickplay')
+    thumbnails = glob.glob(os.path.join(staging_dir, 'thumbnail_*.jpg'))
+    if not thumbnails:
+        raise RuntimeError(f'Trickplay thumbnails missing for {base}')
+
+    subprocess.run(build_sprite_command(staging_dir), check=True)
+    for thumbnail in thumbnails:
+        os.remove(thumbnail)
+    with open(os.path.join(staging_dir, TRICKPLAY_VTT), 'w') as f:
+        f.write(render_trickplay_vtt(duration, ladder, len(thumbnails)))
 
-    for res in resolutions:
-        output_dir = f'{base}_{res}p'
-        os.makedirs(output_dir, exist_ok=True)
+    shutil.rmtree(get_trickplay_dir(base), ignore_errors=True)
+    os.replace(staging_dir, get_trickplay_dir(base))
+    get_rendition_storage().save_dir(get_trickplay_dir(base))
 
-        output_path = os.path.join(output_dir, 'index.m3u8')
 
-        cmd = [
-            'ffmpeg',
-            '-i', source,
-            '-vf', f'scale=-2:{res}',
-            '-c:v', 'libx264',
-            '-crf', '23',
-            '-preset', 'medium',
-            '-c:a', 'aac',
-            '-b:a', '128k',
-            '-f', 'hls',
-            '-hls_time', '6',                 
-            '-hls_playlist_type', 'vod',        
-            '-hls_segment_filename', os.path.join(output_dir, 'segment_%03d.ts'),
-            output_path
+def fan_out_chunks(video_id, source, base, ladder, duration):
+    """
+        Split the source into chunks and encode every chunk of every video rendition which is not yet published
+        as its own job, each rendition is stitched once its chunks are done and the finalizer runs after all stitches.
+        The audio is cheap to encode and is not chunked
+    """
+    chunks = plan_chunks(duration)
+    chunk_names = [name for name, _, _ in chunks]
+
+    stitch_jobs = []
+    for rung in pending_renditions(base, ladder):
+        if is_audio_rung(rung):
+            stitch_jobs.append(enqueue_transcode(convert_rendition_to_hls, video_id, source, base, rung, duration, ladder))
+            continue
+        chunk_jobs = [
+            enqueue_transcode(encode_chunk, video_id, source, base, name, start, end, rung, len(chunks))
+            for name, start, end in chunks
         ]
+        stitch_jobs.append(
+            enqueue_transcode(stitch_rendition, video_id, base, rung, chunk_names, ladder, depends_on=chunk_jobs)
+        )
+    stitch_jobs.append(enqueue_transcode(generate_trickplay, video_id, source, base, ladder, duration))
+    return enqueue_transcode(finalize_transcode, video_id, base, ladder, depends_on=stitch_jobs)
+
+
+def plan_chunks(duration):
+    """
+        Split the source duration into chunks of about HLS_CHUNK_DURATION seconds cut on the segment grid,
+        after the startup segments at multiples of HLS_SEGMENT_DURATION, so the stitched renditions cut their
+        segments where renditions encoded whole do. No cut is made which leaves less than a segment.
+        Returns (chunk name, start seconds, end seconds) of every chunk
+    """
+    step = settings.HLS_SEGMENT_DURATION
+    cuts = [0]
+    point = startup_span() or step
+    while duration - point >= step:
+        if point - cuts[-1] >= settings.HLS_CHUNK_DURATION:
+            cuts.append(point)
+        point += step
+    cuts.append(duration)
+    return [(f'chunk_{i:04d}', start, end) for i, (start, end) in enumerate(zip(cuts, cuts[1:]))]
 
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Command failed with exit code {e.returncode}")
 
-    
-def delete_hls_files(video_path):
+def encode_chunk(video_id, source, base, name, start, end, rung, chunk_count):
     """
-        Delete files
+        Encode one chunk of one video rendition, read from the source with an accurate seek so it starts
+        exactly at its grid point. Timestamps are shifted to the chunk start so the stitched rendition plays continuously.
+        Progress of the rendition is the share of chunks already encoded,
+        chunks finished by an earlier attempt are not encoded again. Only the first chunk starts with startup segments
     """
-    base, _ = os.path.splitext(video_path)
+    output_dir = os.path.join(get_chunks_dir(base), rung['label'])
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(os.path.join(output_dir, f'{name}.done')):
+        return
+
+    cmd = [
+        'ffmpeg', '-y',
+        '-ss', f'{start:.6f}',
+        '-i', source,
+        '-t', f'{end - start:.6f}',
+        '-map', '0:v:0',
+        '-vf', f"scale=-2:{rung['height']}",
+        *encode_args(rung, threads_per_process()),
+        *keyframe_args(start),
+        '-output_ts_offset', f'{start + CHUNK_TS_LEAD:.6f}',
+        *hls_output_args(output_dir, prefix=f'{name}_', segment_format='mpegts', startup=start == 0)
+    ]
+    run_ffmpeg(cmd)
+
+    open(os.path.join(output_dir, f'{name}.done'), 'w').close()
+    done = len(glob.glob(os.path.join(output_dir, '*.done')))
+    save_progress(video_id, {rung['label']: min(99, int(done / chunk_count * 100))})
 
-    for res in resolutions:
-        dir = f'{base}_{res}p'
-        m3u8_path = os.path.join(dir, 'index.m3u8')
-        ts_pattern = os.path.join(dir, 'segment_*.ts')
 
-        if os.path.exists(m3u8_path):
-            os.remove(m3u8_path)
+def stitch_rendition(video_id, base, rung, chunk_names, ladder):
+    """
+        Move the segments of all chunks into the staging dir with continuous numbering,
+        write one playlist over all of them and publish the rendition as playable.
+        Segments moved by an interrupted attempt are kept so a retry can finish the stitch
+    """
+    if not pending_renditions(base, [rung]):
+        return
+
+    chunk_dir = os.path.join(get_chunks_dir(base), rung['label'])
+    output_dir = get_staging_dir(base, rung['label'])
+    os.makedirs(output_dir, exist_ok=True)
+
+    segments = []
+    for name in chunk_names:
+        with open(os.path.join(chunk_dir, f'{name}_index.m3u8')) as f:
+            chunk_segments = parse_media_playlist(f.read())
+
+        for duration, uri in chunk_segments:
+            segment = f'segment_{len(segments):03d}.ts'
+            if not os.path.exists(os.path.join(output_dir, segment)):
+                os.replace(os.path.join(chunk_dir, uri), os.path.join(output_dir, segment))
+            segments.append((duration, segment))
+
+    with open(os.path.join(output_dir, 'index.m3u8'), 'w') as f:
+        f.write(render_media_playlist(segments))
+    publish_rendition(base, rung['label'])
+    publish_playable(video_id, base, ladder)
+
+
+def finalize_transcode(video_id, base, ladder):
+    """
+        Runs after all rendition jobs, make sure every rendition was published
+        and store the complete ladder on the video and every upload of the same content.
+        Local copies are dropped when a remote rendition storage serves them
+    """
+    missing = [rung['label'] for rung in pending_renditions(base, ladder)]
+    if missing:
+        raise RuntimeError(f'Renditions missing for {base}: {missing}')
+
+    shutil.rmtree(get_chunks_dir(base), ignore_errors=True)
+    publish_playable(video_id, base, ladder)
+    release_local_copies(glob.glob(f'{glob.escape(base)}_*'))
+
+
+def publish_playable(video_id, base, ladder):
+    """
+        Make every rendition published so far playable, the master playlist is rewritten over them
+        and the video is ready as soon as the audio and the first video rendition landed.
+        The row lock orders parallel jobs so the last writer always sees every published rendition
+    """
+    with transaction.atomic():
+        video = Video.objects.select_for_update().get(pk=video_id)
+        complete = [rung for rung in ladder if is_rendition_complete(get_rendition_dir(base, rung['label']))]
+        # Video renditions carry no sound, they only play together with the audio rendition
+        if not video_rungs(complete) or any(is_audio_rung(rung) and rung not in complete for rung in ladder):
+            return []
+
+        measured = {rendition['label']: rendition for rendition in video.renditions}
+        renditions = [measured.get(rung['label']) or measure_rendition(base, rung) for rung in complete]
+
+        write_master_playlist(base, renditions)
+        videos = Video.objects.sharing_content(video_id)
+        videos.update(
+            renditions=renditions,
+            manifest=build_manifest(base),
+            status=Video.Status.READY,
+            progress={**video.progress, **{rendition['label']: 100 for rendition in renditions}}
+        )
+        invalidate_video_locations(videos.values_list('pk', flat=True))
+    return renditions
+
+
+def measure_rendition(base, rung):
+    """
+        Add peak and average bandwidth of the encoded segments and their codecs to a rung
+    """
+    output_dir = get_rendition_dir(base, rung['label'])
+    with open(os.path.join(output_dir, 'index.m3u8')) as f:
+        playlist = f.read()
+    segments = parse_media_playlist(playlist)
+
+    sizes = [
+        byte_range[0] if byte_range else os.path.getsize(os.path.join(output_dir, uri))
+        for (_, uri), byte_range in zip(segments, parse_byte_ranges(playlist))
+    ]
+    total_duration = sum(duration for duration, _ in segments)
+    peak = max((size * 8 / duration for (duration, _), size in zip(segments, sizes) if duration), default=0)
+
+    return dict(
+        rung,
+        bandwidth=math.ceil(peak),
+        average_bandwidth=math.ceil(sum(sizes) * 8 / total_duration) if total_duration else 0,
+        codecs=probe_codecs(os.path.join(output_dir, segments[0][1])) if segments else '',
+    )
+
+
+def write_master_playlist(base, ladder):
+    """
+        Write the master playlist next to the rendition dirs, replaced in one rename
+    """
+    path = get_master_playlist_path(base)
+    with open(f'{path}.partial', 'w') as f:
+        f.write(render_master_playlist(ladder))
+    os.replace(f'{path}.partial', path)
+    get_rendition_storage().save_file(path)
+
+
+def build_manifest(base):
+    """
+        Every published file of a video with its size, keyed by the path relative to MEDIA_ROOT.
+        Staging dirs and the chunks of the chunked mode are working files and not part of it
+    """
+    manifest = {}
+    for path in sorted(glob.glob(f'{glob.escape(base)}_*')):
+        if path.endswith('.partial') or path == get_chunks_dir(base):
+            continue
+        files = [path] if os.path.isfile(path) else [
+            os.path.join(root, name) for root, _, names in os.walk(path) for name in sorted(names)
+        ]
+        for file in files:
+            manifest[os.path.relpath(file, settings.MEDIA_ROOT)] = os.path.getsize(file)
+    return manifest
+
+
+def delete_hls_files(base, labels=None):
+    """
+        Delete files of the renditions a video produced from the rendition storage and the local
+        working files of its transcode, used for videos transcoded before they had a manifest.
+        Jobs enqueued before the ladder was tracked pass the path of the source without labels,
+        their renditions are the ones of the default ladder next to it
+    """
+    if labels is None:
+        base = os.path.splitext(base)[0]
+        labels = [f"{rung['height']}p" for rung in settings.HLS_LADDER]
 
-        ts_files = glob.glob(ts_pattern)
-        for ts in ts_files:
-            os.remove(ts)
+    storage = get_rendition_storage()
+    prefix = storage_name(base)
+    names = [name for label in [*labels, 'trickplay'] for name in storage.list(f'{prefix}_{label}')]
+    storage.delete([*names, storage_name(get_master_playlist_path(base))])
 
-        if os.path.exists(dir) and not os.listdir(dir):
-            os.rmdir(dir)
\ No newline at end of file
+    for label in [*labels, 'trickplay']:
+        shutil.rmtree(get_staging_dir(base, label), ignore_errors=True)
+    shutil.rmtree(get_chunks_dir(base), ignore_errors=True)
@@ -1,18 +1,84 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
 from django.urls import reverse
+from django.test import AsyncRequestFactory, SimpleTestCase, override_settings
 from rest_framework.test import APITestCase, APIClient
-from unittest.mock import patch
-from content_app.models import Video
+from unittest.mock import Mock, patch
+import base64
+import fcntl
+import importlib
+import glob
+import re
+import hashlib
+import io
+import json
+
+from django.core.management import call_command
+
+from content_app.models import ContentClaim, Video, VideoUpload
+from content_app.uploads import open_upload_file, write_chunk
+from content_app.tasks import (
+    build_serial_commands, build_single_pass_command, fan_out_renditions, finalize_transcode,
+    plan_chunks, encode_chunk, stitch_rendition, measure_rendition,
+    convert_resolutions_to_hls, is_rendition_complete, get_rendition_dir, get_trickplay_dir, generate_trickplay,
+    get_master_playlist_path, publish_playable, encode_ladder, get_staging_dir, publish_rendition, convert_rendition_to_hls,
+    keyframe_args, delete_hls_files
+)
+from content_app.trickplay import render_trickplay_vtt
+from content_app.encoding import build_ladder, probe_video, video_rungs
+from content_app.playlists import (
+    parse_media_playlist, parse_byte_ranges, render_media_playlist, render_master_playlist, sign_media_playlist
+)
+from content_app.progress import ProgressReporter
+from content_app.tasks import claim_content, mark_transcode_failed, transcode_video, record_transcode_cpu
+from content_app import governor
+from content_app.rendition_storage import FileStat, LocalRenditionStorage, S3RenditionStorage, get_rendition_storage
+from content_app.authentication import ClaimsUser, CookieJWTAuthentication, get_token_version, token_version_key
+from auth_app.api.serializers import LoginSerializer
+from rest_framework_simplejwt.tokens import AccessToken
+from content_app.api import async_views
+from content_app.segment_tokens import check_segment_token, sign_segment_token
+from content_app.locations import get_video_location, has_rendition, local_locations
+from content_app.segment_cache import (
+    SegmentCache, SharedSegmentCache, generation_key, get_segment_cache, get_segment_generation, invalidate_segments
+)
+from content_app.storage import collect_garbage_batch, collect_rendition_garbage, delete_manifest_files, storage_report
+from django.apps import apps as django_apps
 from django.contrib.auth import get_user_model
 from rest_framework import status
 
 User = get_user_model()
 
+SOURCE_PROBE = {'width': 1920, 'height': 1080, 'fps': 25, 'duration': 60, 'bitrate': 8000, 'has_audio': True}
+
 class HLSViewsTests(APITestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='test@example.com', email='test@example.com', password='testpass123')
         self.client = APIClient()
         self.client.force_authenticate(user=self.user)
-        self.video = Video.objects.create(title='Sample Video', video_file='videos/sample.mp4') 
+        self.video = Video.objects.create(title='Sample Video', video_file='videos/sample.mp4', renditions=build_ladder(SOURCE_PROBE)) 
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+
+    def segment_url(self, segment, resolution='720p'):
+        url = reverse('HSL-segment', kwargs={'pk': self.video.id, 'resolution': resolution, 'segment': segment})
+        return f'{url}?token={sign_segment_token(self.video.id, resolution)}'
+
+    def write_media_file(self, name, data=bytes(range(100))):
+        path = os.path.join(self.media, 'videos', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        return path
     
     def test_video_list_view_authenticated(self):
         url = reverse('video-list')
@@ -22,27 +88,1510 @@ class HLSViewsTests(APITestCase):
         titles = [video['title'] for video in response.data]
         self.assertIn('Sample Video', titles)
 
+    def test_video_list_view_playable_filter(self):
+        Video.objects.create(title='Still Transcoding', status=Video.Status.TRANSCODING, progress={'480p': 40})
+        self.video.status = Video.Status.READY
+        self.video.save()
+
+        response = self.client.get(reverse('video-list'))
+        self.assertEqual(len(response.data), 2)
+
+        response = self.client.get(reverse('video-list'), {'playable': 'true'})
+        self.assertEqual([video['title'] for video in response.data], ['Sample Video'])
+        self.assertEqual(response.data[0]['status'], 'READY')
+
     def test_video_list_view_unauthenticated(self):
         self.client.force_authenticate(user=None)
         url = reverse('video-list')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
-    @patch("os.path.exists", return_value=True)
-    @patch("builtins.open", create=True)
-    def test_hls_playlist_view_success(self, mock_open, mock_exists):
+    @patch.object(LocalRenditionStorage, 'stat', return_value=FileStat(10, 1700000000))
+    @patch.object(LocalRenditionStorage, 'read_text', return_value=render_media_playlist([(6.0, 'segment_000.ts')]))
+    def test_hls_playlist_view_success(self, mock_read_text, mock_stat):
         url = reverse('HSL-playlist', kwargs={'pk': self.video.id, 'resolution': '720p'})
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
 
+        uri = parse_media_playlist(response.content.decode())[0][1]
+        segment, _, token = uri.partition('/?token=')
+        self.assertEqual(segment, 'segment_000.ts')
+        self.assertTrue(check_segment_token(token, self.video.id, '720p'))
+        self.assertFalse(check_segment_token(token, self.video.id, '1080p'))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_segment_token_is_checked_without_session(self):
+        self.write_media_file('sample_720p/segment_000.ts', b'segment')
+
+        self.client.force_authenticate(user=None)
+        url = reverse('HSL-segment', kwargs={'pk': self.video.id, 'resolution': '720p', 'segment': 'segment_000.ts'})
+        other_rendition = sign_segment_token(self.video.id, '480p')
+        expired = sign_segment_token(self.video.id, '720p', now=time.time() - 2 * settings.HLS_SEGMENT_TOKEN_TTL)
+        with self.settings(MEDIA_ROOT=self.media):
+            self.assertEqual(self.client.get(self.segment_url('segment_000.ts')).status_code, status.HTTP_200_OK)
+            for token in ('', 'garbage', other_rendition, expired, other_rendition.split('.')[0] + '.' + expired.split('.')[1]):
+                self.assertEqual(self.client.get(f'{url}?token={token}').status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_sign_media_playlist_points_uris_at_segment_route(self):
+        playlist = '#EXTM3U\n#EXT-X-MAP:URI="rendition.mp4",BYTERANGE="100@0"\n#EXTINF:6.000000,\n#EXT-X-BYTERANGE:50@100\nrendition.mp4\n#EXT-X-ENDLIST\n'
+        self.assertEqual(sign_media_playlist(playlist, 'abc').splitlines(), [
+            '#EXTM3U',
+            '#EXT-X-MAP:URI="rendition.mp4/?token=abc",BYTERANGE="100@0"',
+            '#EXTINF:6.000000,',
+            '#EXT-X-BYTERANGE:50@100',
+            'rendition.mp4/?token=abc',
+            '#EXT-X-ENDLIST',
+        ])
+
     @patch("os.path.exists", return_value=False)
     def test_hls_playlist_view_file_not_found(self, mock_exists):
         url = reverse('HSL-playlist', kwargs={'pk': self.video.id, 'resolution': '720p'})
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_hls_playlist_view_resolution_not_in_ladder(self):
+        url = reverse('HSL-playlist', kwargs={'pk': self.video.id, 'resolution': '2160p'})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch.object(LocalRenditionStorage, 'stat', return_value=FileStat(10, 1700000000))
+    @patch("builtins.open", create=True)
+    def test_hls_master_playlist_view_success(self, mock_open, mock_stat):
+        url = reverse('HSL-master-playlist', kwargs={'pk': self.video.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.apple.mpegurl')
+
+    @patch("os.path.exists", return_value=False)
+    def test_hls_master_playlist_view_file_not_found(self, mock_exists):
+        url = reverse('HSL-master-playlist', kwargs={'pk': self.video.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_hls_segment_view_serves_byte_range(self):
+        self.write_media_file('sample_720p/rendition.mp4')
+
+        url = self.segment_url('rendition.mp4')
+        with self.settings(MEDIA_ROOT=self.media):
+            response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(response['Content-Type'], 'video/mp4')
+            self.assertEqual(response['Content-Range'], 'bytes 10-19/100')
+            self.assertEqual(b''.join(response.streaming_content), bytes(range(10, 20)))
+
+            response = self.client.get(url, HTTP_RANGE='bytes=100-')
+            self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_hls_segment_view_only_serves_segment_names(self):
+        self.write_media_file('sample_720p/index.m3u8', render_media_playlist([(6.0, 'segment_000.ts')]))
+        os.makedirs(os.path.join(self.media, 'videos', 'sample_720p', 'segment_001.ts'))
+
+        with self.settings(MEDIA_ROOT=self.media):
+            for name in ['..', '.', 'index.m3u8', 'segment_0.ts', 'rendition.mp4.partial']:
+                self.assertEqual(self.client.get(self.segment_url(name)).status_code, status.HTTP_404_NOT_FOUND)
+            # A directory with a segment name is missing like any other segment
+            self.assertEqual(self.client.get(self.segment_url('segment_001.ts')).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_hls_segment_view_conditional_get_and_caching(self):
+        segment_path = self.write_media_file('sample_720p/segment_000.ts')
+        os.utime(segment_path, (1700000000, 1700000000))
+
+        url = self.segment_url('segment_000.ts')
+        with self.settings(MEDIA_ROOT=self.media):
+            response = self.client.get(url)
+            etag, last_modified = response['ETag'], response['Last-Modified']
+            self.assertEqual(etag, f'"{1700000000:x}-64"')
+            self.assertEqual(last_modified, 'Tue, 14 Nov 2023 22:13:20 GMT')
+            self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+
+            with patch("builtins.open") as mock_open:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+                self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, status.HTTP_304_NOT_MODIFIED)
+                mock_open.assert_not_called()
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"other"').status_code, status.HTTP_200_OK)
+
+            response = self.client.get(url, HTTP_RANGE='bytes=90-', HTTP_IF_RANGE=etag)
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join(response.streaming_content), bytes(range(90, 100)))
+            response = self.client.get(url, HTTP_RANGE='bytes=-5', HTTP_IF_RANGE=last_modified)
+            self.assertEqual(response['Content-Range'], 'bytes 95-99/100')
+            response = self.client.get(url, HTTP_RANGE='bytes=90-', HTTP_IF_RANGE='"stale"')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_playlist_cache_control_follows_transcode_progress(self):
+        for name in ('sample_master.m3u8', 'sample_720p/index.m3u8'):
+            self.write_media_file(name, '#EXTM3U\n')
+
+        master = reverse('HSL-master-playlist', kwargs={'pk': self.video.id})
+        playlist = reverse('HSL-playlist', kwargs={'pk': self.video.id, 'resolution': '720p'})
+        with self.settings(MEDIA_ROOT=self.media):
+            self.video.progress = {'480p': 100, '720p': 40}
+            self.video.save()
+            self.assertEqual(self.client.get(master)['Cache-Control'], 'private, no-cache')
+            self.assertEqual(self.client.get(playlist)['Cache-Control'], 'private, max-age=300')
+
+            self.video.progress = {'480p': 100, '720p': 100}
+            self.video.save()
+            self.assertEqual(self.client.get(master)['Cache-Control'], 'private, max-age=300')
+
+    def test_hls_segment_view_offloads_to_reverse_proxy(self):
+        segment_path = self.write_media_file('sample_720p/segment_000.ts', b'segment')
+
+        url = self.segment_url('segment_000.ts')
+        with self.settings(MEDIA_ROOT=self.media, HLS_OFFLOAD='x-accel-redirect'):
+            response = self.client.get(url, HTTP_RANGE='bytes=0-3')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['X-Accel-Redirect'], '/protected-media/videos/sample_720p/segment_000.ts')
+            self.assertEqual(response['Content-Type'], 'video/MP2T')
+            self.assertEqual(response.content, b'')
+
+            missing = self.segment_url('segment_001.ts')
+            self.assertEqual(self.client.get(missing).status_code, status.HTTP_404_NOT_FOUND)
+
+        with self.settings(MEDIA_ROOT=self.media, HLS_OFFLOAD='x-sendfile'):
+            self.assertEqual(self.client.get(url)['X-Sendfile'], segment_path)
+
+        with self.settings(MEDIA_ROOT=self.media, HLS_OFFLOAD=''):
+            response = self.client.get(url)
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(b''.join(response.streaming_content), b'segment')
+
+    def test_hls_segment_view_does_not_query_database_once_cached(self):
+        self.write_media_file('sample_720p/segment_000.ts', b'segment')
+
+        url = self.segment_url('segment_000.ts')
+        with self.settings(MEDIA_ROOT=self.media):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+            with self.assertNumQueries(0):
+                self.assertEqual(b''.join(self.client.get(url).streaming_content), b'segment')
+
+            local_locations.clear()
+            with self.assertNumQueries(0):
+                self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_hls_segment_view_serves_hot_segments_from_cache(self):
+        self.write_media_file('sample_720p/segment_000.ts')
+
+        url = self.segment_url('segment_000.ts')
+        with self.settings(MEDIA_ROOT=self.media, HLS_SEGMENT_CACHE_BUDGET=1024 * 1024):
+            response = self.client.get(url)
+            self.assertEqual(response['X-Cache'], 'MISS')
+            etag = response['ETag']
+            with patch("builtins.open") as mock_open:
+                response = self.client.get(url)
+                self.assertEqual(response['X-Cache'], 'HIT')
+                self.assertEqual(b''.join(response.streaming_content), bytes(range(100)))
+                response = self.client.get(url, HTTP_RANGE='bytes=90-')
+                self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+                self.assertEqual(b''.join(response.streaming_content), bytes(range(90, 100)))
+                mock_open.assert_not_called()
+            self.assertEqual(response['ETag'], etag)
+
+            # A transcode again replaces the files and moves the segments to a new generation
+            generation = get_video_location(self.video.pk)['generation']
+            self.write_media_file('sample_720p/segment_000.ts', b'transcoded again')
+            invalidate_segments('videos/sample')
+            self.assertEqual(get_video_location(self.video.pk, refresh=True)['generation'], generation + 1)
+            response = self.client.get(url)
+            self.assertEqual(response['X-Cache'], 'MISS')
+            self.assertEqual(b''.join(response.streaming_content), b'transcoded again')
+
+            stats = get_segment_cache().stats()
+            self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 1))
+            self.client.force_authenticate(user=User.objects.create_user(username='admin', password='pass', is_staff=True))
+            response = self.client.get(reverse('segment-cache-stats'))
+            self.assertEqual(response.data['hit_ratio'], 0.5)
+
+            self.video.delete()
+            self.assertEqual(get_segment_cache().stats()['entries'], 0)
+
+    def test_video_location_is_invalidated_on_save_and_delete(self):
+        self.assertEqual(get_video_location(self.video.pk)['renditions'], ['480p', '720p', '1080p', 'audio'])
+
+        self.video.renditions = [{'label': '480p'}]
+        self.video.progress = {'480p': 100, '720p': 0}
+        self.video.save()
+        self.assertEqual(get_video_location(self.video.pk)['renditions'], ['480p'])
+
+        Video.objects.filter(pk=self.video.pk).update(renditions=[{'label': '480p'}, {'label': '720p'}])
+        location = get_video_location(self.video.pk)
+        self.assertTrue(has_rendition(self.video.pk, location, '720p'))
+        self.assertEqual(get_video_location(self.video.pk)['renditions'], ['480p', '720p'])
+
+        video_id = self.video.pk
+        self.video.delete()
+        self.assertIsNone(get_video_location(video_id))
+
+    def test_labels_outside_the_ladder_are_not_looked_up(self):
+        Video.objects.filter(pk=self.video.pk).update(renditions=[{'label': '480p'}], progress={'480p': 100, '720p': 0})
+        location = get_video_location(self.video.pk)
+        with self.assertNumQueries(0):
+            for label in ['2160p', 'garbage', '..']:
+                self.assertFalse(has_rendition(self.video.pk, location, label))
+        with self.assertNumQueries(1):
+            self.assertFalse(has_rendition(self.video.pk, location, '720p'))
+
+    async def test_async_views_stream_segments_and_sign_playlists(self):
+        self.write_media_file('sample_720p/segment_000.ts')
+        self.write_media_file('sample_720p/index.m3u8', render_media_playlist([(6.0, 'segment_000.ts')]))
+
+        factory = AsyncRequestFactory()
+        segment = {'pk': self.video.id, 'resolution': '720p', 'segment': 'segment_000.ts'}
+        token = sign_segment_token(self.video.id, '720p')
+        with self.settings(MEDIA_ROOT=self.media, HLS_SEGMENT_CACHE_BUDGET=0), patch('content_app.rendition_storage.CHUNK_SIZE', 16):
+            response = await async_views.hls_segment(factory.get('/', {'token': token}), **segment)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Length'], '100')
+            self.assertEqual(response['Cache-Control'], 'private, max-age=31536000, immutable')
+            chunks = [chunk async for chunk in response.streaming_content]
+            self.assertEqual(max(map(len, chunks)), 16)
+            self.assertEqual(b''.join(chunks), bytes(range(100)))
+
+            response = await async_views.hls_segment(factory.get('/', {'token': token}, headers={'Range': 'bytes=10-19'}), **segment)
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), bytes(range(10, 20)))
+
+            etag = response['ETag']
+            response = await async_views.hls_segment(factory.get('/', {'token': token}, headers={'If-None-Match': etag}), **segment)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+            response = await async_views.hls_segment(factory.get('/', {'token': 'garbage'}), **segment)
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+            for name in ['segment_001.ts', '..', 'index.m3u8']:
+                response = await async_views.hls_segment(factory.get('/', {'token': token}), **dict(segment, segment=name))
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+            request = factory.get('/')
+            response = await async_views.hls_playlist(request, pk=self.video.id, resolution='720p')
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+            token = await sync_to_async(LoginSerializer.get_token)(self.user)
+            request.COOKIES['access_token'] = str(token.access_token)
+            response = await async_views.hls_playlist(request, pk=self.video.id, resolution='720p')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            uri = parse_media_playlist(response.content.decode())[0][1]
+            self.assertEqual(uri, f"segment_000.ts/?token={sign_segment_token(self.video.id, '720p')}")
+
+            response = await async_views.hls_playlist(request, pk=self.video.id, resolution='2160p')
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @patch.object(LocalRenditionStorage, 'stat', return_value=FileStat(10, 1700000000))
+    @patch("builtins.open", create=True)
+    def test_trickplay_view_serves_vtt_only_known_files(self, mock_open, mock_stat):
+        response = self.client.get(reverse('trickplay', kwargs={'pk': self.video.id, 'filename': 'trickplay.vtt'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/vtt')
+
+        response = self.client.get(reverse('trickplay', kwargs={'pk': self.video.id, 'filename': 'index.m3u8'}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_hls_playlist_video_not_found(self):
         url = reverse('HSL-playlist', kwargs={'pk': 999, 'resolution': '720p'})
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SegmentCacheTests(SimpleTestCase):
+    def key(self, segment, base='videos/sample'):
+        return (base, 0, '720p', segment)
+
+    def test_cache_is_off_unless_a_budget_is_set(self):
+        self.assertEqual(settings.HLS_SEGMENT_CACHE_BUDGET, 0)
+        self.assertIsNone(get_segment_cache())
+
+    def test_lru_evicts_least_recently_used_within_budget(self):
+        segment_cache = SegmentCache(25, 'lru')
+        for segment in ('a', 'b'):
+            self.assertTrue(segment_cache.put(self.key(segment), segment.encode() * 10, FileStat(10, 0)))
+        self.assertIsNotNone(segment_cache.get(self.key('a')))
+        self.assertTrue(segment_cache.put(self.key('c'), b'c' * 10, FileStat(10, 0)))
+
+        self.assertIsNone(segment_cache.get(self.key('b')))
+        self.assertEqual(segment_cache.get(self.key('a')).data, b'a' * 10)
+        self.assertFalse(segment_cache.put(self.key('huge'), b'h' * 26, FileStat(26, 0)))
+        stats = segment_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['bytes']), (2, 1, 1, 20))
+
+        segment_cache.invalidate('videos/sample')
+        self.assertEqual(segment_cache.stats()['entries'], 0)
+
+    def test_tinylfu_keeps_hot_segments_from_one_off_requests(self):
+        segment_cache = SegmentCache(20, 'tinylfu')
+        for segment in ('hot', 'warm'):
+            for _ in range(3):
+                segment_cache.get(self.key(segment))
+            segment_cache.put(self.key(segment), b'x' * 10, FileStat(10, 0))
+
+        segment_cache.get(self.key('once'))
+        self.assertFalse(segment_cache.put(self.key('once'), b'x' * 10, FileStat(10, 0)))
+        self.assertIsNotNone(segment_cache.get(self.key('hot')))
+        self.assertEqual(segment_cache.stats()['rejections'], 1)
+
+        for _ in range(5):
+            segment_cache.get(self.key('rising'))
+        self.assertTrue(segment_cache.put(self.key('rising'), b'x' * 10, FileStat(10, 0)))
+        self.assertIsNone(segment_cache.get(self.key('warm')))
+
+    def test_shared_cache_maps_segments_of_other_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        worker, other_worker = SharedSegmentCache(40, 'lru', directory), SharedSegmentCache(40, 'lru', directory)
+
+        self.assertTrue(worker.put(self.key('a'), b'a' * 10, FileStat(10, 1700000000.5)))
+        entry = other_worker.get(self.key('a'))
+        self.assertEqual(bytes(entry.data), b'a' * 10)
+        self.assertEqual(entry.stat, FileStat(10, 1700000000.5))
+
+        # Files are 16 byte headers and 10 byte segments, the older one goes first
+        os.utime(os.path.join(directory, worker.ident(self.key('a'))), (1, 1))
+        other_worker.put(self.key('b', base='videos/other'), b'b' * 10, FileStat(10, 0))
+        self.assertIsNone(worker.get(self.key('a')))
+        self.assertEqual(worker.stats()['entries'], 1)
+
+        worker.invalidate('videos/other')
+        self.assertIsNone(other_worker.get(self.key('b', base='videos/other')))
+        self.assertEqual(other_worker.stats()['bytes'], 0)
+
+    def test_workers_sharing_a_directory_evict_and_store_one_at_a_time(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        worker, other_worker = SharedSegmentCache(40, 'lru', directory), SharedSegmentCache(40, 'lru', directory)
+        store = SharedSegmentCache.store
+
+        def store_while_other_worker_tries(cache_self, ident, data, stat):
+            # Another process's flock of the lock file can't be taken while a put runs
+            with open(os.path.join(directory, SharedSegmentCache.LOCK_NAME)) as lock_file:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            store(cache_self, ident, data, stat)
+
+        with patch.object(SharedSegmentCache, 'store', store_while_other_worker_tries):
+            self.assertTrue(worker.put(self.key('a'), b'a' * 10, FileStat(10, 0)))
+        self.assertEqual(other_worker.stats()['entries'], 1)
+
+
+class ClaimsUserAuthenticationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='claims@example.com', email='claims@example.com', password='testpass123', is_staff=True)
+        # The cached token version outlives the rolled back user, only its key is dropped so other cached data stays
+        cache.delete(token_version_key(self.user.pk))
+        self.addCleanup(cache.delete, token_version_key(self.user.pk))
+        self.client = APIClient()
+        self.client.cookies['access_token'] = str(LoginSerializer.get_token(self.user).access_token)
+        Video.objects.create(title='Sample Video', video_file='videos/sample.mp4')
+
+    def test_claims_user_saves_the_user_query(self):
+        with self.settings(JWT_CLAIMS_USER=False), self.assertNumQueries(2):
+            self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_200_OK)
+        with self.settings(JWT_CLAIMS_USER=True), self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_200_OK)
+
+    @override_settings(JWT_CLAIMS_USER=True)
+    def test_claims_user_carries_token_claims(self):
+        request = Mock(COOKIES={'access_token': self.client.cookies['access_token'].value}, parser_context={})
+        user, _ = CookieJWTAuthentication().authenticate(request)
+        self.assertIsInstance(user, ClaimsUser)
+        self.assertEqual((user.id, user.email, user.is_staff), (self.user.id, 'claims@example.com', True))
+
+    @override_settings(JWT_CLAIMS_USER=True)
+    def test_views_which_need_the_model_user_load_it(self):
+        with self.assertNumQueries(2):
+            response = self.client.head(reverse('video-upload', kwargs={'pk': uuid4()}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(JWT_CLAIMS_USER=True)
+    def test_tokens_without_claims_resolve_the_user_from_the_database(self):
+        self.client.cookies['access_token'] = str(AccessToken.for_user(self.user))
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_200_OK)
+
+    @override_settings(JWT_CLAIMS_USER=True)
+    def test_deactivation_and_password_change_revoke_tokens(self):
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.user.is_active = True
+        self.user.save()
+        self.client.cookies['access_token'] = str(LoginSerializer.get_token(self.user).access_token)
+        self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_200_OK)
+
+        self.user.set_password('newpass123')
+        self.user.save()
+        self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(JWT_CLAIMS_USER=True)
+    def test_revocations_survive_losing_the_cache(self):
+        self.user.set_password('newpass123')
+        self.user.save()
+        cache.delete(token_version_key(self.user.pk))
+        self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(cache.get(token_version_key(self.user.pk)), 1)
+
+    @patch('content_app.authentication.get_token_version')
+    def test_token_version_is_only_checked_for_claims_users(self, mock_get_token_version):
+        with self.settings(JWT_CLAIMS_USER=False):
+            self.assertEqual(self.client.get(reverse('video-list')).status_code, status.HTTP_200_OK)
+        mock_get_token_version.assert_not_called()
+
+    def test_saves_which_keep_the_claims_keep_tokens(self):
+        version = get_token_version(self.user.pk)
+        self.user.first_name = 'Claims'
+        self.user.save()
+        self.user.save(update_fields=['last_login'])
+        self.assertEqual(get_token_version(self.user.pk), version)
+
+
+class VideoUploadTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media_root = self.settings(MEDIA_ROOT=self.media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+        self.user = User.objects.create_user(username='admin@example.com', email='admin@example.com', password='testpass123', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.data = os.urandom(3000)
+
+    def create_upload(self, filename='clip.mp4'):
+        metadata = f"filename {base64.b64encode(filename.encode()).decode()},title {base64.b64encode(b'Clip').decode()}"
+        return self.client.post(reverse('video-upload-create'), HTTP_UPLOAD_LENGTH=str(len(self.data)), HTTP_UPLOAD_METADATA=metadata)
+
+    def send_chunk(self, location, offset, chunk, checksum=None):
+        headers = {'HTTP_UPLOAD_OFFSET': str(offset)}
+        if checksum:
+            headers['HTTP_UPLOAD_CHECKSUM'] = f'sha256 {base64.b64encode(checksum).decode()}'
+        return self.client.generic('PATCH', location, chunk, content_type='application/offset+octet-stream', **headers)
+
+    @patch('content_app.signals.enqueue_after_commit')
+    def test_chunks_are_appended_and_video_created_on_completion(self, mock_enqueue):
+        location = self.create_upload()['Location']
+
+        response = self.send_chunk(location, 0, self.data[:1000], hashlib.sha256(self.data[:1000]).digest())
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.client.head(location)['Upload-Offset'], '1000')
+        self.assertFalse(Video.objects.exists())
+
+        response = self.send_chunk(location, 1000, self.data[1000:])
+        self.assertEqual(response['Upload-Offset'], '3000')
+
+        upload = VideoUpload.objects.get()
+        self.assertEqual(upload.video.title, 'Clip')
+        self.assertEqual(upload.video.video_file.name, upload.file_name)
+        with open(upload.get_path(), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_wrong_offset_conflicts(self):
+        location = self.create_upload()['Location']
+        response = self.send_chunk(location, 500, self.data[500:1000])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '0')
+
+    def test_checksum_mismatch_discards_chunk(self):
+        location = self.create_upload()['Location']
+        response = self.send_chunk(location, 0, self.data[:1000], hashlib.sha256(b'other').digest())
+        self.assertEqual(response.status_code, 460)
+        self.assertEqual(VideoUpload.objects.get().offset, 0)
+        self.assertEqual(os.path.getsize(VideoUpload.objects.get().get_path()), 0)
+
+    def test_chunk_without_content_length_is_rejected(self):
+        location = self.create_upload()['Location']
+        response = self.client.generic('PATCH', location, content_type='application/offset+octet-stream', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(response.status_code, status.HTTP_411_LENGTH_REQUIRED)
+
+    def test_chunk_for_an_upload_being_written_is_locked(self):
+        location = self.create_upload()['Location']
+        with open_upload_file(VideoUpload.objects.get().get_path()):
+            response = self.send_chunk(location, 0, self.data[:1000])
+        self.assertEqual(response.status_code, status.HTTP_423_LOCKED)
+        self.assertEqual(self.send_chunk(location, 0, self.data[:1000]).status_code, status.HTTP_204_NO_CONTENT)
+
+    def test_offset_moved_while_writing_conflicts(self):
+        location = self.create_upload()['Location']
+
+        def write_and_move_offset(f, offset, stream, length, checksum):
+            VideoUpload.objects.update(offset=500)
+            return write_chunk(f, offset, stream, length, checksum)
+
+        with patch('content_app.api.views.write_chunk', side_effect=write_and_move_offset):
+            response = self.send_chunk(location, 0, self.data[:1000])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '500')
+
+    def test_unsupported_extension_rejected(self):
+        self.assertEqual(self.create_upload('clip.exe').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_non_staff_cannot_upload(self):
+        self.client.force_authenticate(user=User.objects.create_user(username='user@example.com', password='testpass123'))
+        self.assertEqual(self.create_upload().status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TranscodeCommandTests(SimpleTestCase):
+    def setUp(self):
+        self.ladder = build_ladder(SOURCE_PROBE)
+
+    def test_single_pass_command_includes_trickplay_branch(self):
+        cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', self.ladder, trickplay=True)
+        filter_graph = cmd[cmd.index('-filter_complex') + 1]
+        self.assertIn('split=4[s480p][s720p][s1080p][strickplay]', filter_graph)
+        self.assertIn('[strickplay]scale=160:90[vtrickplay]', filter_graph)
+        self.assertEqual(cmd[-1], '/media/videos/sample_trickplay.partial/thumbnail_%05d.jpg')
+        self.assertEqual(cmd[cmd.index('[vtrickplay]') + 1:][:2], ['-r', '1/10'])
+
+    def test_trickplay_vtt_points_at_tiles(self):
+        lines = render_trickplay_vtt(1005, self.ladder, thumbnail_count=102).splitlines()
+        self.assertEqual(lines[:4], ['WEBVTT', '', '00:00:00.000 --> 00:00:10.000', 'sprite_000.jpg#xywh=0,0,160,90'])
+        self.assertIn('sprite_000.jpg#xywh=160,90,160,90', lines)
+        self.assertEqual(lines[-2:], ['00:16:40.000 --> 00:16:45.000', 'sprite_001.jpg#xywh=0,0,160,90'])
+
+    def test_single_pass_command_decodes_source_once(self):
+        cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+        self.assertEqual(cmd.count('-i'), 1)
+        self.assertIn('[0:v]split=3[s480p][s720p][s1080p]', cmd[cmd.index('-filter_complex') + 1])
+        for rung in self.ladder:
+            self.assertIn(f"/media/videos/sample_{rung['label']}.partial/index.m3u8", cmd)
+        for rung in video_rungs(self.ladder):
+            self.assertIn(f"[v{rung['label']}]", cmd)
+
+    def test_audio_is_encoded_once_into_its_own_rendition(self):
+        cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+        self.assertEqual(cmd.count('-c:a'), 1)
+        self.assertEqual(cmd.count('-c:v'), 3)
+        audio_output = cmd[cmd.index('0:a:0'):]
+        self.assertEqual(audio_output[-1], '/media/videos/sample_audio.partial/index.m3u8')
+        self.assertNotIn('-c:v', audio_output)
+
+        *video_commands, audio_command = build_serial_commands('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+        self.assertTrue(all('-c:a' not in cmd and '0:v:0' in cmd for cmd in video_commands))
+        self.assertIn('0:a:0', audio_command)
+        self.assertNotIn('-c:v', audio_command)
+
+    def test_serial_commands_one_per_resolution(self):
+        commands = build_serial_commands('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+        self.assertEqual(len(commands), len(self.ladder))
+        self.assertEqual(commands[0][-1], '/media/videos/sample_480p.partial/index.m3u8')
+        self.assertIn('1400k', commands[0])
+
+
+    def test_video_outputs_force_keyframes_at_startup_segment_boundaries(self):
+        cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+        self.assertEqual(cmd.count('-force_key_frames'), 3)
+        expression = cmd[cmd.index('-force_key_frames') + 1]
+        self.assertEqual(expression, 'expr:if(lt(n_forced,3),gte(t,n_forced*2),gte(t,6+(n_forced-3)*6))')
+        self.assertEqual(cmd[cmd.index('-sc_threshold') + 1], '0')
+
+        audio_output = cmd[cmd.index('0:a:0'):]
+        self.assertEqual(audio_output[audio_output.index('-hls_time') + 1], '6')
+        self.assertNotIn('-force_key_frames', audio_output)
+        self.assertEqual(cmd[cmd.index('-hls_time') + 1], '2')
+
+        with self.settings(HLS_STARTUP_SEGMENTS=0):
+            cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', self.ladder)
+            self.assertEqual(cmd[cmd.index('-force_key_frames') + 1], 'expr:gte(t,n_forced*6)')
+            self.assertEqual(cmd[cmd.index('-hls_time') + 1], '6')
+
+        # Chunks keep to the grid of the whole source, one starting off the grid at 7 s cuts next at 12 s
+        self.assertEqual(keyframe_args(12)[1], 'expr:gte(t+12,12+n_forced*6)')
+        self.assertEqual(keyframe_args(7)[1], 'expr:gte(t+7,6+n_forced*6)')
+
+
+class EncodingLadderTests(SimpleTestCase):
+    def test_ladder_never_upscales(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, width=854, height=480))
+        self.assertEqual([rung['label'] for rung in ladder], ['480p', 'audio'])
+
+    def test_small_source_keeps_its_own_height(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, width=640, height=361))
+        self.assertEqual([rung['label'] for rung in ladder], ['360p', 'audio'])
+
+    def test_silent_source_has_no_audio_rung(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, has_audio=False))
+        self.assertEqual([rung['label'] for rung in ladder], ['480p', '720p', '1080p'])
+
+    def test_bitrate_capped_at_source_bitrate(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, bitrate=2000))
+        self.assertEqual([rung['video_bitrate'] for rung in video_rungs(ladder)], [1400, 2000, 2000])
+
+    def test_max_fps_only_applies_above_source_rate(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, fps=60), ladder=[{'height': 720, 'video_bitrate': 2800, 'max_fps': 30}])
+        self.assertEqual(ladder[0]['fps'], 30)
+        ladder = build_ladder(SOURCE_PROBE, ladder=[{'height': 720, 'video_bitrate': 2800, 'max_fps': 30}])
+        self.assertIsNone(ladder[0]['fps'])
+
+    @override_settings(HLS_STARTUP_RUNG={'height': 240, 'video_bitrate': 400})
+    def test_startup_rung_joins_below_the_ladder(self):
+        ladder = build_ladder(SOURCE_PROBE)
+        self.assertEqual([rung['label'] for rung in ladder], ['240p', '480p', '720p', '1080p', 'audio'])
+        self.assertEqual(ladder[0]['video_bitrate'], 400)
+
+        ladder = build_ladder(SOURCE_PROBE, ladder=[{'height': 144, 'video_bitrate': 200}])
+        self.assertEqual([rung['label'] for rung in ladder], ['144p', 'audio'])
+
+    @patch('content_app.encoding.subprocess.run')
+    def test_probe_video_reads_ffprobe_json(self, mock_run):
+        mock_run.return_value.stdout = (
+            '{"streams": [{"codec_type": "video", "width": 1280, "height": 720, "avg_frame_rate": "30000/1001"},'
+            ' {"codec_type": "audio"}], "format": {"duration": "12.5", "bit_rate": "3000000"}}'
+        )
+        probe = probe_video('/media/videos/sample.mp4')
+        self.assertEqual((probe['width'], probe['height'], probe['bitrate']), (1280, 720, 3000))
+        self.assertAlmostEqual(probe['fps'], 29.97, places=2)
+        self.assertEqual(probe['duration'], 12.5)
+        self.assertTrue(probe['has_audio'])
+
+    @patch('content_app.encoding.subprocess.run')
+    def test_probe_video_without_video_stream_fails_with_a_message(self, mock_run):
+        mock_run.return_value.stdout = '{"streams": [{"codec_type": "audio"}], "format": {"duration": "12.5"}}'
+        with self.assertRaisesMessage(ValueError, '/media/videos/sample.mp4 has no video stream'):
+            probe_video('/media/videos/sample.mp4')
+
+
+class TranscodeFanOutTests(SimpleTestCase):
+    @patch('content_app.tasks.enqueue')
+    def test_fan_out_enqueues_one_job_per_resolution_and_finalizer(self, mock_enqueue):
+        ladder = build_ladder(SOURCE_PROBE)
+        fan_out_renditions(1, '/media/videos/sample.mp4', '/media/videos/sample', ladder, 60)
+
+        *children, trickplay, finalizer = mock_enqueue.call_args_list
+        self.assertEqual([call.args[4] for call in children], ladder)
+        self.assertTrue(all(call.kwargs['queue'] == 'transcode' for call in children))
+        self.assertIs(trickplay.args[0], generate_trickplay)
+        self.assertIs(finalizer.args[0], finalize_transcode)
+        self.assertEqual(len(finalizer.kwargs['depends_on']), len(ladder) + 1)
+
+    @patch('os.path.exists', return_value=False)
+    def test_finalize_raises_when_playlist_missing(self, mock_exists):
+        with self.assertRaises(RuntimeError):
+            finalize_transcode(1, '/media/videos/sample', build_ladder(SOURCE_PROBE))
+
+
+def write_rendition(output_dir, ended=True):
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'segment_000.ts'), 'wb') as f:
+        f.write(b'segment')
+    playlist = render_media_playlist([(6.0, 'segment_000.ts')])
+    with open(os.path.join(output_dir, 'index.m3u8'), 'w') as f:
+        f.write(playlist if ended else playlist.replace('#EXT-X-ENDLIST', ''))
+
+
+class ProgressivePublishTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.base = os.path.join(self.tmp, 'sample')
+        self.ladder = build_ladder(SOURCE_PROBE)
+        with patch('content_app.signals.enqueue_after_commit'):
+            self.video = Video.objects.create(title='Sample Video', video_file='videos/sample.mp4')
+
+    @patch('content_app.tasks.probe_codecs', return_value='avc1.64001f,mp4a.40.2')
+    def test_video_is_ready_after_first_rendition(self, mock_codecs):
+        write_rendition(get_rendition_dir(self.base, '480p'))
+        publish_playable(self.video.id, self.base, self.ladder)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.status, Video.Status.QUEUED)
+
+        write_rendition(get_rendition_dir(self.base, 'audio'))
+        publish_playable(self.video.id, self.base, self.ladder)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.status, Video.Status.READY)
+        self.assertEqual([rendition['label'] for rendition in self.video.renditions], ['480p', 'audio'])
+        with open(get_master_playlist_path(self.base)) as f:
+            self.assertEqual(f.read().count('#EXT-X-STREAM-INF'), 1)
+
+        write_rendition(get_rendition_dir(self.base, '720p'))
+        publish_playable(self.video.id, self.base, self.ladder)
+        with open(get_master_playlist_path(self.base)) as f:
+            self.assertEqual(f.read().count('#EXT-X-STREAM-INF'), 2)
+        mock_codecs.assert_called_with(os.path.join(get_rendition_dir(self.base, '720p'), 'segment_000.ts'))
+        self.assertEqual(mock_codecs.call_count, 3)
+
+    @override_settings(HLS_TRANSCODE_MODE='single_pass')
+    @patch('content_app.tasks.choose_preset', return_value='fast')
+    @patch('content_app.tasks.enqueue')
+    @patch('content_app.tasks.convert_rendition_to_hls')
+    @patch('content_app.tasks.probe_video', return_value=SOURCE_PROBE)
+    @patch('content_app.tasks.hash_video_file', return_value='abc')
+    def test_lowest_rendition_encoded_before_the_rest_is_queued(self, mock_hash, mock_probe, mock_convert, mock_enqueue, mock_preset):
+        transcode_video(self.video.id)
+
+        self.assertEqual(
+            [call.args[3] for call in mock_convert.call_args_list],
+            [dict(self.ladder[0], preset='fast'), dict(self.ladder[-1], preset='fast')]
+        )
+        self.assertIs(mock_enqueue.call_args.args[0], encode_ladder)
+        self.assertEqual(mock_enqueue.call_args.kwargs['queue'], 'transcode')
+
+    def test_failure_keeps_playable_video_ready(self):
+        Video.objects.filter(pk=self.video.pk).update(status=Video.Status.READY, renditions=self.ladder[:1])
+        mark_transcode_failed(Mock(args=[self.video.id], retries_left=0, meta={}), None, None, None, None)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.status, Video.Status.READY)
+
+
+@override_settings(TRANSCODE_FFMPEG_SLOTS=2, HLS_BACKLOG_PRESETS=[(0, 'medium'), (20, 'fast'), (100, 'veryfast')])
+class GovernorTests(SimpleTestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.lock_dir)
+
+    @patch('content_app.governor.host_cpu_count', return_value=16)
+    def test_threads_share_the_cores_of_the_host(self, mock_cpus):
+        self.assertEqual(governor.threads_per_process(), 8)
+        with self.settings(TRANSCODE_FFMPEG_SLOTS=0):
+            self.assertEqual(governor.slot_count(), 4)
+            self.assertEqual(governor.threads_per_process(), 4)
+
+        cmd = build_single_pass_command('/media/videos/sample.mp4', '/media/videos/sample', build_ladder(SOURCE_PROBE), threads=8)
+        self.assertEqual([cmd[i + 1] for i, arg in enumerate(cmd) if arg == '-threads'], ['2', '2', '2'])
+
+    @patch('content_app.governor.time.sleep', side_effect=RuntimeError('no free slot'))
+    def test_slots_cap_concurrent_processes(self, mock_sleep):
+        with self.settings(TRANSCODE_LOCK_DIR=self.lock_dir):
+            with governor.ffmpeg_slot() as first, governor.ffmpeg_slot() as second:
+                self.assertEqual((first, second), (0, 1))
+                with self.assertRaisesMessage(RuntimeError, 'no free slot'):
+                    with governor.ffmpeg_slot():
+                        pass
+            with governor.ffmpeg_slot() as slot:
+                self.assertEqual(slot, 0)
+
+    @patch('content_app.governor.transcode_backlog')
+    def test_preset_gets_faster_with_backlog(self, mock_backlog):
+        for backlog, preset in [(0, 'medium'), (20, 'fast'), (500, 'veryfast')]:
+            mock_backlog.return_value = backlog
+            self.assertEqual(governor.choose_preset(), preset)
+
+
+class ResumableTranscodeTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.base = os.path.join(self.tmp, 'sample')
+        self.ladder = build_ladder(SOURCE_PROBE)
+
+    def fake_ffmpeg(self, cmd, reporter=None):
+        write_rendition(os.path.dirname(cmd[-1]))
+
+    def test_unended_playlist_is_not_complete(self):
+        write_rendition(self.tmp, ended=False)
+        self.assertFalse(is_rendition_complete(self.tmp))
+        write_rendition(self.tmp)
+        self.assertTrue(is_rendition_complete(self.tmp))
+
+    @patch('content_app.tasks.run_ffmpeg', side_effect=subprocess.CalledProcessError(1, 'ffmpeg'))
+    def test_failed_ffmpeg_raises_and_publishes_nothing(self, mock_run):
+        with self.assertRaises(subprocess.CalledProcessError):
+            convert_resolutions_to_hls('/media/videos/sample.mp4', mode='serial', ladder=self.ladder, base=self.base)
+        self.assertFalse(os.path.exists(get_rendition_dir(self.base, '480p')))
+
+    @patch('content_app.tasks.run_ffmpeg')
+    def test_retry_skips_published_renditions(self, mock_run):
+        mock_run.side_effect = self.fake_ffmpeg
+        write_rendition(get_rendition_dir(self.base, '480p'))
+
+        convert_resolutions_to_hls('/media/videos/sample.mp4', mode='serial', ladder=self.ladder, base=self.base)
+
+        self.assertEqual(mock_run.call_count, len(self.ladder) - 1)
+        self.assertNotIn('480p', ' '.join(mock_run.call_args_list[0].args[0]))
+        for rung in self.ladder:
+            self.assertTrue(is_rendition_complete(get_rendition_dir(self.base, rung['label'])))
+            self.assertFalse(os.path.exists(f"{self.base}_{rung['label']}.partial"))
+
+
+    def test_only_replaced_renditions_drop_cached_segments(self):
+        with self.settings(MEDIA_ROOT=self.tmp):
+            self.addCleanup(cache.delete, generation_key('sample'))
+            for label in ('480p', '720p'):
+                write_rendition(get_staging_dir(self.base, label))
+                publish_rendition(self.base, label)
+            self.assertEqual(get_segment_generation('sample'), 0)
+
+            write_rendition(get_staging_dir(self.base, '480p'))
+            publish_rendition(self.base, '480p')
+            self.assertEqual(get_segment_generation('sample'), 1)
+
+
+class TranscodeProgressTests(APITestCase):
+    def setUp(self):
+        self.video = Video.objects.create(title='Sample Video', progress={'480p': 0, '720p': 0})
+
+    @override_settings(HLS_PROGRESS_INTERVAL=60)
+    def test_progress_writes_are_throttled(self):
+        reporter = ProgressReporter(self.video.id, ['720p'], duration=100)
+        with self.assertNumQueries(4):
+            for seconds in range(1, 50):
+                reporter.feed(f'out_time_us={seconds * 1_000_000}\n')
+                reporter.feed('progress=continue\n')
+
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.progress, {'480p': 0, '720p': 1})
+
+        reporter.feed('progress=end\n')
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.progress, {'480p': 0, '720p': 100})
+
+    def test_failed_job_marks_video_failed_after_last_retry(self):
+        job = Mock(args=(self.video.id,), retries_left=2, meta={})
+        mark_transcode_failed(job, None, RuntimeError, RuntimeError(), None)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.status, Video.Status.QUEUED)
+
+        job.retries_left = 0
+        mark_transcode_failed(job, None, RuntimeError, RuntimeError(), None)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.status, Video.Status.FAILED)
+
+    @patch('content_app.tasks.job_cpu_seconds', return_value=1.5)
+    def test_cpu_seconds_of_every_attempt_are_recorded(self, mock_cpu):
+        job = Mock(args=(self.video.id,), retries_left=1, meta={})
+        mark_transcode_failed(job, None, RuntimeError, RuntimeError(), None)
+        record_transcode_cpu(job, None, None)
+
+        self.assertEqual(job.meta['cpu_seconds'], 3.0)
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.cpu_seconds, 3.0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.gettempdir())
+class DeduplicationTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        self.ladder = build_ladder(SOURCE_PROBE)
+        self.original = self.create_video('original.mp4', content_hash='abc', status=Video.Status.READY, renditions=self.ladder)
+
+    def create_video(self, name, **fields):
+        with open(os.path.join(self.media, name), 'wb') as f:
+            f.write(b'same content')
+        with patch('content_app.signals.enqueue_after_commit'):
+            return Video.objects.create(title=name, video_file=os.path.join(self.media, name), **fields)
+
+    @patch('content_app.tasks.probe_video')
+    @patch('content_app.tasks.hash_video_file', return_value='abc')
+    def test_duplicate_upload_reuses_renditions(self, mock_hash, mock_probe):
+        duplicate = self.create_video('duplicate.mp4')
+        transcode_video(duplicate.id)
+
+        duplicate.refresh_from_db()
+        mock_probe.assert_not_called()
+        self.assertEqual(duplicate.video_file.name, self.original.video_file.name)
+        self.assertEqual(duplicate.renditions, self.ladder)
+        self.assertEqual(duplicate.status, Video.Status.READY)
+        self.assertEqual(duplicate.get_base_path(), self.original.get_base_path())
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'duplicate.mp4')))
+
+    @patch('content_app.tasks.probe_video')
+    @patch('content_app.tasks.hash_video_file', return_value='def')
+    def test_concurrent_uploads_of_the_same_content_encode_once(self, mock_hash, mock_probe):
+        first, second = self.create_video('first.mp4'), self.create_video('second.mp4')
+        # The first upload claimed the content and is still probing its source
+        self.assertEqual(claim_content(first, 'def'), first)
+
+        transcode_video(second.id)
+
+        second.refresh_from_db()
+        mock_probe.assert_not_called()
+        self.assertEqual((second.content_hash, second.video_file.name), ('def', first.video_file.name))
+        self.assertEqual(Video.objects.sharing_content(first.id).count(), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'second.mp4')))
+
+    def test_claim_of_a_failed_upload_passes_on(self):
+        failed, retry = self.create_video('failed.mp4'), self.create_video('retry.mp4')
+        claim_content(failed, 'def')
+        Video.objects.filter(pk=failed.pk).update(status=Video.Status.FAILED)
+
+        self.assertEqual(claim_content(retry, 'def'), retry)
+        self.assertEqual(ContentClaim.objects.get(content_hash='def').video, retry)
+
+    @patch('content_app.signals.enqueue_after_commit')
+    def test_files_deleted_with_last_reference(self, mock_enqueue):
+        duplicate = self.create_video('duplicate.mp4', content_hash='abc', renditions=self.ladder)
+        Video.objects.filter(pk=duplicate.pk).update(video_file=self.original.video_file.name)
+
+        self.original.delete()
+        mock_enqueue.assert_not_called()
+
+        Video.objects.get(pk=duplicate.pk).delete()
+        self.assertEqual(mock_enqueue.call_count, 2)
+
+
+
+class RenditionStorageTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        self.override = override_settings(MEDIA_ROOT=self.media, STORAGE_GC_MIN_AGE=0)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+
+        self.videos_dir = os.path.join(self.media, 'videos')
+        self.base = os.path.join(self.videos_dir, 'abc')
+        self.ladder = build_ladder(dict(SOURCE_PROBE, height=480, width=854))
+        for rung in self.ladder:
+            write_rendition(get_rendition_dir(self.base, rung['label']))
+        with patch('content_app.signals.enqueue_after_commit'):
+            self.video = Video.objects.create(title='Sample Video', video_file='videos/sample.mp4', content_hash='abc')
+
+    @patch('content_app.tasks.probe_codecs', return_value='avc1.64001e')
+    def test_manifest_lists_every_published_file(self, mock_codecs):
+        os.makedirs(f'{self.base}_720p.partial')
+        publish_playable(self.video.id, self.base, self.ladder)
+
+        self.video.refresh_from_db()
+        self.assertEqual(sorted(self.video.manifest), [
+            'videos/abc_480p/index.m3u8', 'videos/abc_480p/segment_000.ts',
+            'videos/abc_audio/index.m3u8', 'videos/abc_audio/segment_000.ts', 'videos/abc_master.m3u8',
+        ])
+        self.assertEqual(self.video.manifest['videos/abc_480p/segment_000.ts'], len(b'segment'))
+
+    @override_settings(STORAGE_DELETE_BATCH_SIZE=3)
+    @patch('content_app.storage.enqueue')
+    def test_delete_unlinks_manifest_in_batches(self, mock_enqueue):
+        paths = sorted(os.path.relpath(os.path.join(root, name), self.media) for root, _, names in os.walk(self.videos_dir) for name in names)
+        self.assertEqual(delete_manifest_files(paths), 3)
+        mock_enqueue.assert_called_once_with(delete_manifest_files, paths[3:])
+
+        delete_manifest_files(paths[3:])
+        self.assertEqual(os.listdir(self.videos_dir), [])
+
+    def test_delete_jobs_enqueued_with_the_source_path_still_run(self):
+        legacy_base = os.path.join(self.videos_dir, 'old')
+        for label in ('480p', '720p'):
+            write_rendition(get_rendition_dir(legacy_base, label))
+
+        delete_hls_files(f'{legacy_base}.mp4')
+        self.assertFalse(glob.glob(f'{legacy_base}_*'))
+        self.assertTrue(os.path.exists(get_rendition_dir(self.base, '480p')))
+
+    def test_gc_reclaims_orphans_only(self):
+        write_rendition(get_rendition_dir(os.path.join(self.videos_dir, 'deleted'), '480p'))
+        os.makedirs(os.path.join(self.videos_dir, 'deleted_chunks'))
+        for name in ('sample.mp4', 'orphan.mp4'):
+            with open(os.path.join(self.videos_dir, name), 'wb') as f:
+                f.write(b'source')
+
+        names, reclaimed = collect_garbage_batch()
+        self.assertEqual(len(names), 6)
+        self.assertEqual(reclaimed, len(b'source') + len(b'segment') + os.path.getsize(get_rendition_dir(self.base, '480p') + '/index.m3u8'))
+        self.assertEqual(sorted(os.listdir(self.videos_dir)), ['abc_480p', 'abc_audio', 'sample.mp4'])
+
+    def test_gc_reclaims_orphans_of_a_remote_storage(self):
+        bucket = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bucket)
+        for base in ('abc', 'deleted'):
+            write_rendition(get_rendition_dir(os.path.join(bucket, 'videos', base), '480p'))
+        with open(os.path.join(bucket, 'videos', 'deleted_master.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n')
+
+        storage = {'BACKEND': 'content_app.tests.DirectoryRenditionStorage', 'OPTIONS': {'root': bucket}}
+        with self.settings(RENDITION_STORAGE=storage):
+            names, reclaimed = collect_garbage_batch()
+        self.assertIn('deleted_480p', names)
+        self.assertEqual(reclaimed, len(b'segment') + len('#EXTM3U\n') + os.path.getsize(os.path.join(bucket, 'videos', 'abc_480p', 'index.m3u8')))
+        self.assertEqual(sorted(os.listdir(os.path.join(bucket, 'videos'))), ['abc_480p'])
+        self.assertEqual(sorted(os.listdir(self.videos_dir)), ['abc_480p', 'abc_audio'])
+
+    @override_settings(STORAGE_GC_MIN_AGE=3600)
+    def test_gc_keeps_recent_orphans(self):
+        write_rendition(get_rendition_dir(os.path.join(self.videos_dir, 'deleted'), '480p'))
+        self.assertEqual(collect_garbage_batch()[1], 0)
+        self.assertTrue(os.path.isdir(os.path.join(self.videos_dir, 'deleted_480p')))
+
+    @override_settings(STORAGE_GC_BATCH_SIZE=2)
+    @patch('content_app.storage.django_rq.get_queue')
+    @patch('content_app.storage.enqueue')
+    def test_gc_pass_continues_after_cursor_and_reschedules(self, mock_enqueue, mock_get_queue):
+        collect_rendition_garbage()
+        self.assertEqual(mock_enqueue.call_args.args[1:], ('abc_audio', 0))
+
+        report = collect_rendition_garbage('abc_audio')
+        mock_get_queue.return_value.enqueue_in.assert_called_once()
+        self.assertEqual(report['reclaimed_bytes'], 0)
+
+    def test_report_counts_shared_files_once(self):
+        manifest = {'videos/abc_480p/segment_000.ts': 100, 'videos/abc_master.m3u8': 10}
+        Video.objects.filter(pk=self.video.pk).update(manifest=manifest)
+        with patch('content_app.signals.enqueue_after_commit'):
+            Video.objects.create(title='Duplicate', video_file='videos/sample.mp4', content_hash='abc', manifest=manifest)
+
+        report = storage_report()
+        self.assertEqual([video['rendition_bytes'] for video in report['videos']], [110, 110])
+        self.assertEqual(report['total_bytes'], 110)
+
+
+class RecordingRenditionStorage(LocalRenditionStorage):
+    """
+        Remote storage double which records what the pipeline hands to it
+    """
+    is_local = False
+
+    def __init__(self):
+        self.saved = []
+
+    def save_dir(self, path):
+        self.saved.append(os.path.basename(path))
+
+    def save_file(self, path):
+        self.saved.append(os.path.basename(path))
+
+
+class DirectoryRenditionStorage(LocalRenditionStorage):
+    """
+        Remote storage double which keeps its objects in a directory outside of MEDIA_ROOT
+    """
+    is_local = False
+
+    def __init__(self, root):
+        self.root = root
+
+    def local_path(self, name):
+        return os.path.join(self.root, name)
+
+    def list(self, prefix):
+        return [
+            os.path.relpath(os.path.join(directory, name), self.root)
+            for directory, _, names in os.walk(self.local_path(prefix)) for name in sorted(names)
+        ]
+
+
+class RenditionStorageBackendTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media_root = override_settings(MEDIA_ROOT=self.media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.base = os.path.join(self.media, 'videos', 'abc')
+
+    def test_local_storage_streams_ranges_and_deletes(self):
+        storage = LocalRenditionStorage()
+        os.makedirs(os.path.join(self.media, 'videos', 'abc_480p'))
+        with open(os.path.join(self.media, 'videos', 'abc_480p', 'rendition.mp4'), 'wb') as f:
+            f.write(os.urandom(200 * 1024))
+
+        name = 'videos/abc_480p/rendition.mp4'
+        data = b''.join(storage.iter_range(name))
+        self.assertEqual(storage.size(name), len(data))
+        self.assertEqual(b''.join(storage.iter_range(name, 100, 70000)), data[100:70100])
+        self.assertEqual(storage.list('videos/abc_480p'), [name])
+
+        storage.delete([name])
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'videos', 'abc_480p')))
+        with self.assertRaises(FileNotFoundError):
+            storage.size(name)
+
+    @override_settings(RENDITION_STORAGE={'BACKEND': 'content_app.tests.RecordingRenditionStorage'})
+    @patch('content_app.tasks.probe_codecs', return_value='avc1.64001e')
+    def test_remote_storage_gets_published_files_and_local_copies_are_dropped(self, mock_codecs):
+        ladder = build_ladder(dict(SOURCE_PROBE, height=480, width=854, has_audio=False))
+        with patch('content_app.signals.enqueue_after_commit'):
+            video = Video.objects.create(title='Sample Video', video_file='videos/sample.mp4', content_hash='abc')
+        write_rendition(get_staging_dir(self.base, '480p'))
+        publish_rendition(self.base, '480p')
+        finalize_transcode(video.id, self.base, ladder)
+
+        self.assertEqual(get_rendition_storage().saved, ['abc_480p', 'abc_master.m3u8'])
+        self.assertEqual(os.listdir(os.path.join(self.media, 'videos')), [])
+
+
+@unittest.skipUnless(os.environ.get('RENDITION_S3_TEST_ENDPOINT_URL'), 'needs an S3 compatible endpoint, e.g. a local MinIO')
+class S3RenditionStorageTests(SimpleTestCase):
+    """
+        Runs against a MinIO started with "docker compose --profile s3 up minio" and
+        RENDITION_S3_TEST_ENDPOINT_URL=http://localhost:9000
+    """
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        media_root = override_settings(MEDIA_ROOT=self.media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+        self.storage = S3RenditionStorage(
+            bucket=f'videoflix-test-{uuid4().hex[:12]}',
+            endpoint_url=os.environ['RENDITION_S3_TEST_ENDPOINT_URL'],
+            access_key_id=os.environ.get('RENDITION_S3_TEST_ACCESS_KEY_ID', 'minioadmin'),
+            secret_access_key=os.environ.get('RENDITION_S3_TEST_SECRET_ACCESS_KEY', 'minioadmin'),
+            region_name='us-east-1',
+            multipart_threshold=5 * 1024 * 1024,
+            multipart_chunksize=5 * 1024 * 1024,
+        )
+        self.storage.client.create_bucket(Bucket=self.storage.bucket)
+        self.addCleanup(self.storage.client.delete_bucket, Bucket=self.storage.bucket)
+
+    def test_multipart_upload_streaming_reads_and_batched_delete(self):
+        rendition_dir = os.path.join(self.media, 'videos', 'abc_1080p')
+        os.makedirs(rendition_dir)
+        data = os.urandom(12 * 1024 * 1024)
+        with open(os.path.join(rendition_dir, 'rendition.mp4'), 'wb') as f:
+            f.write(data)
+        with open(os.path.join(rendition_dir, 'index.m3u8'), 'w') as f:
+            f.write('#EXTM3U\n')
+        self.storage.save_dir(rendition_dir)
+
+        name = 'videos/abc_1080p/rendition.mp4'
+        head = self.storage.client.head_object(Bucket=self.storage.bucket, Key=name)
+        self.assertTrue(head['ETag'].strip('"').endswith('-3'))
+        self.assertEqual(self.storage.size(name), len(data))
+        self.assertEqual(self.storage.read_text('videos/abc_1080p/index.m3u8'), '#EXTM3U\n')
+
+        chunks = list(self.storage.iter_range(name, 1000, 200000))
+        self.assertTrue(all(len(chunk) <= 64 * 1024 for chunk in chunks))
+        self.assertEqual(b''.join(chunks), data[1000:201000])
+
+        names = self.storage.list('videos/abc_1080p')
+        self.assertEqual(sorted(names), ['videos/abc_1080p/index.m3u8', name])
+        self.storage.delete(names)
+        with self.assertRaises(FileNotFoundError):
+            self.storage.size(name)
+
+class MasterPlaylistTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.base = os.path.join(self.tmp, 'sample')
+
+    @patch('content_app.tasks.probe_codecs', return_value='avc1.64001f,mp4a.40.2')
+    def test_measure_rendition_uses_segment_sizes(self, mock_codecs):
+        rung = build_ladder(SOURCE_PROBE)[1]
+        os.makedirs(f'{self.base}_720p')
+        for name, size in [('segment_000.ts', 6000), ('segment_001.ts', 1000)]:
+            with open(os.path.join(f'{self.base}_720p', name), 'wb') as f:
+                f.write(b'\0' * size)
+        with open(os.path.join(f'{self.base}_720p', 'index.m3u8'), 'w') as f:
+            f.write(render_media_playlist([(6.0, 'segment_000.ts'), (2.0, 'segment_001.ts')]))
+
+        rendition = measure_rendition(self.base, rung)
+        self.assertEqual(rendition['bandwidth'], 8000)
+        self.assertEqual(rendition['average_bandwidth'], 7000)
+        self.assertEqual(rendition['codecs'], 'avc1.64001f,mp4a.40.2')
+
+    def test_byte_range_offsets_continue_from_previous_range(self):
+        playlist = (
+            '#EXTM3U\n#EXT-X-MAP:URI="rendition.mp4",BYTERANGE="100@0"\n'
+            '#EXTINF:6.0,\n#EXT-X-BYTERANGE:600@100\nrendition.mp4\n'
+            '#EXTINF:2.0,\n#EXT-X-BYTERANGE:200\nrendition.mp4\n#EXT-X-ENDLIST\n'
+        )
+        self.assertEqual(parse_byte_ranges(playlist), [(600, 100), (200, 700)])
+        self.assertEqual(parse_byte_ranges(render_media_playlist([(6.0, 'segment_000.ts')])), [None])
+
+    def test_master_playlist_lists_renditions_by_bandwidth(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, has_audio=False))
+        renditions = [
+            dict(rung, bandwidth=rung['video_bitrate'] * 1000, average_bandwidth=rung['video_bitrate'] * 900, codecs='avc1.64001f')
+            for rung in reversed(ladder)
+        ]
+        lines = render_master_playlist(renditions).splitlines()
+
+        self.assertEqual(lines[0], '#EXTM3U')
+        self.assertEqual(lines[2], '#EXT-X-STREAM-INF:BANDWIDTH=1400000,AVERAGE-BANDWIDTH=1260000,RESOLUTION=854x480,CODECS="avc1.64001f"')
+        self.assertEqual(lines[3::2], ['480p/index.m3u8', '720p/index.m3u8', '1080p/index.m3u8'])
+
+    def test_master_playlist_references_shared_audio(self):
+        *videos, audio = build_ladder(SOURCE_PROBE)
+        renditions = [
+            dict(videos[0], bandwidth=1400000, average_bandwidth=1260000, codecs='avc1.64001e'),
+            dict(audio, bandwidth=130000, average_bandwidth=128000, codecs='mp4a.40.2'),
+        ]
+        lines = render_master_playlist(renditions).splitlines()
+
+        self.assertEqual(
+            lines[2],
+            '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="default",DEFAULT=YES,AUTOSELECT=YES,URI="audio/index.m3u8"'
+        )
+        self.assertEqual(
+            lines[3],
+            '#EXT-X-STREAM-INF:BANDWIDTH=1530000,AVERAGE-BANDWIDTH=1388000,RESOLUTION=854x480,'
+            'CODECS="avc1.64001e,mp4a.40.2",AUDIO="audio"'
+        )
+        self.assertEqual(lines[4:], ['480p/index.m3u8'])
+
+
+def first_video_pts(path, stream_ids=range(0xE0, 0xF0)):
+    """
+        Seconds of the first video pts in a mpeg-ts segment, or of other streams by their PES stream ids
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    for offset in range(0, len(data) - 187, 188):
+        packet = data[offset:offset + 188]
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        adaptation = (packet[3] >> 4) & 0x3
+        if not adaptation & 0x1:
+            continue
+        start = 5 + packet[4] if adaptation & 0x2 else 4
+        pes = packet[start:]
+        if pes[:3] == b'\x00\x00\x01' and pes[3] in stream_ids and pes[7] & 0x80:
+            p = pes[9:14]
+            pts = ((p[0] >> 1) & 0x07) << 30 | p[1] << 22 | (p[2] >> 1) << 15 | p[3] << 7 | p[4] >> 1
+            return pts / 90000
+    return None
+
+
+def video_keyframes(path):
+    """
+        Whether each video frame of a mpeg-ts segment is a keyframe, by the random access indicator
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    keyframes = []
+    for offset in range(0, len(data) - 187, 188):
+        packet = data[offset:offset + 188]
+        if packet[0] != 0x47 or not packet[1] & 0x40:
+            continue
+        adaptation = (packet[3] >> 4) & 0x3
+        if not adaptation & 0x1:
+            continue
+        start = 5 + packet[4] if adaptation & 0x2 else 4
+        pes = packet[start:]
+        if pes[:3] == b'\x00\x00\x01' and 0xE0 <= pes[3] <= 0xEF:
+            keyframes.append(bool(adaptation & 0x2 and packet[4] and packet[5] & 0x40))
+    return keyframes
+
+
+class LegacyMasterPlaylistTests(APITestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        rendition_dir = os.path.join(self.media, 'videos', 'old_480p')
+        os.makedirs(rendition_dir)
+        with open(os.path.join(rendition_dir, 'index.m3u8'), 'w') as f:
+            f.write(render_media_playlist([(6.0, 'segment_000.ts')]))
+        with open(os.path.join(rendition_dir, 'segment_000.ts'), 'wb') as f:
+            f.write(b'x' * 6000)
+
+        legacy = {'label': '480p', 'height': 480, 'video_bitrate': 1400, 'audio_bitrate': 128, 'fps': None}
+        self.video = Video.objects.create(title='Old', video_file='videos/old.mp4', renditions=[legacy], status=Video.Status.READY)
+        self.client.force_authenticate(user=User.objects.create_user(username='viewer', password='pass'))
+
+    def test_legacy_videos_get_a_master_playlist_without_audio_group(self):
+        migration = importlib.import_module('content_app.migrations.0008_legacy_master_playlists')
+        url = reverse('HSL-master-playlist', kwargs={'pk': self.video.pk})
+        with self.settings(MEDIA_ROOT=self.media):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+            migration.write_legacy_master_playlists(django_apps, None)
+
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            playlist = b''.join(response.streaming_content).decode()
+        self.assertNotIn('#EXT-X-MEDIA', playlist)
+        self.assertNotIn('AUDIO=', playlist)
+        self.assertIn('#EXT-X-STREAM-INF:BANDWIDTH=8000,AVERAGE-BANDWIDTH=8000', playlist)
+        self.assertEqual(playlist.splitlines()[-1], '480p/index.m3u8')
+        self.video.refresh_from_db()
+        self.assertEqual(self.video.renditions[0]['bandwidth'], 8000)
+        self.assertEqual(playlist, render_master_playlist(self.video.renditions))
+
+    def test_legacy_videos_are_ready_and_complete(self):
+        Video.objects.filter(pk=self.video.pk).update(status=Video.Status.QUEUED)
+        importlib.import_module('content_app.migrations.0003_video_status').mark_transcoded_videos_ready(django_apps, None)
+        self.video.refresh_from_db()
+        self.assertEqual((self.video.status, self.video.progress), (Video.Status.READY, {'480p': 100}))
+        self.assertTrue(self.video.is_complete)
+
+        migration = importlib.import_module('content_app.migrations.0008_legacy_master_playlists')
+        with self.settings(MEDIA_ROOT=self.media):
+            migration.write_legacy_master_playlists(django_apps, None)
+            response = self.client.get(reverse('HSL-master-playlist', kwargs={'pk': self.video.pk}))
+        self.assertEqual(response['Cache-Control'], 'private, max-age=300')
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), 'ffmpeg is not installed')
+class SyntheticSourceTestCase(SimpleTestCase):
+    """
+        Encodes a 20 s 320x240 clip with audio, made once per class, into a temp dir of every test.
+        The clip has a keyframe every 1.4 s, so its own keyframes never fall on the segment grid
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        source_dir = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, source_dir)
+        cls.source = os.path.join(source_dir, 'testsrc.mp4')
+        subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=duration=20:size=320x240:rate=25',
+            '-f', 'lavfi', '-i', 'sine=duration=20',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '35',
+            '-c:a', 'aac', '-shortest', cls.source
+        ], check=True)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.base = os.path.join(self.tmp, 'testsrc')
+
+
+class TrickplayTests(SyntheticSourceTestCase):
+    @override_settings(TRICKPLAY_INTERVAL=2, TRICKPLAY_COLUMNS=3, TRICKPLAY_ROWS=2)
+    def test_single_pass_writes_trickplay_sheets(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, width=320, height=240))
+        convert_resolutions_to_hls(self.source, mode='single_pass', ladder=ladder, duration=20, base=self.base)
+
+        trickplay_dir = get_trickplay_dir(self.base)
+        self.assertEqual(sorted(os.listdir(trickplay_dir)), ['sprite_000.jpg', 'sprite_001.jpg', 'trickplay.vtt'])
+        with open(os.path.join(trickplay_dir, 'trickplay.vtt')) as f:
+            self.assertEqual(f.read().count(' --> '), 10)
+
+
+class StartupSegmentTests(SyntheticSourceTestCase):
+    @override_settings(HLS_STARTUP_RUNG={'height': 144, 'video_bitrate': 200})
+    def test_startup_segments_are_aligned_and_start_with_keyframes(self):
+        probe = dict(SOURCE_PROBE, width=320, height=240)
+        ladder = [dict(rung, preset='ultrafast') for rung in build_ladder(probe, ladder=[{'height': 240, 'video_bitrate': 400}])]
+        convert_resolutions_to_hls(self.source, mode='single_pass', ladder=ladder, duration=20, base=self.base)
+
+        def read_playlist(label):
+            with open(os.path.join(get_rendition_dir(self.base, label), 'index.m3u8')) as f:
+                playlist = f.read()
+            target = int(re.search(r'#EXT-X-TARGETDURATION:(\d+)', playlist).group(1))
+            return [duration for duration, _ in parse_media_playlist(playlist)], target
+
+        def boundaries(durations):
+            return [round(sum(durations[:i + 1]), 1) for i in range(len(durations))]
+
+        self.assertEqual([rung['label'] for rung in ladder], ['144p', '240p', 'audio'])
+        video = {label: read_playlist(label) for label in ('144p', '240p')}
+        for label, (durations, target) in video.items():
+            self.assertEqual([round(duration) for duration in durations], [2, 2, 2, 6, 6, 2], label)
+            self.assertAlmostEqual(sum(durations), 20, delta=0.1)
+            self.assertLessEqual(max(durations), target + 0.5)
+            self.assertEqual(boundaries(durations), boundaries(video['144p'][0]))
+
+        audio, target = read_playlist('audio')
+        self.assertTrue(all(duration <= target + 0.5 for duration in audio))
+        self.assertAlmostEqual(sum(audio), 20, delta=0.1)
+        self.assertTrue(set(boundaries(audio)[:-1]) <= set(boundaries(video['240p'][0])))
+
+        rendition_dir = get_rendition_dir(self.base, '240p')
+        for segment in sorted(glob.glob(os.path.join(rendition_dir, '*.ts'))):
+            keyframes = video_keyframes(segment)
+            self.assertTrue(keyframes[0], segment)
+            self.assertEqual(keyframes.count(True), 1, segment)
+
+
+class Fmp4RenditionTests(SyntheticSourceTestCase):
+    @override_settings(HLS_SEGMENT_FORMAT='fmp4')
+    def test_fmp4_rendition_is_one_file(self):
+        ladder = build_ladder(dict(SOURCE_PROBE, width=320, height=240))
+        convert_resolutions_to_hls(self.source, mode='serial', ladder=ladder, base=self.base)
+
+        rendition_dir = get_rendition_dir(self.base, '240p')
+        self.assertEqual(sorted(os.listdir(rendition_dir)), ['index.m3u8', 'rendition.mp4'])
+        with open(os.path.join(rendition_dir, 'index.m3u8')) as f:
+            byte_ranges = parse_byte_ranges(f.read())
+        self.assertGreater(len(byte_ranges), 1)
+        self.assertTrue(is_rendition_complete(rendition_dir))
+
+
+class ChunkedEncodingTests(SyntheticSourceTestCase):
+    @override_settings(HLS_CHUNK_DURATION=10, HLS_SEGMENT_DURATION=4, HLS_STARTUP_SEGMENTS=2)
+    def test_chunks_are_cut_on_the_segment_grid(self):
+        # Startup segments end at 4, regular ones follow every 4 s, the rest after 20 is less than a segment
+        self.assertEqual([(start, end) for _, start, end in plan_chunks(23)], [(0, 12), (12, 23)])
+        with self.settings(HLS_STARTUP_SEGMENTS=0):
+            self.assertEqual([(start, end) for _, start, end in plan_chunks(23)], [(0, 12), (12, 23)])
+        with self.settings(HLS_CHUNK_DURATION=120):
+            self.assertEqual([(start, end) for _, start, end in plan_chunks(23)], [(0, 23)])
+
+    @override_settings(HLS_CHUNK_DURATION=6)
+    @patch('content_app.tasks.publish_playable')
+    @patch('content_app.tasks.save_progress')
+    def test_stitched_playlist_is_gap_free(self, mock_save_progress, mock_publish_playable):
+        chunks = plan_chunks(20)
+        self.assertEqual([(start, end) for _, start, end in chunks], [(0, 6), (6, 12), (12, 20)])
+
+        rung = build_ladder(dict(SOURCE_PROBE, width=320, height=240))[0]
+        for name, start, end in chunks:
+            encode_chunk(1, self.source, self.base, name, start, end, rung, len(chunks))
+        stitch_rendition(1, self.base, rung, [name for name, _, _ in chunks], [rung])
+        self.assertEqual(mock_save_progress.call_args.args, (1, {'240p': 99}))
+        mock_publish_playable.assert_called_once_with(1, self.base, [rung])
+
+        rendition_dir = os.path.join(self.tmp, 'testsrc_240p')
+        with open(os.path.join(rendition_dir, 'index.m3u8')) as f:
+            playlist = f.read()
+        segments = parse_media_playlist(playlist)
+
+        self.assertNotIn('#EXT-X-DISCONTINUITY', playlist)
+        self.assertEqual([uri for _, uri in segments], [f'segment_{i:03d}.ts' for i in range(len(segments))])
+        self.assertAlmostEqual(sum(duration for duration, _ in segments), 20, delta=0.1)
+
+        starts = [first_video_pts(os.path.join(rendition_dir, uri)) for _, uri in segments]
+        for (duration, _), start, next_start in zip(segments, starts, starts[1:]):
+            self.assertAlmostEqual(next_start - start, duration, delta=0.05)
+
+    @override_settings(HLS_CHUNK_DURATION=6, HLS_TRANSCODE_MODE='chunked', HLS_STARTUP_RUNG={'height': 144, 'video_bitrate': 200})
+    @patch('content_app.tasks.publish_playable')
+    @patch('content_app.tasks.save_progress')
+    @patch('content_app.progress.save_progress')
+    def test_stitched_rendition_cuts_where_whole_rendition_does(self, *mocks):
+        ladder = build_ladder(dict(SOURCE_PROBE, width=320, height=240), ladder=[{'height': 240, 'video_bitrate': 400}])
+        whole, stitched = ladder[:2]
+        convert_rendition_to_hls(1, self.source, self.base, whole, 20, ladder)
+        chunks = plan_chunks(20)
+        for name, start, end in chunks:
+            encode_chunk(1, self.source, self.base, name, start, end, stitched, len(chunks))
+        stitch_rendition(1, self.base, stitched, [name for name, _, _ in chunks], ladder)
+
+        def boundaries(label):
+            with open(os.path.join(get_rendition_dir(self.base, label), 'index.m3u8')) as f:
+                durations = [duration for duration, _ in parse_media_playlist(f.read())]
+            return [round(sum(durations[:i + 1]), 1) for i in range(len(durations))]
+
+        self.assertEqual((whole['label'], stitched['label']), ('144p', '240p'))
+        self.assertEqual(boundaries('144p'), [2, 4, 6, 12, 18, 20])
+        self.assertEqual(boundaries('240p'), boundaries('144p'))
+
+    @override_settings(HLS_CHUNK_DURATION=6, HLS_TRANSCODE_MODE='chunked')
+    @patch('content_app.tasks.publish_playable')
+    @patch('content_app.tasks.save_progress')
+    @patch('content_app.progress.save_progress')
+    def test_audio_stays_in_sync_with_stitched_video(self, *mocks):
+        video, audio = build_ladder(dict(SOURCE_PROBE, width=320, height=240))
+        chunks = plan_chunks(20)
+        for name, start, end in chunks:
+            encode_chunk(1, self.source, self.base, name, start, end, video, len(chunks))
+        stitch_rendition(1, self.base, video, [name for name, _, _ in chunks], [video])
+        convert_rendition_to_hls(1, self.source, self.base, audio, 20, [video, audio])
+
+        video_start = first_video_pts(os.path.join(get_rendition_dir(self.base, '240p'), 'segment_000.ts'))
+        audio_start = first_video_pts(os.path.join(get_rendition_dir(self.base, 'audio'), 'segment_000.ts'), range(0xC0, 0xE0))
+        self.assertAlmostEqual(audio_start, video_start, delta=0.1)
+
+
+class BenchmarkCommandTests(APITestCase):
+    def test_benchmark_reports_synthetic_clips_as_json(self):
+        out = io.StringIO()
+        call_command('benchmark_transcode', durations=[2], heights=[240], modes=['single_pass'], presets=['ultrafast'], stdout=out)
+
+        [result] = json.loads(out.getvalue())['results']
+        self.assertEqual((result['source_resolution'], result['mode'], result['preset']), ('426x240', 'single_pass', 'ultrafast'))
+        self.assertGreater(result['realtime_factor'], 0)
+        self.assertGreater(result['renditions']['240p']['bytes'], 0)
+        self.assertEqual(result['renditions']['240p']['segments'], 1)
+
+    def test_segment_delivery_benchmark_reports_cpu_per_gb(self):
+        out = io.StringIO()
+        call_command('benchmark_segment_delivery', requests=3, segment_size=1, stdout=out)
+
+        results = {result['mode']: result for result in json.loads(out.getvalue())['results']}
+        self.assertEqual(set(results), {'worker', 'segment-cache', 'x-accel-redirect', 'x-sendfile'})
+        self.assertEqual(results['segment-cache']['bytes_served'], 3 * 1024 * 1024)
+        self.assertEqual(results['worker']['bytes_served'], 3 * 1024 * 1024)
+        self.assertEqual(results['x-sendfile']['bytes_served'], 3 * 1024 * 1024)
+        self.assertIn('cpu_seconds_per_gb', results['worker'])
+        self.assertFalse(Video.objects.filter(content_hash='benchmark').exists())
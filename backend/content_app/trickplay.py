@@ -0,0 +1,104 @@
+import math
+import os
+
+from django.conf import settings
+
+from content_app.encoding import video_rungs
+
+TRICKPLAY_VTT = 'trickplay.vtt'
+THUMBNAIL_PATTERN = 'thumbnail_%05d.jpg'
+SPRITE_PATTERN = 'sprite_%03d.jpg'
+
+
+def tile_size(ladder):
+    """
+        Width and height of one thumbnail, the aspect ratio is taken from the highest video rung
+    """
+    rung = video_rungs(ladder)[-1]
+    width = settings.TRICKPLAY_WIDTH
+    return width, round(width * rung['height'] / rung['width'] / 2) * 2
+
+
+def trickplay_filter(ladder):
+    """
+        ffmpeg filter which scales the frames down to thumbnail size
+    """
+    width, height = tile_size(ladder)
+    return f'scale={width}:{height}'
+
+
+def trickplay_output_args(output_dir):
+    """
+        ffmpeg output options writing one jpeg thumbnail per interval.
+        Frames are dropped by the output frame rate instead of an fps filter, a filter would hold
+        the shared filter graph back by a whole interval and queue full size frames of every rendition
+    """
+    return [
+        '-r', f'1/{settings.TRICKPLAY_INTERVAL}',
+        '-c:v', 'mjpeg',
+        '-q:v', '5',
+        '-f', 'image2',
+        '-start_number', '0',
+        os.path.join(output_dir, THUMBNAIL_PATTERN)
+    ]
+
+
+def build_sprite_command(output_dir):
+    """
+        ffmpeg command which packs the thumbnails into sprite sheets of columns x rows
+    """
+    return [
+        'ffmpeg', '-y',
+        '-framerate', '1',
+        '-start_number', '0',
+        '-i', os.path.join(output_dir, THUMBNAIL_PATTERN),
+        '-vf', f'tile={settings.TRICKPLAY_COLUMNS}x{settings.TRICKPLAY_ROWS}',
+        '-q:v', '5',
+        '-start_number', '0',
+        os.path.join(output_dir, SPRITE_PATTERN)
+    ]
+
+
+def build_trickplay_command(source, output_dir, ladder):
+    """
+        ffmpeg command for the thumbnails alone, used when they are not part of the single pass
+    """
+    return [
+        'ffmpeg', '-y',
+        '-i', source,
+        '-map', '0:v:0',
+        '-vf', trickplay_filter(ladder),
+        *trickplay_output_args(output_dir)
+    ]
+
+
+def format_vtt_time(seconds):
+    """
+        WebVTT timestamp hh:mm:ss.ttt
+    """
+    millis = round(seconds * 1000)
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    return f'{hours:02d}:{minutes:02d}:{millis / 1000:06.3f}'
+
+
+def render_trickplay_vtt(duration, ladder, thumbnail_count):
+    """
+        WebVTT track with one cue per thumbnail pointing at its tile in a sprite sheet
+    """
+    width, height = tile_size(ladder)
+    interval = settings.TRICKPLAY_INTERVAL
+    per_sheet = settings.TRICKPLAY_COLUMNS * settings.TRICKPLAY_ROWS
+    tiles = min(math.ceil(duration / interval), thumbnail_count)
+
+    lines = ['WEBVTT', '']
+    for tile in range(tiles):
+        sheet, position = divmod(tile, per_sheet)
+        row, column = divmod(position, settings.TRICKPLAY_COLUMNS)
+        start, end = tile * interval, min((tile + 1) * interval, duration)
+        lines += [
+            f'{format_vtt_time(start)} --> {format_vtt_time(end)}',
+            f'{SPRITE_PATTERN % sheet}#xywh={column * width},{row * height},{width},{height}',
+            ''
+        ]
+    return '\n'.join(lines)
@@ -0,0 +1,109 @@
+import base64
+import binascii
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+
+from django.http import UnreadablePostError
+
+from content_app.models import Video
+
+TUS_VERSION = '1.0.0'
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class UploadLocked(Exception):
+    pass
+
+
+def parse_metadata(header):
+    """
+        Decode a tus Upload-Metadata header, comma separated "key base64-value" pairs
+    """
+    metadata = {}
+    for pair in filter(None, (pair.strip() for pair in (header or '').split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            raise ValueError(f'Invalid metadata value for {key}')
+    return metadata
+
+
+def parse_checksum(header):
+    """
+        Decode a tus Upload-Checksum header, only sha256 is supported
+    """
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm != 'sha256':
+        raise ValueError(f'Unsupported checksum algorithm {algorithm}')
+    try:
+        return base64.b64decode(value)
+    except binascii.Error:
+        raise ValueError('Invalid checksum')
+
+
+@contextmanager
+def open_upload_file(path):
+    """
+        Open the file of an upload to write a chunk and hold a flock on it meanwhile, so a second
+        request for the same upload raises UploadLocked instead of writing over the first.
+        The lock goes away with the file, also when the worker dies
+    """
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadLocked()
+        yield f
+
+
+def write_chunk(f, offset, stream, length, checksum=None):
+    """
+        Write up to length bytes of the request stream to the file at offset, the stream is read
+        in bounded pieces so memory stays flat. A broken connection keeps the bytes which arrived,
+        a checksum mismatch truncates the file back to the offset. Returns the bytes written
+    """
+    sha256 = hashlib.sha256()
+    written = 0
+    f.seek(offset)
+    f.truncate()
+    while written < length:
+        try:
+            data = stream.read(min(CHUNK_SIZE, length - written))
+        except UnreadablePostError:
+            break
+        if not data:
+            break
+        f.write(data)
+        sha256.update(data)
+        written += len(data)
+
+    if checksum is not None and sha256.digest() != checksum:
+        f.truncate(offset)
+        raise ChecksumMismatch()
+    return written
+
+
+def create_video_from_upload(upload):
+    """
+        Create the video of a completed upload, its post_save signal enqueues the transcode
+    """
+    metadata = upload.metadata
+    category = metadata.get('category')
+    video = Video.objects.create(
+        title=metadata.get('title') or os.path.splitext(metadata['filename'])[0],
+        description=metadata.get('description', ''),
+        category=category if category in Video.Category.values else Video.Category.MOVIE,
+        video_file=upload.file_name
+    )
+    upload.video = video
+    upload.save(update_fields=['video'])
+    return video
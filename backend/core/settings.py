@@ -43,7 +43,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'core.middleware.WhiteNoiseMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -107,8 +107,132 @@ RQ_QUEUES = {
         'DEFAULT_TIMEOUT': 900,
         'REDIS_CLIENT_KWARGS': {},
     },
+    # Entry jobs which hash, probe and encode the lowest rendition so a video becomes playable quickly
+    'transcode_high': {
+        'HOST': os.environ.get("REDIS_HOST", default="redis"),
+        'PORT': os.environ.get("REDIS_PORT", default=6379),
+        'DB': os.environ.get("REDIS_DB", default=0),
+        'DEFAULT_TIMEOUT': int(os.environ.get("TRANSCODE_TIMEOUT", default=3 * 60 * 60)),
+        'REDIS_CLIENT_KWARGS': {},
+    },
+    'transcode': {
+        'HOST': os.environ.get("REDIS_HOST", default="redis"),
+        'PORT': os.environ.get("REDIS_PORT", default=6379),
+        'DB': os.environ.get("REDIS_DB", default=0),
+        'DEFAULT_TIMEOUT': int(os.environ.get("TRANSCODE_TIMEOUT", default=3 * 60 * 60)),
+        'REDIS_CLIENT_KWARGS': {},
+    },
 }
 
+# HLS transcoding
+# 'serial' runs one ffmpeg process per resolution,
+# 'single_pass' decodes the source once and writes every resolution from one filter graph,
+# The lowest resolution is always encoded first on the transcode_high queue and published on its own,
+# the mode decides how the remaining resolutions are encoded on the transcode queue.
+# 'fanout' encodes every resolution as its own job on the transcode queue,
+# 'chunked' splits the source on the segment grid and encodes every chunk of every resolution as its own job
+HLS_TRANSCODE_MODE = os.environ.get('HLS_TRANSCODE_MODE', default='single_pass')
+# 'mpegts' writes one file per segment, 'fmp4' writes every resolution as one fragmented mp4
+# addressed by byte range playlists. The chunked mode always stitches mpegts segments
+HLS_SEGMENT_FORMAT = os.environ.get('HLS_SEGMENT_FORMAT', default='mpegts')
+# Target length in seconds of one hls segment
+HLS_SEGMENT_DURATION = int(os.environ.get('HLS_SEGMENT_DURATION', default=6))
+# Startup profile, video renditions start with HLS_STARTUP_SEGMENTS segments of HLS_STARTUP_SEGMENT_DURATION
+# seconds so players start after a short download, 0 segments disables it. Keyframes are forced at every
+# segment boundary, the same in every video rendition, so every segment decodes on its own
+HLS_STARTUP_SEGMENTS = int(os.environ.get('HLS_STARTUP_SEGMENTS', default=3))
+HLS_STARTUP_SEGMENT_DURATION = int(os.environ.get('HLS_STARTUP_SEGMENT_DURATION', default=2))
+# Least length in seconds of one chunk in chunked mode, cuts happen at the next segment boundary
+HLS_CHUNK_DURATION = int(os.environ.get('HLS_CHUNK_DURATION', default=120))
+# Encoding ladder, bitrates in kbit/s. Rungs above the source height are skipped
+# and video bitrates are capped at the source bitrate, optional max_fps caps the frame rate
+HLS_LADDER = [
+    {'height': 480, 'video_bitrate': 1400},
+    {'height': 720, 'video_bitrate': 2800},
+    {'height': 1080, 'video_bitrate': 5000},
+]
+# Optional low bitrate rung below the ladder players start on before they measured the bandwidth,
+# e.g. {'height': 240, 'video_bitrate': 400}. It is listed first in the master playlist and encoded first
+HLS_STARTUP_RUNG = None
+# Bitrate in kbit/s of the audio rendition, encoded once and shared by all video renditions
+HLS_AUDIO_BITRATE = int(os.environ.get('HLS_AUDIO_BITRATE', default=128))
+# Largest file in bytes accepted by the resumable upload api
+VIDEO_UPLOAD_MAX_SIZE = int(os.environ.get('VIDEO_UPLOAD_MAX_SIZE', default=20 * 1024 ** 3))
+# Trickplay thumbnails for scrubbing, one every TRICKPLAY_INTERVAL seconds (0 disables them).
+# Thumbnails are TRICKPLAY_WIDTH pixels wide and packed into sprite sheets of columns x rows
+TRICKPLAY_INTERVAL = int(os.environ.get('TRICKPLAY_INTERVAL', default=10))
+TRICKPLAY_WIDTH = 160
+TRICKPLAY_COLUMNS = 10
+TRICKPLAY_ROWS = 10
+# Concurrent ffmpeg processes per host, 0 allows one per 4 cores. Every process gets
+# an equal share of the cores as encoder threads, slots are lock files shared by all workers of the host
+TRANSCODE_FFMPEG_SLOTS = int(os.environ.get('TRANSCODE_FFMPEG_SLOTS', default=0))
+TRANSCODE_LOCK_DIR = os.environ.get('TRANSCODE_LOCK_DIR', default='/tmp/videoflix-ffmpeg-slots')
+# x264 preset of a new video by the number of jobs waiting on the transcode queues,
+# (minimum backlog, preset) pairs starting at 0. Faster presets drain a backlog sooner
+HLS_BACKLOG_PRESETS = [(0, 'medium'), (20, 'fast'), (100, 'veryfast')]
+# Minimum seconds between two transcode progress writes of one ffmpeg process
+HLS_PROGRESS_INTERVAL = int(os.environ.get('HLS_PROGRESS_INTERVAL', default=5))
+# Where published renditions are stored and served from. The local backend keeps them below MEDIA_ROOT,
+# the S3 backend uploads them to an S3 compatible bucket (AWS S3, MinIO) so web hosts need no shared
+# filesystem. Workers still encode into MEDIA_ROOT and drop their copies once a transcode is finalized
+RENDITION_STORAGE = {
+    'BACKEND': os.environ.get('RENDITION_STORAGE_BACKEND', default='content_app.rendition_storage.LocalRenditionStorage'),
+    'OPTIONS': {},
+}
+if RENDITION_STORAGE['BACKEND'].endswith('S3RenditionStorage'):
+    RENDITION_STORAGE['OPTIONS'] = {
+        'bucket': os.environ.get('RENDITION_S3_BUCKET', default='videoflix'),
+        'prefix': os.environ.get('RENDITION_S3_PREFIX', default=''),
+        'endpoint_url': os.environ.get('RENDITION_S3_ENDPOINT_URL'),
+        'region_name': os.environ.get('RENDITION_S3_REGION'),
+        'access_key_id': os.environ.get('RENDITION_S3_ACCESS_KEY_ID'),
+        'secret_access_key': os.environ.get('RENDITION_S3_SECRET_ACCESS_KEY'),
+    }
+# Segment delivery by the reverse proxy, the segment view only checks access and answers with a header.
+# 'x-accel-redirect' for nginx, HLS_OFFLOAD_PREFIX has to be an internal location aliased to MEDIA_ROOT:
+#     location /protected-media/ { internal; alias /app/media/; }
+# 'x-sendfile' for apache mod_xsendfile and lighttpd with the absolute path of the file.
+# Empty streams the segments through the worker, as does every backend without local files
+HLS_OFFLOAD = os.environ.get('HLS_OFFLOAD', default='')
+HLS_OFFLOAD_PREFIX = os.environ.get('HLS_OFFLOAD_PREFIX', default='/protected-media/')
+# Cache-Control of HLS responses, the views need a login so caches are private unless a CDN signs access.
+# Segments never change once published, finished VOD playlists only when a video is transcoded again.
+# The master playlist is revalidated while renditions are still being added to it
+HLS_SEGMENT_CACHE_CONTROL = os.environ.get('HLS_SEGMENT_CACHE_CONTROL', default='private, max-age=31536000, immutable')
+HLS_PLAYLIST_CACHE_CONTROL = os.environ.get('HLS_PLAYLIST_CACHE_CONTROL', default='private, max-age=300')
+HLS_INCOMPLETE_CACHE_CONTROL = 'private, no-cache'
+# Serve media playlists and segments from async views, set by the ASGI deployment (ASGI=True in the entrypoint).
+# Under WSGI the sync views stay, django would buffer the async streams of whole segments
+HLS_ASYNC_VIEWS = os.environ.get('HLS_ASYNC_VIEWS', 'False') == 'True'
+# Seconds the segment tokens of a served media playlist stay valid, players fetch a VOD playlist once
+# so this has to cover watching the longest video including pauses
+HLS_SEGMENT_TOKEN_TTL = int(os.environ.get('HLS_SEGMENT_TOKEN_TTL', default=6 * 60 * 60))
+# Hot segment cache of the segment views within HLS_SEGMENT_CACHE_BUDGET bytes per process, off by default.
+# Every worker process holds its own budget in memory on top of its usual footprint, so a host needs
+# workers x budget spare RAM. With HLS_SEGMENT_CACHE_DIR on a tmpfs like /dev/shm the workers of a host share one budget and map the
+# cached segments from there. 'lru' evicts the least recently used segments, 'tinylfu' also only admits a
+# segment requested more often than the ones it would evict. Larger files than HLS_SEGMENT_CACHE_MAX_SIZE
+# and files the reverse proxy sends with HLS_OFFLOAD are not cached
+HLS_SEGMENT_CACHE_BUDGET = int(os.environ.get('HLS_SEGMENT_CACHE_BUDGET', default=0))
+HLS_SEGMENT_CACHE_POLICY = os.environ.get('HLS_SEGMENT_CACHE_POLICY', default='tinylfu')
+HLS_SEGMENT_CACHE_MAX_SIZE = int(os.environ.get('HLS_SEGMENT_CACHE_MAX_SIZE', default=8 * 1024 * 1024))
+HLS_SEGMENT_CACHE_DIR = os.environ.get('HLS_SEGMENT_CACHE_DIR', default='')
+# Video id to rendition location lookups of the HLS views, cached in redis and in a per process LRU.
+# Saves and deletes drop both, other processes keep a stale LRU entry for at most VIDEO_LOCATION_LOCAL_TTL seconds
+VIDEO_LOCATION_CACHE_TIMEOUT = 24 * 60 * 60
+VIDEO_LOCATION_LOCAL_TTL = int(os.environ.get('VIDEO_LOCATION_LOCAL_TTL', default=60))
+VIDEO_LOCATION_LOCAL_SIZE = 4096
+# Rendition storage garbage collection on the default queue, a pass looks at STORAGE_GC_BATCH_SIZE
+# entries of MEDIA_ROOT/videos per job and starts again every STORAGE_GC_INTERVAL seconds.
+# With the S3 backend the objects below videos/ in the bucket are listed and collected alongside,
+# every job lists the whole prefix once, only orphaned objects are looked up for their age
+# Orphans younger than STORAGE_GC_MIN_AGE seconds are kept, they may belong to a transcode just starting
+STORAGE_GC_INTERVAL = int(os.environ.get('STORAGE_GC_INTERVAL', default=6 * 60 * 60))
+STORAGE_GC_BATCH_SIZE = 500
+STORAGE_GC_MIN_AGE = 24 * 60 * 60
+# Files unlinked per delete job, larger manifests continue in a follow up job
+STORAGE_DELETE_BATCH_SIZE = 1000
 
 
 # Password validation
@@ -194,6 +318,10 @@ DEFAULT_FROM_EMAIL=os.environ.get('DEFAULT_FROM_EMAIL')
 
 
 from datetime import timedelta
+# Build request.user from the access token claims instead of querying the user on every request.
+# Deactivating a user or resetting the password revokes the tokens through a version kept in redis
+JWT_CLAIMS_USER = os.environ.get('JWT_CLAIMS_USER', 'False') == 'True'
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=21),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -6,7 +6,10 @@ from rq import Retry
 
 DEFAULT_RETRY = Retry(max=3, interval=[10, 30, 60])
 
+def enqueue(task, *args, queue='default', **kwargs):
+    """ put task into rq right away and return the job """
+    return django_rq.get_queue(queue).enqueue(task, *args, retry=DEFAULT_RETRY, **kwargs)
+
 def enqueue_after_commit(task, *args, queue='default', **kwargs):
     """ put task into rq after instance is store in DB"""
-    transaction.on_commit(lambda: django_rq.get_queue(queue).enqueue(task, *args, retry=DEFAULT_RETRY, **kwargs))
-       
\ No newline at end of file
+    transaction.on_commit(lambda: enqueue(task, *args, queue=queue, **kwargs))
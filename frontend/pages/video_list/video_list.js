@@ -77,7 +77,7 @@ async function loadAndSetupVideos() {
 function setupInitialVideo() {
     if (VIDEOS && VIDEOS.length > 0) {
         currentVideo = VIDEOS[0].id;
-        loadVideo(VIDEOS[0].id, '480p');
+        loadVideo(VIDEOS[0].id, 'auto');
     }
 }
 
@@ -210,7 +210,7 @@ function showVideo(id) {
     document.getElementById('videoDescription').innerHTML = video.description;
     document.getElementById('playButton').setAttribute("onclick", `playVideo(${id})`)
     currentVideo = id
-    loadVideo(id, '480p');
+    loadVideo(id, 'auto');
 }
 
 /**
@@ -236,7 +236,7 @@ async function doRefresh() {
 /**
  * Loads and plays a video using HLS.js.
  * @param {number} id - The video ID.
- * @param {string} resolution - The desired video resolution (e.g., '480p').
+ * @param {string} resolution - The desired video resolution (e.g., '480p') or 'auto' for adaptive bitrate.
  */
 function loadVideo(id, resolution) {
     if (hls) {
@@ -306,10 +306,11 @@ function loadVideo(id, resolution) {
         enableEmsgMetadataCues: false,
         enableID3MetadataCues: false
     });
-    hls.loadSource(`${API_BASE_URL}${URL_TO_INDEX_M3U8(id, resolution)}`);
+    hls.loadSource(`${API_BASE_URL}${URL_TO_MASTER_M3U8(id)}`);
     hls.attachMedia(videoContainer);
 
     hls.on(Hls.Events.MANIFEST_PARSED, () => {
+        pinResolution(hls, resolution);
         setTimeout(() => {
             videoContainer.play().catch(() => {
                 console.log("User interaction required to start playback");
@@ -324,6 +325,18 @@ function loadVideo(id, resolution) {
     });
 }
 
+/**
+ * Pins HLS.js to the level of a fixed resolution, 'auto' keeps the adaptive bitrate switching.
+ * The resolution playlists carry no sound, every level plays the shared audio of the master playlist.
+ * @param {Hls} player - HLS.js instance with a parsed master playlist
+ * @param {string} resolution - 'auto' or a fixed resolution (e.g., '720p')
+ */
+function pinResolution(player, resolution) {
+    if (resolution === 'auto') return;
+    const level = player.levels.findIndex(level => `${level.height}p` === resolution);
+    if (level !== -1) player.currentLevel = level;
+}
+
 /**
  * Proofs if a container is scrollable and add then the CSS class
  * @param {HTMLElement} container - container that should be proofed
@@ -449,10 +462,11 @@ function loadVideoInOverlay(id, resolution) {
         enableID3MetadataCues: false
     });
 
-    overlayHls.loadSource(`${API_BASE_URL}${URL_TO_INDEX_M3U8(id, resolution)}`);
+    overlayHls.loadSource(`${API_BASE_URL}${URL_TO_MASTER_M3U8(id)}`);
     overlayHls.attachMedia(overlayVideoContainer);
 
     overlayHls.on(Hls.Events.MANIFEST_PARSED, () => {
+        pinResolution(overlayHls, resolution);
         setTimeout(() => {
             overlayVideoContainer.play().catch(() => {
             console.log("User interaction required to start overlay playback");
@@ -66,3 +66,16 @@ const TOAST_DURATION = 2000;
  * // url is 'video/5/720p/index.m3u8'
  */
 const URL_TO_INDEX_M3U8 = (id, resolution) => `video/${id}/${resolution}/index.m3u8`
+
+/**
+ * Generates the URL path to the adaptive bitrate master playlist (master.m3u8) of a video.
+ * HLS.js switches between all resolutions listed in it depending on the bandwidth.
+ *
+ * @param {number|string} id - The unique identifier of the video/movie.
+ * @returns {string} The URL path to the master playlist of the video.
+ *
+ * @example
+ * const url = URL_TO_MASTER_M3U8(5);
+ * // url is 'video/5/master.m3u8'
+ */
+const URL_TO_MASTER_M3U8 = (id) => `video/${id}/master.m3u8`
@@ -68,11 +68,11 @@ let overlayVideoContainer
 let currentVideo
 
 /**
- * Current video resolution selected by the user (default is '480p').
+ * Current video resolution selected by the user (default is 'auto', adaptive bitrate).
  *
  * @type {string}
  */
-let currentResolution = '480p'
+let currentResolution = 'auto'
 
 /**
  * Predefined messages for different activation states (e.g., loading, success, error).